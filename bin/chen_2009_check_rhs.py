@@ -0,0 +1,22 @@
+"""Check the PySB Chen 2009 ODEs against the original SimBiology equations.
+
+Usage: chen_2009_check_rhs.py [n_states] [rtol]
+
+Both right hand sides are evaluated at `n_states` (default 2000) random
+states, and every species whose derivative differs by more than `rtol`
+(default 1e-6) of the sum of the contributions to it is printed with the
+reactions responsible. Exits with status 1 if any species disagrees.
+"""
+
+import sys
+from rasmodel.chen_2009 import model, equivalence
+
+def main(argv):
+    n_states = int(argv[1]) if len(argv) > 1 else 2000
+    rtol = float(argv[2]) if len(argv) > 2 else 1e-6
+    comparison = equivalence.compare_rhs(model, n_states=n_states, rtol=rtol)
+    print comparison
+    return 0 if comparison.equivalent else 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
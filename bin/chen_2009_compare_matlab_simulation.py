@@ -1,10 +1,8 @@
-from rasmodel.chen_2009 import model
-from pysb.integrate import Solver
-from pysb.bng import generate_equations
+from rasmodel.chen_2009 import model, EGF, HRG
+from rasmodel.simulation.solver import Simulator
 import matplotlib.pyplot as plt
 import numpy as np
 from numpy.lib.recfunctions import merge_arrays
-import sympy
 import scipy
 import scipy.io
 import os.path
@@ -14,12 +12,11 @@ import pkg_resources
 plt.figure()
 
 ## Simulate PySB model.
-# Implement "fixed" species (they are never consumed).
-generate_equations(model)
-for i in (5, 6, 7):
-    model.odes[i] = sympy.numbers.Zero()
+# Ligands are "fixed" species (they are never consumed).
+fixed = [EGF(rec=None, comp='pm'), HRG(rec=None, comp='pm'),
+         HRG(rec=None, comp='endo')]
 tspan = np.linspace(0, 9000, 9001)
-solver = Solver(model, tspan, atol=1e-6, rtol=1e-8)
+solver = Simulator(model, tspan, clamped=fixed, atol=1e-6, rtol=1e-8)
 solver.run()
 pysb_sim = merge_arrays((solver.yobs, solver.yexpr), flatten=True)
 
@@ -0,0 +1,36 @@
+"""Report how far the Chen 2009 network lumps exactly.
+
+Usage: chen_2009_lumping.py [-v]
+
+Prints the number of state variables before and after forward and backward
+lumping (the latter for the model's initial values), and with -v the species
+of every block with more than one.
+"""
+
+import sys
+from rasmodel.chen_2009 import model, EGF, HRG
+from rasmodel.network.cache import generate_equations
+from rasmodel.simulation.system import MassActionSystem
+from rasmodel.simulation.lumping import (LumpedSystem, forward_partition,
+                                         backward_partition)
+
+def main(argv):
+    generate_equations(model)
+    fixed = [EGF(rec=None, comp='pm'), HRG(rec=None, comp='pm'),
+             HRG(rec=None, comp='endo')]
+    system = MassActionSystem(model, clamped=fixed)
+    for kind, partition in (('forward', forward_partition),
+                            ('backward', backward_partition)):
+        lumped = LumpedSystem(system, partition(system), kind)
+        print '%-8s %d -> %d state variables (%.3gx)' % (
+            kind, system.n_state, lumped.n_state, lumped.compression)
+        if '-v' in argv:
+            for block in range(lumped.n_state):
+                if lumped.sizes[block] > 1:
+                    for i in (lumped.blocks == block).nonzero()[0]:
+                        print '    %s' % model.species[system.free[i]]
+                    print
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,24 @@
+"""Report which rules, component functions and modules generate the network.
+
+Usage: chen_2009_network_profile.py [module ...] [--sort=KEY] [--max-species=N]
+
+Modules default to all of erbb, pi3k and mapk. KEY is one of species,
+reactions, seconds or tuples (default species).
+"""
+
+import sys
+from rasmodel import chen_2009
+from rasmodel.network.profile import profile_network
+
+def main(argv):
+    modules = [a for a in argv[1:] if not a.startswith('--')]
+    options = dict(a[2:].split('=', 1) for a in argv[1:] if a.startswith('--'))
+    model = chen_2009.build_model(modules or chen_2009.MODULES)
+    max_species = options.get('max-species')
+    profile = profile_network(model, chen_2009.rule_origins(model),
+                              max_species=max_species and int(max_species))
+    profile.report(sort=options.get('sort', 'species'))
+    return 1 if profile.error else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,28 @@
+"""Report how much of the network each readout depends on.
+
+Usage: chen_2009_observable_cones.py [target ...]
+
+Targets are observable or expression names and default to pErbB1, pERK and
+pAKT.
+"""
+
+import sys
+from rasmodel.chen_2009 import model
+from rasmodel.network.cache import generate_equations
+from rasmodel.network.dependency import cone_report
+
+def main(argv):
+    targets = argv[1:] or ['pErbB1', 'pERK', 'pAKT']
+    generate_equations(model)
+    print '%-20s %8s %10s %11s' % ('target', 'species', 'reactions',
+                                   'candidates')
+    print '%-20s %8d %10d' % ('(network)', len(model.species),
+                              len(model.reactions))
+    for row in cone_report(model, targets):
+        print '%-20s %8d %10d %11d' % (row['name'], row['species'],
+                                       row['reactions'],
+                                       len(row['candidates']))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
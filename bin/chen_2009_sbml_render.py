@@ -485,10 +485,10 @@ species_nodes_to_drop = set(
     n for n in graph.nodes_iter()
     if n not in box_and_neighbors and n.attr['_type'] == 'species')
 reaction_nodes_to_drop = neighbor_set(species_nodes_to_drop)
-dropped_species = [s for s in model.species
-                   if s.name in species_nodes_to_drop]
-dropped_reactions = [r for r in model.reactions
-                     if r.name in reaction_nodes_to_drop]
+dropped_species = [model.species_by_name(str(n))
+                   for n in species_nodes_to_drop]
+dropped_reactions = [model.reaction_by_name(str(n))
+                     for n in reaction_nodes_to_drop]
 for n in list(species_nodes_to_drop | reaction_nodes_to_drop):
     graph.remove_node(n)
 num_keep_species = len([n for n in graph.nodes() if n.attr['_type'] == 'species'])
@@ -0,0 +1,44 @@
+"""Rank the Chen 2009 parameters by their effect on pERK, pAKT and pErbB1.
+
+Usage: chen_2009_sensitivity.py [module ...]
+
+Forward sensitivities to the parameters of the given component modules
+(default: all of them) are integrated over the reference protocol with fixed
+ligands over one hour. For each readout the parameters are ranked by their
+largest normalized sensitivity, p / max(y) * dy/dp, over the time course.
+"""
+
+import sys
+import time
+import numpy as np
+from rasmodel.chen_2009 import (model, EGF, HRG, MODULES,
+                                module_parameters)
+from rasmodel.simulation.sensitivity import SensitivitySolver
+
+def main(argv):
+    modules = argv[1:] or MODULES
+    fixed = [EGF(rec=None, comp='pm'), HRG(rec=None, comp='pm'),
+             HRG(rec=None, comp='endo')]
+    tspan = np.linspace(0, 3600, 61)
+    sim = SensitivitySolver(model, tspan, module_parameters(model, modules),
+                            clamped=fixed, atol=1e-6, rtol=1e-8)
+    start = time.time()
+    sim.run()
+    print '%d parameters in %.1fs (%d steps)' % (len(sim.parameters),
+                                                 time.time() - start,
+                                                 sim.stats['nsteps'])
+    values = np.array([model.parameters[name].value
+                       for name in sim.parameters])
+    for name, y, dy in [('pERK', sim.yobs['pERK'], sim.dyobs['pERK']),
+                        ('pAKT', sim.yobs['pAKT'], sim.dyobs['pAKT']),
+                        ('pErbB1', sim.yexpr['pErbB1'],
+                         sim.dyexpr['pErbB1'])]:
+        normalized = np.abs(dy * values).max(axis=0) / np.abs(y).max()
+        print
+        print name
+        for j in np.argsort(-normalized)[:10]:
+            print '  %-12s %9.3g' % (sim.parameters[j], normalized[j])
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1,19 +1,16 @@
-from rasmodel.chen_2009 import model
-from pysb.integrate import Solver
-from pysb.bng import generate_equations
+from rasmodel.chen_2009 import model, EGF, HRG
+from rasmodel.simulation.solver import Simulator
 import numpy as np
 import matplotlib.pyplot as plt
-import sympy
 
 # Replicate matlab simulation
 
-# Implement "fixed" species (they are never consumed).
-generate_equations(model)
-for i in (5, 6, 7):
-    model.odes[i] = sympy.numbers.Zero()
+# Ligands are "fixed" species (they are never consumed).
+fixed = [EGF(rec=None, comp='pm'), HRG(rec=None, comp='pm'),
+         HRG(rec=None, comp='endo')]
 
 tspan = np.linspace(0, 9000, 9001)
-solver = Solver(model, tspan, atol=1e-6, rtol=1e-8)
+solver = Simulator(model, tspan, clamped=fixed, atol=1e-6, rtol=1e-8)
 solver.run()
 
 plt.figure()
@@ -1,20 +1,14 @@
 import rasmodel.chen_2009.original_sbml as sbml
-from pysb.integrate import Solver
-from pysb.bng import generate_equations
 import numpy as np
 import matplotlib.pyplot as plt
-import sympy
 
-# Replicate matlab simulation using PySB simulation code.
-
-model = sbml.pysb_model()
-
-generate_equations(model)
-for i in (0, 388, 334):
-    model.odes[i] = sympy.numbers.Zero()
+# Replicate matlab simulation, integrating the SBML reactions directly.
+# Species declared constant in the SBML (EGF and the two HRG pools) are held
+# fixed, and the inhibitor reactions left out of the MATLAB simulation are
+# dropped.
 
 tspan = np.linspace(0, 9000, 9001)
-solver = Solver(model, tspan, atol=1e-6, rtol=1e-8)
+solver = sbml.simulator(tspan, scoped=True, atol=1e-6, rtol=1e-8)
 solver.run()
 
 plt.figure()
@@ -0,0 +1,39 @@
+"""Propose fast species of the Chen 2009 model for QSSA and report the error.
+
+Usage: chen_2009_timescales.py [threshold] [max_fraction]
+
+The reference protocol is the default simulation with fixed ligands over one
+hour. Species faster than `threshold` seconds (default 0.01) at every output
+time, and holding at most `max_fraction` (default 0.01) of a conserved pool,
+are eliminated.
+"""
+
+import sys
+import numpy as np
+from rasmodel.chen_2009 import model, EGF, HRG
+from rasmodel.simulation.solver import Simulator
+from rasmodel.simulation import timescale
+
+def main(argv):
+    threshold = float(argv[1]) if len(argv) > 1 else 0.01
+    max_fraction = float(argv[2]) if len(argv) > 2 else 0.01
+    fixed = [EGF(rec=None, comp='pm'), HRG(rec=None, comp='pm'),
+             HRG(rec=None, comp='endo')]
+    tspan = np.linspace(0, 3600, 61)
+    options = dict(clamped=fixed, atol=1e-6, rtol=1e-8)
+    sim = Simulator(model, tspan, **options)
+    sim.run()
+    system = sim.system
+    fast = timescale.propose_fast(system, system.state(sim.y),
+                                  system.rate_constants(),
+                                  threshold=threshold,
+                                  max_fraction=max_fraction)
+    for f in fast:
+        print '%4d %-12s %9.3g  %s' % (f.species, f.kind, f.timescale,
+                                       model.species[f.species])
+    print timescale.error_report(model, tspan, [f.species for f in fast],
+                                 **options)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -2,8 +2,9 @@ from rasmodel.scenarios.default import model
 
 import numpy as np
 from matplotlib import pyplot as plt
-from pysb.integrate import Solver
 from pysb import *
+from rasmodel.simulation.solver import Simulator
+from rasmodel.simulation.sweep import run_sweep
 
 from tbidbaxlipo.util import fitting
 
@@ -23,15 +24,23 @@ plt.figure()
 
 t = np.linspace(0, 1000, 1000) # 1000 seconds
 
-for mutant in KRAS.site_states['mutant']:
-    # Zero out all initial conditions
-    for ic in model.initial_conditions:
-        ic[1].value = 0
-    model.parameters['KRAS_%s_GTP_0' % mutant].value = total_pi
-
-    sol = Solver(model, t)
-    sol.run()
-    plt.plot(t, sol.yobs['Pi_'] / total_pi, label=mutant)
+sol = Simulator(model, t)
+mutants = KRAS.site_states['mutant']
+pi = sol.system.observable_names.index('Pi_')
+# All initial conditions zeroed out.
+zero = dict((ic[1].name, 0) for ic in model.initial_conditions)
+
+def mutant_conditions(**values):
+    conditions = []
+    for mutant in mutants:
+        condition = dict(zero, **values)
+        condition['KRAS_%s_GTP_0' % mutant] = total_pi
+        conditions.append(condition)
+    return conditions
+
+yobs = run_sweep(sol, mutant_conditions())
+for mutant, y in zip(mutants, yobs):
+    plt.plot(t, y[:, pi] / total_pi, label=mutant)
     plt.ylabel('GTP hydrolyzed (%)')
     plt.ylim(top=1)
     plt.xlabel('Time (s)')
@@ -40,16 +49,9 @@ for mutant in KRAS.site_states['mutant']:
 plt.legend(loc='upper left', fontsize=11, frameon=False)
 
 plt.figure()
-for mutant in KRAS.site_states['mutant']:
-    # Zero out all initial conditions
-    for ic in model.initial_conditions:
-        ic[1].value = 0
-    model.parameters['RASA1_0'].value = 50000
-    model.parameters['KRAS_%s_GTP_0' % mutant].value = total_pi
-
-    sol = Solver(model, t)
-    sol.run()
-    plt.plot(t, sol.yobs['Pi_'] / total_pi, label=mutant)
+yobs = run_sweep(sol, mutant_conditions(RASA1_0=50000))
+for mutant, y in zip(mutants, yobs):
+    plt.plot(t, y[:, pi] / total_pi, label=mutant)
     plt.ylabel('GTP hydrolyzed (%)')
     plt.ylim(top=1)
     plt.xlabel('Time (s)')
@@ -2,64 +2,259 @@
     The model currently does not account for the following:
      - species ending in '_inh', '_i', 'half_active'
      - Events (referred to as rules in simbiology)
-    When instantiated with all modules, the model has 436 species, 713 reactions and 212 parameters 
+    When instantiated with all modules, the model has 436 species, 713 reactions and 212 parameters
+
+    The model is not built at import time. Use build_model() to obtain a model
+    for a given selection of component modules, e.g. the ErbB and MAPK
+    pathways without PI3K/AKT:
+
+        build_model(modules=['erbb', 'mapk'])
+
+    Models are memoized per configuration. For backward compatibility the
+    module attribute `model` (and every component of it, e.g. `k103`) is
+    still available and builds the full model on first access.
 """
-from pysb import Model
+import sys
+import types
+import contextlib
+from pysb import Model, Parameter, Expression
+from pysb.core import SelfExporter
 from .components import erbb, pi3k, mapk
 from ..utils import merge_parameters
 
-# Create the model.
-Model()
-
-# Declare monomers.
-erbb.receptor_monomers()
-erbb.ligand_monomers()
-erbb.adapter_monomers()
-pi3k.PI3K_monomers()
-mapk.MAPK_monomers()
-
-# Generate ErbB (upstream) pathway.
-erbb.transport()
-erbb.ErbB1_priming()
-erbb.ligand_binding()
-erbb.receptor_dimerization()
-erbb.lateral_signaling()
-erbb.secondary_dimerization()
-erbb.trans_phosphorylation()
-erbb.GAP_binding()
-erbb.Grb2_binding()
-erbb.SHC_binding()
-erbb.secondary_Grb2_binding()
-erbb.RAS_binds_sos()
-erbb.RTK_phos()
-erbb.bind_cPP()
-erbb.R_deg_v2()
-erbb.ErbB2_magic_rxns()
-
-# Generate PI3K/AKT pathway.
-pi3k.bind_Gab1()
-pi3k.Shp2_catalysis()
-pi3k.Erk_catalysis()
-pi3k.Pase_9t_catalysis()
-pi3k.bind_PI3K()
-pi3k.PIP2_PIP3()
-pi3k.PI3K_binds_RAS()
-pi3k.AKT_rxns()
-
-# Generate MAPK pathway.
-mapk.MAPK_pathway()
-
-# Define observables.
-erbb.declare_observables()
-pi3k.declare_observables()
-mapk.declare_observables()
-
-# Merge parameters that were redundantly specified in multiple component
-# modules.
-merge_parameters(model, 'k103', [k103_ls, k103_magic])
-merge_parameters(model, 'kd103', [kd103_ls, kd103_magic])
-merge_parameters(model, 'k122', [k122_gab, k122_ls, k122_priming])
-merge_parameters(model, 'kd122', [kd122_gab, kd122_ls, kd122_priming])
-merge_parameters(model, 'k16', [k16_scndry])
-merge_parameters(model, 'kd123', [kd123_gab, kd123_ls])
-merge_parameters(model, 'kd24', [kd24_scndry])
+# Component modules in the order they must be applied. The ErbB module
+# declares the receptors, adapters and RAS that the other modules act on, so
+# it is always required.
+MODULES = ('erbb', 'pi3k', 'mapk')
+
+_monomer_functions = [
+    (erbb, 'receptor_monomers'),
+    (erbb, 'ligand_monomers'),
+    (erbb, 'adapter_monomers'),
+    (pi3k, 'PI3K_monomers'),
+    (mapk, 'MAPK_monomers'),
+    ]
+
+_pathway_functions = {
+    # Generate ErbB (upstream) pathway.
+    'erbb': [
+        (erbb, 'transport'),
+        (erbb, 'ErbB1_priming'),
+        (erbb, 'ligand_binding'),
+        (erbb, 'receptor_dimerization'),
+        (erbb, 'lateral_signaling'),
+        (erbb, 'secondary_dimerization'),
+        (erbb, 'trans_phosphorylation'),
+        (erbb, 'GAP_binding'),
+        (erbb, 'Grb2_binding'),
+        (erbb, 'SHC_binding'),
+        (erbb, 'secondary_Grb2_binding'),
+        (erbb, 'RAS_binds_sos'),
+        (erbb, 'RTK_phos'),
+        (erbb, 'bind_cPP'),
+        (erbb, 'R_deg_v2'),
+        (erbb, 'ErbB2_magic_rxns'),
+        ],
+    # Generate PI3K/AKT pathway.
+    'pi3k': [
+        (pi3k, 'bind_Gab1'),
+        (pi3k, 'Shp2_catalysis'),
+        (pi3k, 'Erk_catalysis'),
+        (pi3k, 'Pase_9t_catalysis'),
+        (pi3k, 'bind_PI3K'),
+        (pi3k, 'PIP2_PIP3'),
+        (pi3k, 'PI3K_binds_RAS'),
+        (pi3k, 'AKT_rxns'),
+        ],
+    # Generate MAPK pathway.
+    'mapk': [
+        (mapk, 'MAPK_pathway'),
+        ],
+    }
+
+_observable_functions = {
+    'erbb': (erbb, 'declare_observables'),
+    'pi3k': (pi3k, 'declare_observables'),
+    'mapk': (mapk, 'declare_observables'),
+    }
+
+# Parameters that were redundantly specified in multiple component modules,
+# and the name to merge them under. Parameters from modules that were left out
+# of a build are simply skipped.
+_parameter_merges = [
+    ('k103', ['k103_ls', 'k103_magic']),
+    ('kd103', ['kd103_ls', 'kd103_magic']),
+    ('k122', ['k122_gab', 'k122_ls', 'k122_priming']),
+    ('kd122', ['kd122_gab', 'kd122_ls', 'kd122_priming']),
+    ('k16', ['k16_scndry']),
+    ('kd123', ['kd123_gab', 'kd123_ls']),
+    ('kd24', ['kd24_scndry']),
+    ]
+
+_models = {}
+_origins = {}
+_parameter_modules = {}
+
+
+@contextlib.contextmanager
+def _exporting_to(model, namespace):
+    """Direct pysb self-export into `model` and a private namespace."""
+    saved = (SelfExporter.default_model, SelfExporter.target_globals,
+             SelfExporter.target_module)
+    SelfExporter.default_model = model
+    SelfExporter.target_globals = namespace
+    SelfExporter.target_module = None
+    try:
+        yield
+    finally:
+        (SelfExporter.default_model, SelfExporter.target_globals,
+         SelfExporter.target_module) = saved
+
+
+def _normalize(names, what):
+    names = frozenset(names)
+    unknown = names - set(MODULES)
+    if unknown:
+        raise ValueError("Unknown %s: %s" % (what, ', '.join(sorted(unknown))))
+    return names
+
+
+def build_model(modules=MODULES, observables=None):
+    """Return the Chen 2009 model built from the given component modules.
+
+    Parameters
+    ----------
+    modules : sequence of str, optional
+        Names of the component modules whose rules to include, out of
+        'erbb', 'pi3k' and 'mapk'. Defaults to all of them. 'erbb' is always
+        required. Order is irrelevant; modules are applied in pathway order.
+    observables : sequence of str, optional
+        Names of the modules whose observables to declare. Defaults to
+        `modules`.
+
+    The model is built on first request and memoized, so repeated calls with
+    the same configuration return the same Model object.
+    """
+    modules = _normalize(modules, 'modules')
+    if 'erbb' not in modules:
+        raise ValueError("The 'erbb' module is required")
+    if observables is None:
+        observables = modules
+    observables = _normalize(observables, 'observables')
+    key = (modules, observables)
+    try:
+        return _models[key]
+    except KeyError:
+        pass
+
+    name = __name__
+    if modules != set(MODULES):
+        name += '[%s]' % ','.join(m for m in MODULES if m in modules)
+    model = Model(name, _export=False)
+    origins = {}
+    parameter_modules = {}
+    with _exporting_to(model, {}):
+        # Declare all monomers, even for unused modules, since the ErbB
+        # observables and several rules refer to them. Monomers without
+        # initial conditions don't contribute any species.
+        for module, function in _monomer_functions:
+            getattr(module, function)()
+        for m in MODULES:
+            if m in modules:
+                for module, function in _pathway_functions[m]:
+                    n = len(model.rules)
+                    n_parameters = len(model.parameters)
+                    getattr(module, function)()
+                    origin = '%s.%s' % (m, function)
+                    for rule in model.rules[n:]:
+                        origins[rule.name] = origin
+                    for parameter in model.parameters[n_parameters:]:
+                        parameter_modules[parameter.name] = set([m])
+        for m in MODULES:
+            if m in observables:
+                module, function = _observable_functions[m]
+                getattr(module, function)()
+    for new_name, old_names in _parameter_merges:
+        parameters = [model.parameters[n] for n in old_names
+                      if n in model.parameters.keys()]
+        if parameters:
+            merge_parameters(model, new_name, parameters)
+            merged = parameter_modules.setdefault(new_name, set())
+            for p in parameters:
+                merged |= parameter_modules.get(p.name, set())
+
+    _models[key] = model
+    _origins[key] = origins
+    _parameter_modules[key] = parameter_modules
+    return model
+
+
+def rule_origins(model):
+    """Return the component function that declared each rule of `model`.
+
+    The result maps rule names to strings like 'erbb.transport', and is
+    empty for models not built by build_model.
+    """
+    for key, m in _models.items():
+        if m is model:
+            return dict(_origins[key])
+    return {}
+
+
+def module_parameters(model, modules):
+    """Return the names of the parameters declared by component modules.
+
+    Parameters
+    ----------
+    model : pysb.Model
+        A model built by build_model; the result is empty for other models.
+    modules : sequence of str
+        Names of component modules, e.g. ['mapk'].
+
+    Parameters merged from several modules (see _parameter_merges) belong to
+    each of them. Parameters that no rule or initial condition uses, like
+    the originals of merged ones, are left out. Names are in
+    model.parameters order.
+    """
+    modules = _normalize(modules, 'modules')
+    for key, m in _models.items():
+        if m is model:
+            parameter_modules = _parameter_modules[key]
+            break
+    else:
+        return []
+    used = set()
+    for value in ([r.rate_forward for r in model.rules] +
+                  [r.rate_reverse for r in model.rules] +
+                  [value for cp, value in model.initial_conditions]):
+        if isinstance(value, Expression):
+            used.update(p.name for p in value.expand_expr().atoms(Parameter))
+        elif value is not None:
+            used.add(value.name)
+    return [p.name for p in model.parameters if p.name in used and
+            parameter_modules.get(p.name, set()) & modules]
+
+
+class _LazyModule(types.ModuleType):
+    """Module type that builds the default model on attribute access."""
+
+    def __getattr__(self, name):
+        # Only called for names not already in the module dict.
+        if name.startswith('__'):
+            raise AttributeError(name)
+        model = build_model()
+        if name == 'model':
+            return model
+        component = model.all_components().get(name)
+        if component is None:
+            raise AttributeError("'module' object has no attribute '%s'"
+                                 % name)
+        return component
+
+
+# Replace this module with a lazy one. Keep a reference to the original so
+# its globals (which our functions use) aren't cleared on garbage collection.
+_lazy_module = _LazyModule(__name__, __doc__)
+_lazy_module.__dict__.update(globals())
+_lazy_module._original_module = sys.modules[__name__]
+sys.modules[__name__] = _lazy_module
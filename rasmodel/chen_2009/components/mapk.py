@@ -36,6 +36,7 @@ def MAPK_pathway():
     
     # Initial amount
     # ==============
+    Parameter('RAF_0', 71131.2)     # c41
     Parameter('MEK_0', 3020000)     # c47
     Parameter('ERK_0', 695000)      # c55
     Parameter('Pase1_0', 5e+4)      # c44
@@ -84,6 +85,7 @@ def MAPK_pathway():
     
     # Initial conditions
     # ==================
+    Initial(RAF(akt=None, pase1=None, mek=None, ras=None, state='up'), RAF_0)
     Initial(MEK(raf=None, pase2=None, erk=None,state='up'), MEK_0)
     Initial(ERK(mek=None, pase3=None, sos=None, state='up', gab1=None), ERK_0)
     Initial(Pase1(raf=None), Pase1_0)
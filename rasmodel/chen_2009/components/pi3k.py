@@ -289,7 +289,6 @@ def AKT_rxns():
     Parameter('Pase4_0', 4.5e+5)   # c113
     Parameter('PTEN_0', 56100.9)   # c279
     Parameter('Shp_0', 2213.59)     # c461
-    Parameter('RAF_0', 71131.2)     # c41
     # Rate constants
     # ==============
     Parameter('k69',3.33e-5)   # k69
@@ -320,7 +319,6 @@ def AKT_rxns():
     Initial(Pase4(akt=None), Pase4_0)
     Initial(PTEN(pip=None), PTEN_0)
     Initial(Shp(pip=None), Shp_0)
-    Initial(RAF(akt=None, pase1=None, mek=None, ras=None, state='up'), RAF_0)
     
     # Rules
     # =====
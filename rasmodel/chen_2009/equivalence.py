@@ -0,0 +1,278 @@
+"""Numerical equivalence check of the PySB and the reference Chen 2009 ODEs.
+
+Simulating both models for hours and comparing plots only shows that they
+differ, not where. Here both right hand sides are evaluated at thousands of
+random positive states at once: the PySB side from the generated network
+(see rasmodel.simulation.system, which computes model.odes from the same
+reactions), the reference side from the compiled SimBiology equations (see
+simbiology). Species are matched through sbml_mapping. A species whose
+derivative disagrees at any state is reported together with the reactions
+responsible: at the worst state, the per-reaction contributions to its
+derivative are paired up between the two models, and the unpaired ones are
+listed::
+
+    from rasmodel.chen_2009 import model, equivalence
+    comparison = equivalence.compare_rhs(model)
+    print comparison
+
+Derivatives are compared relative to the sum of the absolute contributions
+to them, so cancellation between large fluxes does not hide or fake
+differences. Species that are constant in the reference (the ligands) are
+clamped on the PySB side.
+"""
+
+import time
+import numpy as np
+import scipy.sparse
+from rasmodel.network.cache import generate_equations
+from rasmodel.simulation.system import MassActionSystem
+from . import simbiology
+from .sbml_mapping import species_mapping
+
+
+class Disagreement(object):
+    """A species whose derivative differs between the two models.
+
+    Attributes
+    ----------
+    species : str
+        SBML species name.
+    pysb_index : int
+        Index of the species in the PySB model.
+    error : float
+        Largest difference of the derivatives, relative to the tolerance.
+    state : int
+        The random state where it occurs.
+    expected, actual : float
+        Reference and PySB derivative at that state.
+    reference_terms, pysb_terms : list of (str, float)
+        Contributions to the derivative at that state left unpaired, from
+        the reference rate-law terms and from the PySB reactions.
+    """
+
+    def __init__(self, species, pysb_index, error, state, expected, actual,
+                 reference_terms, pysb_terms):
+        self.species = species
+        self.pysb_index = pysb_index
+        self.error = error
+        self.state = state
+        self.expected = expected
+        self.actual = actual
+        self.reference_terms = reference_terms
+        self.pysb_terms = pysb_terms
+
+    def __str__(self):
+        lines = ['%s (s%d): reference %.6g, pysb %.6g at state %d '
+                 '(%.3g x tolerance)' % (self.species, self.pysb_index,
+                                         self.expected, self.actual,
+                                         self.state, self.error)]
+        for label, value in self.reference_terms:
+            lines.append('  reference only  %12.6g  %s' % (value, label))
+        for label, value in self.pysb_terms:
+            lines.append('  pysb only       %12.6g  %s' % (value, label))
+        return '\n'.join(lines)
+
+
+class RhsComparison(object):
+    """Result of compare_rhs().
+
+    Attributes
+    ----------
+    n_states, n_species : int
+        Number of random states and of matched species compared.
+    disagreements : list of Disagreement
+        Species whose derivatives differ, worst first.
+    unmatched_reference : list of str
+        Reference species without a PySB counterpart (held at zero).
+    unmatched_pysb : list of int
+        PySB species without a reference counterpart (held at their
+        initial values).
+    seconds : float
+        Time spent evaluating and comparing, excluding setup.
+    """
+
+    def __init__(self, n_states, n_species, disagreements,
+                 unmatched_reference, unmatched_pysb, seconds):
+        self.n_states = n_states
+        self.n_species = n_species
+        self.disagreements = disagreements
+        self.unmatched_reference = unmatched_reference
+        self.unmatched_pysb = unmatched_pysb
+        self.seconds = seconds
+
+    @property
+    def equivalent(self):
+        return not self.disagreements
+
+    def __str__(self):
+        lines = ['%d species compared at %d states in %.3gs'
+                 % (self.n_species, self.n_states, self.seconds),
+                 'unmatched reference species: %s'
+                 % (', '.join(self.unmatched_reference) or '-'),
+                 'unmatched pysb species: %s'
+                 % (', '.join('s%d' % i for i in self.unmatched_pysb) or '-'),
+                 '%d species disagree' % len(self.disagreements)]
+        lines.extend(str(d) for d in self.disagreements)
+        return '\n'.join(lines)
+
+
+def _batch_fluxes(system, y, k, values):
+    """Fluxes of `system` at many full species vectors `y` (states by
+    species)."""
+    padded = np.concatenate((y, np.ones((len(y), 1))), axis=1)
+    flux = k * padded[:, system.reactants].prod(axis=2)
+    if system.has_dynamic_rates:
+        g = system.expression_values(system.observables.dot(y.T).T, values)
+        for j, e in zip(system._dynamic_reactions, system._dynamic_index):
+            flux[:, j] *= g[:, e]
+    return flux
+
+
+def _row(matrix, r):
+    """Column indexes and values of row `r` of a CSR matrix."""
+    start, end = matrix.indptr[r], matrix.indptr[r + 1]
+    return zip(matrix.indices[start:end], matrix.data[start:end])
+
+
+def _unpaired(reference, pysb, tolerance):
+    """Pair up equal contributions and return the ones left over.
+
+    `reference` and `pysb` are lists of (label, value); values are paired
+    greedily, each with the closest unused value within `tolerance`.
+    Leftovers smaller than `tolerance` (e.g. terms with a zero rate
+    constant) are dropped.
+    """
+    reference = sorted(reference, key=lambda (label, value): value)
+    used = [False] * len(reference)
+    left = []
+    for label, value in pysb:
+        best = None
+        for n, (other, v) in enumerate(reference):
+            if not used[n] and abs(v - value) <= tolerance and \
+                    (best is None or
+                     abs(v - value) < abs(reference[best][1] - value)):
+                best = n
+        if best is None:
+            left.append((label, value))
+        else:
+            used[best] = True
+    return ([(label, v) for (label, v), u in zip(reference, used)
+             if not u and abs(v) > tolerance],
+            [(label, v) for label, v in left if abs(v) > tolerance])
+
+
+def compare_rhs(model, n_states=2000, rtol=1e-6, atol=1e-9, low=1e-3,
+                high=1e3, seed=0):
+    """Compare the PySB and the reference derivatives at random states.
+
+    Parameters
+    ----------
+    model : pysb.Model
+        The PySB Chen 2009 model; its network is generated if needed. Its
+        own parameter values are used, and the reference uses the values of
+        the original SBML model.
+    n_states : int, optional
+        Number of random states.
+    rtol, atol : float, optional
+        A derivative disagrees if the difference exceeds atol plus rtol
+        times the sum of the absolute contributions to it.
+    low, high : float, optional
+        Species values are drawn log-uniformly from this range.
+    seed : int, optional
+        Seed of the random states.
+
+    Returns
+    -------
+    RhsComparison
+    """
+    generate_equations(model)
+    equations = simbiology.load_equations()
+    sbml2pysb, pysb2sbml = species_mapping(model)
+    n_reference = len(equations.species)
+    stoichiometry = equations.stoichiometry.tocsr()
+    counts = np.diff(stoichiometry.indptr)
+    boundary = [sbml2pysb[name] for i, name in enumerate(equations.species)
+                if name in sbml2pysb and counts[i] == 0]
+    system = MassActionSystem(model, clamped=boundary)
+    k = system.rate_constants()
+    values = system.values()
+    p = equations.parameter_vector()
+    reference_index = np.array([equations.species_index[name]
+                                for name in sorted(sbml2pysb)], dtype=int)
+    pysb_index = np.array([sbml2pysb[name] for name in sorted(sbml2pysb)],
+                          dtype=int)
+
+    start = time.time()
+    rng = np.random.RandomState(seed)
+    samples = np.exp(rng.uniform(np.log(low), np.log(high),
+                                 (n_states, len(pysb_index))))
+    y = np.empty((n_states, system.n_species))
+    y[:] = system.initial_values()
+    y[:, pysb_index] = samples
+    x = np.zeros((n_states, n_reference))
+    x[:, reference_index] = samples
+
+    # PySB derivatives and scales, by species (zero for clamped species).
+    flux = _batch_fluxes(system, y, k, values)
+    actual = np.zeros((n_states, system.n_species))
+    actual[:, system.free] = system.stoichiometry.dot(flux.T).T
+    actual_scale = np.zeros((n_states, system.n_species))
+    actual_scale[:, system.free] = abs(system.stoichiometry).dot(
+        np.abs(flux).T).T
+    # Reference derivatives and scales.
+    terms = equations.terms(x, p)
+    term_stoichiometry = scipy.sparse.csr_matrix(
+        stoichiometry.dot(equations._term_map))
+    expected = term_stoichiometry.dot(terms.T).T
+    expected_scale = abs(term_stoichiometry).dot(np.abs(terms).T).T
+
+    scale = np.maximum(actual_scale[:, pysb_index],
+                       expected_scale[:, reference_index])
+    error = (np.abs(actual[:, pysb_index] - expected[:, reference_index]) /
+             (atol + rtol * scale))
+    worst = error.argmax(axis=0)
+    worst_error = error[worst, np.arange(len(pysb_index))]
+
+    pysb_stoichiometry = system.stoichiometry.tocsr()
+    row = dict((i, r) for r, i in enumerate(system.free))
+    disagreements = []
+    for c in np.nonzero(worst_error > 1)[0]:
+        s = worst[c]
+        i = pysb_index[c]
+        r = reference_index[c]
+        reference_terms = [
+            (equations.describe_term(t), coefficient * terms[s, t])
+            for t, coefficient in _row(term_stoichiometry, r)]
+        pysb_terms = []
+        if i in row:
+            pysb_terms = [
+                (_describe_reaction(model, system.reactions[j], pysb2sbml),
+                 coefficient * flux[s, j])
+                for j, coefficient in _row(pysb_stoichiometry, row[i])]
+        tolerance = atol + rtol * scale[s, c]
+        reference_terms, pysb_terms = _unpaired(reference_terms, pysb_terms,
+                                                tolerance)
+        disagreements.append(Disagreement(
+            equations.species[r], i, worst_error[c], s, expected[s, r],
+            actual[s, i], reference_terms, pysb_terms))
+    disagreements.sort(key=lambda d: -d.error)
+    seconds = time.time() - start
+
+    unmatched_reference = [name for name in equations.species
+                           if name not in sbml2pysb]
+    unmatched_pysb = [i for i in range(system.n_species)
+                      if i not in pysb2sbml]
+    return RhsComparison(n_states, len(pysb_index), disagreements,
+                         unmatched_reference, unmatched_pysb, seconds)
+
+
+def _describe_reaction(model, j, pysb2sbml):
+    """Return reaction `j` of `model` as text, naming species as in SBML."""
+    reaction = model.reactions[j]
+
+    def side(indexes):
+        return ' + '.join(pysb2sbml.get(i, 's%d' % i) for i in indexes)
+
+    return 'r%d %s: %s -> %s' % (j, ','.join(reaction['rule']),
+                                 side(reaction['reactants']),
+                                 side(reaction['products']))
@@ -0,0 +1,277 @@
+"""Correspondence between the PySB and the original SBML Chen 2009 species.
+
+SBML species labels name the proteins of a complex in the SimBiology
+convention, e.g. 'endo|2(EGF:ErbB1)#P:GAP:(Shc#P)'. label_composition()
+parses them into the composition signatures of rasmodel.network.matching
+(the monomers with their states and compartment), and the PySB species are
+matched to the SBML species with the same composition. Reactions are then
+matched on their mapped reactants and products::
+
+    from rasmodel.chen_2009 import model, sbml_mapping
+    sbml2pysb, pysb2sbml = sbml_mapping.species_mapping(model)
+    result = sbml_mapping.model_matching(model)
+
+Both are cached with the network cache. bin/chen_2009_compare_sbml.py
+reports the species and reactions that do not match.
+"""
+
+import re
+import hashlib
+from rasmodel.network import matching
+from rasmodel.network.cache import generate_equations
+
+
+# Degradation sinks of the SBML model.
+sink_names = ('c13', 'c520', 'c86')
+
+# PySB monomer names of the proteins whose SBML name differs.
+monomer_names = {
+    'Shc': 'SHC',
+    'Sos': 'SOS',
+    'Pase9t': 'Pase_9t',
+    'RTK_Pase': 'RTK',
+    'Raf': 'RAF',
+    'Ras': 'RAS',
+    'Ras_activated': 'RAS',
+    }
+
+_label_token_re = re.compile(r'\d+|[()]|#P|-FullActive|:|[A-Za-z]\w*')
+
+# State of the preceding protein after a ':'-separated state word.
+_state_words = {
+    'P': {'up': 'p', 'p': 'pp'},
+    'Ser': {'p': 'p_ser'},
+    'GDP': {None: 'gdp'},
+    'GTP': {None: 'gtp'},
+    }
+
+# State of a protein after a '#P' or '-FullActive' suffix.
+_suffixes = {
+    '#P': {'up': 'p', 'p': 'pp'},
+    '-FullActive': {'up': 'full_act', 'p': 'full_act'},
+    }
+
+
+class _LabelParser(object):
+    """Recursive descent parser of SBML species labels.
+
+    Proteins are [monomer name, site states, SBML name] lists. A number
+    before a parenthesized group or after it repeats the group, and a
+    suffix after a protein or a group applies to every protein in it that
+    has the resulting state.
+    """
+
+    def __init__(self, label, compartment, site_states):
+        self.tokens = _label_token_re.findall(label)
+        self.position = 0
+        self.compartment = compartment
+        self.site_states = site_states
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def take(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def complex(self):
+        proteins = []
+        while True:
+            if self.peek() in _state_words:
+                self._apply(proteins[-1:], _state_words[self.take()])
+            else:
+                proteins.extend(self.item())
+            if self.peek() != ':':
+                return proteins
+            self.take()
+
+    def item(self):
+        count = int(self.take()) if (self.peek() or '').isdigit() else 1
+        token = self.take()
+        if token is None or token in (')', ':'):
+            raise ValueError('missing protein')
+        if token == '(':
+            proteins = self.complex()
+            if self.take() != ')':
+                raise ValueError('unbalanced parentheses')
+        else:
+            proteins = [self.protein(token)]
+        while self.peek() in _suffixes or (self.peek() or '').isdigit():
+            token = self.take()
+            if token.isdigit():
+                count *= int(token)
+            else:
+                self._apply(proteins, _suffixes[token])
+        return [[name, dict(states), word] for i in range(count)
+                for name, states, word in proteins]
+
+    def protein(self, word):
+        name = monomer_names.get(word, word)
+        site_states = self.site_states[name]
+        states = {}
+        if 'comp' in site_states:
+            states['comp'] = self.compartment
+        if 'up' in site_states.get('state', ()):
+            states['state'] = 'up'
+        return [name, states, word]
+
+    def _apply(self, proteins, transitions):
+        for name, states, word in proteins:
+            new = transitions.get(states.get('state'))
+            if new == 'gtp' and word == 'Ras_activated':
+                new = 'active_gtp'
+            if new in self.site_states[name].get('state', ()):
+                states['state'] = new
+
+
+def label_composition(label, site_states):
+    """Return the composition signature of an SBML species label.
+
+    `site_states` maps PySB monomer names to their site_states. Proteins
+    without a state word or suffix are unphosphorylated ('up'), and an
+    'endo|' prefix puts the proteins with a compartment site in 'endo'
+    rather than 'pm'. Raises ValueError or KeyError for labels outside this
+    vocabulary.
+    """
+    compartment = 'pm'
+    if label.startswith('endo|'):
+        compartment = 'endo'
+        label = label[len('endo|'):]
+    parser = _LabelParser(label, compartment, site_states)
+    proteins = parser.complex()
+    if parser.peek() is not None:
+        raise ValueError('unexpected %r in label %s' % (parser.peek(), label))
+    return matching.composition([p[0] for p in proteins],
+                                [p[1] for p in proteins])
+
+
+def sbml_species(sbml_model):
+    """Return SBML species labels and species, sorted by label.
+
+    Inhibitor species, degradation sinks and other species outside the
+    scope of the PySB model are left out.
+    """
+    # We will ignore species whose labels contain these strings.
+    ignore_patterns = ('_i', '_h', 'Inh')
+    # We will ignore these individually named species.
+    ignore_names = sink_names + (
+        # MEK#P#P:ERK "_i" species that are missing _i in label.
+        'c80', 'c82', 'c96', 'c98',
+        )
+    species = [s for s in sbml_model.species
+               if not any(i in s.label for i in ignore_patterns)
+               and s.name not in ignore_names]
+    labels = [s.label for s in species]
+    ics = [' @ %.17g' % s.initial_amount if s.initial_amount != 0 else ''
+           for s in species]
+    names = [label + ic for label, ic in zip(labels, ics)]
+
+    # Sort names and species by names.
+    names, species = zip(*sorted(zip(names, species)))
+
+    return names, species
+
+
+def scoped_reactions(sbml_model):
+    """Return the SBML reactions within the scope of the PySB model.
+
+    These are the reactions among the species sbml_species() keeps and the
+    degradation sinks, i.e. the ones the PySB model reproduces.
+    """
+    labels, species = sbml_species(sbml_model)
+    wanted = set(s.name for s in species) | set(sink_names)
+    return [r for r in sbml_model.reactions
+            if all(s.name in wanted for s in r.reactants + r.products)]
+
+
+def _sbml_key(sbml_model):
+    h = hashlib.sha1()
+    for s in sbml_model.species:
+        h.update('%s %s\n' % (s.name, s.label))
+    for r in sbml_model.reactions:
+        h.update('%s %s %s\n' % (r.name, ' '.join(map(str, r.reactants)),
+                                 ' '.join(map(str, r.products))))
+    return h.hexdigest()
+
+
+def model_matching(model, sbml_model=None, cache_dir=None):
+    """Match the PySB and SBML species and reactions by structure.
+
+    Parameters
+    ----------
+    model : pysb.Model
+        The PySB model; its network is generated if needed.
+    sbml_model : original_sbml.Model, optional
+        Defaults to original_sbml.load_model().
+
+    Returns
+    -------
+    rasmodel.network.matching.ModelMatching
+        The SBML side is on the left: species as listed by sbml_species()
+        and reactions by scoped_reactions(). The PySB side has
+        model.species and model.reactions_bidirectional. The SBML sinks
+        stand for the PySB __sink() species.
+    """
+    if sbml_model is None:
+        from .original_sbml import load_model
+        sbml_model = load_model()
+    generate_equations(model)
+
+    def compute():
+        labels, species = sbml_species(sbml_model)
+        site_states = dict((m.name, m.site_states) for m in model.monomers)
+        signatures = []
+        for s in species:
+            try:
+                signatures.append(label_composition(s.label, site_states))
+            except (KeyError, ValueError):
+                signatures.append(None)
+        species_matching = matching.join(
+            signatures, matching.species_signatures(model, 'composition'))
+        mapped = dict((species[i].name, j) for i, j in
+                      species_matching.left_to_right.items())
+        sink = next(i for i, s in enumerate(model.species)
+                    if str(s) == '__sink()')
+        mapped.update((name, sink) for name in sink_names)
+        reactions = matching.match_reactions(
+            [([s.name for s in r.reactants], [s.name for s in r.products])
+             for r in scoped_reactions(sbml_model)],
+            [(r['reactants'], r['products'])
+             for r in model.reactions_bidirectional],
+            mapped)
+        return {'species': species_matching, 'reactions': reactions}
+
+    key = hashlib.sha1('chen_2009 %s %s' % (matching.network_key(model),
+                                            _sbml_key(sbml_model)))
+    result = matching.cached(key.hexdigest(), compute, cache_dir)
+    return matching.ModelMatching(result['species'], result['reactions'])
+
+
+def species_mapping(model, sbml_model=None, cache_dir=None):
+    """Match PySB and SBML species by structure (see model_matching()).
+
+    Parameters
+    ----------
+    model : pysb.Model
+        The PySB model; its network is generated if needed.
+    sbml_model : original_sbml.Model, optional
+        Defaults to original_sbml.load_model().
+
+    Returns
+    -------
+    sbml2pysb, pysb2sbml : dict
+        SBML species name to PySB species index and the reverse, for the
+        matched species.
+    """
+    if sbml_model is None:
+        from .original_sbml import load_model
+        sbml_model = load_model()
+    result = model_matching(model, sbml_model, cache_dir)
+    labels, species = sbml_species(sbml_model)
+    sbml2pysb = dict((species[i].name, j)
+                     for i, j in result.species.left_to_right.items())
+    pysb2sbml = dict((i, name) for name, i in sbml2pysb.items())
+    return sbml2pysb, pysb2sbml
@@ -0,0 +1,269 @@
+"""Direct simulation of the original SBML model.
+
+original_sbml.pysb_model() converts every SBML species to a Monomer and
+every reaction to a Rule, so simulating it means generating a network that
+the SBML already spells out. SBMLSystem instead builds the arrays of
+rasmodel.simulation.system.MassActionSystem straight from the parsed
+Reaction tuples: each reaction contributes a forward flux
+kf_scale * kf * reactants and a reverse flux kr_scale * kr * products, in
+species amounts. Everything MassActionSystem computes from
+those arrays (fluxes, right hand side, sparse analytic Jacobian) is
+inherited, and SBMLSimulator integrates it with Simulator's stiff solvers::
+
+    from rasmodel.chen_2009 import original_sbml
+    sim = original_sbml.simulator(np.linspace(0, 9000, 9001),
+                                  atol=1e-6, rtol=1e-8)
+    sim.run()
+    sim.yexpr['pErbB1']
+
+Any Model of rasmodel.network.sbml works the same way, with observables
+given as the species names they sum::
+
+    from rasmodel.network import sbml
+    other = sbml.load('BIOMD0000000255.xml')
+    sim = SBMLSimulator(tspan, other, observables={'ERKPP': ['x12', 'x21']})
+
+The SBML kinetic laws are plain mass action, so the flux of a reaction
+between two molecules of the same species is kf * A**2 and consumes two A.
+The PySB conversion needs the '_symmetric' expressions (2 * kf) to cancel
+the 1/2 that network generation applies to such reactions; here the rate
+constant is used as is.
+
+Parameters are the reactions' rate constants plus '<species>_0' for each
+nonzero initial amount, named as in pysb_model(), so the same param_values
+dicts work for both. Species declared constant in the SBML are clamped.
+SBMLSystem warns if the loader left reactions out (sbml.Model.unrecognized),
+since the simulation would silently miss their fluxes.
+
+The SBML also has reactions of inhibitor species that the PySB model leaves
+out; with zero inhibitor they still drain the complexes they dissociate
+into. original_sbml.simulator(tspan, scoped=True) drops them, which
+reproduces data/matlab_sim.mat.
+"""
+
+import collections
+import warnings
+import numpy as np
+import scipy.sparse
+import sympy
+from rasmodel.simulation.system import MassActionSystem
+from rasmodel.simulation.solver import Simulator
+from . import original_sbml
+
+DynamicExpression = collections.namedtuple('DynamicExpression', 'name expr')
+
+
+def observable_species():
+    """Return the species names summed by each Chen 2009 observable, by
+    name."""
+    return collections.OrderedDict([
+        ('pErbB11', original_sbml.sbml_perb11_names),
+        ('pErbB1n', original_sbml.sbml_perb12_names +
+         original_sbml.sbml_perb13_names + original_sbml.sbml_perb14_names),
+        ('pERK', original_sbml.sbml_perk_names),
+        ('pAKT', original_sbml.sbml_pakt_names),
+        ])
+
+
+def dynamic_expressions():
+    """Return the Chen 2009 expressions of the observables."""
+    pErbB11, pErbB1n = sympy.symbols('pErbB11 pErbB1n')
+    return [DynamicExpression('pErbB1', 2 * pErbB11 + pErbB1n)]
+
+
+class SBMLSystem(MassActionSystem):
+    """Array form of the reactions of an SBML model.
+
+    Parameters
+    ----------
+    sbml_model : rasmodel.network.sbml.Model, optional
+        Defaults to original_sbml.load_model().
+    clamped : list, optional
+        Species to hold constant, as species names or indexes. Defaults to
+        the species declared constant.
+    observables : dict, optional
+        Species names summed by each observable, by observable name.
+    expressions : list of DynamicExpression, optional
+        Expressions of the observables.
+        Both default to those of the Chen 2009 model if `sbml_model` is
+        omitted, and to none otherwise.
+
+    Attributes
+    ----------
+    species : list of rasmodel.network.sbml.Species
+    reactions : numpy.ndarray of int
+        Reaction of each flux; fluxes come in forward, reverse pairs.
+    parameters : list of str
+        Names of the parameters, in parameter_vector() order.
+
+    See MassActionSystem for the other attributes.
+    """
+
+    def __init__(self, sbml_model=None, clamped=None, observables=None,
+                 expressions=None):
+        if sbml_model is None:
+            sbml_model = original_sbml.load_model()
+            if observables is None:
+                observables = observable_species()
+            if expressions is None:
+                expressions = dynamic_expressions()
+        if sbml_model.unrecognized:
+            warnings.warn('leaving out %d unrecognized SBML reactions: %s'
+                          % (len(sbml_model.unrecognized),
+                             ', '.join('%s (%s)' % u for u in
+                                       sbml_model.unrecognized[:5])))
+        self.model = sbml_model
+        self.species = list(sbml_model.species)
+        self.n_species = n = len(self.species)
+        index = dict((s.name, i) for i, s in enumerate(self.species))
+        if clamped is None:
+            clamped = [i for i, s in enumerate(self.species) if s.constant]
+        self.clamped = np.unique(np.array([index.get(c, c) for c in clamped],
+                                          dtype=int))
+        self.pruned = self.ignored = np.array([], dtype=int)
+        self.free = np.setdiff1d(np.arange(n), self.clamped)
+        self.n_state = len(self.free)
+        self._columns = np.empty(n + 1, dtype=int)
+        self._columns.fill(-1)
+        self._columns[self.free] = np.arange(self.n_state)
+
+        self._initial = [(index[s.name], s.name + '_0', s.initial_amount)
+                         for s in self.species if s.initial_amount != 0]
+        rate_parameters = collections.OrderedDict()
+        for r in sbml_model.reactions:
+            for p in r.kf, r.kr:
+                rate_parameters.setdefault(p.name, p.value)
+        self.parameters = ([name for i, name, value in self._initial] +
+                           list(rate_parameters))
+        self.parameter_names = self.parameters
+        self._defaults = np.array([value for i, name, value in
+                                   self._initial] +
+                                  list(rate_parameters.values()))
+        position = dict((name, i) for i, name in enumerate(self.parameters))
+
+        m = 2 * len(sbml_model.reactions)
+        self.n_reactions = m
+        self.reactions = np.repeat(np.arange(len(sbml_model.reactions)), 2)
+        order = max(len(side) for r in sbml_model.reactions
+                    for side in (r.reactants, r.products))
+        self.reactants = np.empty((m, order), dtype=int)
+        self.reactants.fill(n)
+        self._rate_parameters = np.empty(m, dtype=int)
+        self.rate_numbers = np.empty(m)
+        rows = []
+        cols = []
+        data = []
+        for j, r in enumerate(sbml_model.reactions):
+            for flux, (left, right, k, scale) in enumerate([
+                    (r.reactants, r.products, r.kf, r.kf_scale),
+                    (r.products, r.reactants, r.kr, r.kr_scale)]):
+                f = 2 * j + flux
+                left = [index[s.name] for s in left]
+                self.reactants[f, :len(left)] = left
+                self._rate_parameters[f] = position[k.name]
+                self.rate_numbers[f] = scale
+                net = {}
+                for i in left:
+                    net[i] = net.get(i, 0) - 1
+                for s in right:
+                    net[index[s.name]] = net.get(index[s.name], 0) + 1
+                for i, c in net.items():
+                    if c:
+                        rows.append(i)
+                        cols.append(f)
+                        data.append(c)
+        self.stoichiometry = scipy.sparse.csr_matrix(
+            (data, (rows, cols)), shape=(n, m), dtype=float)[self.free]
+        self._dynamic_reactions = np.array([], dtype=int)
+        self._dynamic_index = np.array([], dtype=int)
+
+        observables = observables or {}
+        self.observable_names = list(observables)
+        rows = []
+        cols = []
+        for o, names in enumerate(observables.values()):
+            rows.extend([o] * len(names))
+            cols.extend(index[name] for name in names)
+        self.observables = scipy.sparse.csr_matrix(
+            (np.ones(len(rows)), (rows, cols)),
+            shape=(len(observables), n), dtype=float)
+        self.dynamic_expressions = list(expressions or [])
+
+        self._y = np.zeros(n + 1)
+        self._y[n] = 1.0
+        self._build_jacobian_pattern()
+
+    def parameter_vector(self, param_values=None):
+        """Return parameter values as a vector in `parameters` order.
+
+        `param_values` may be None (use the SBML values), a vector, or a
+        dict of values by parameter name overriding the SBML values.
+        """
+        if param_values is not None and not isinstance(param_values, dict):
+            if len(param_values) != len(self.parameters):
+                raise ValueError("param_values must be the same length as "
+                                 "parameters")
+            return np.array(param_values, dtype=float)
+        values = self._defaults.copy()
+        for name, value in (param_values or {}).items():
+            try:
+                values[self.parameters.index(name)] = value
+            except ValueError:
+                raise IndexError("param_values dictionary has unknown "
+                                 "parameter name (%s)" % name)
+        return values
+
+    def rate_constants(self, param_values=None):
+        """Return the vector of rate constants, one per flux."""
+        return (self.rate_numbers *
+                self.parameter_vector(param_values)[self._rate_parameters])
+
+    def initial_values(self, param_values=None):
+        """Return the species vector of initial amounts."""
+        p = self.parameter_vector(param_values)
+        y0 = np.zeros(self.n_species)
+        for n, (i, name, value) in enumerate(self._initial):
+            y0[i] = p[n]
+        return y0
+
+
+class SBMLSimulator(Simulator):
+    """Integrate an SBML model through SBMLSystem.
+
+    Takes the arguments of Simulator except the model and the network
+    reduction options, and produces the same y, yobs and yexpr results. For
+    the original SBML model the observables are those of pysb_model():
+    pErbB11, pErbB1n, pERK and pAKT, and the expression pErbB1.
+
+    Parameters
+    ----------
+    tspan : vector-like
+        Time values at which to report results.
+    sbml_model : rasmodel.network.sbml.Model, optional
+        Defaults to original_sbml.load_model().
+    clamped : list, optional
+        Species names or indexes to hold constant. Defaults to the species
+        declared constant.
+    observables, expressions : optional
+        See SBMLSystem.
+    """
+
+    def __init__(self, tspan, sbml_model=None, clamped=None,
+                 observables=None, expressions=None,
+                 use_analytic_jacobian=True, integrator='bdf', verbose=False,
+                 **integrator_options):
+        self.system = SBMLSystem(sbml_model, clamped, observables,
+                                 expressions)
+        self.model = self.system.model
+        self.tspan = np.asarray(tspan, dtype=float)
+        self.verbose = verbose
+        self.clamped = self.system.clamped
+        self.reduced = False
+        self.qssa = None
+        self.lumping = None
+        self.prune = False
+        self.ignored = ()
+        self.stats = {}
+        self._systems = {}
+        self._setup_integrator(integrator, use_analytic_jacobian,
+                               integrator_options)
@@ -0,0 +1,254 @@
+"""Compiled numeric form of the SimBiology reference equations.
+
+simbiology_expressions holds the equations of the original model as written
+by SimBiology's getequations(): importing it builds over a thousand sympy
+Symbols and ~700 ReactionFlux expressions. Here its source is parsed once,
+without sympy, into arrays: the species and parameter indexes, a sparse
+stoichiometry matrix (species x fluxes) and a table of rate-law terms (flux,
+coefficient, parameter, reactant species). The result is cached on disk
+with the network cache (see rasmodel.network.cache), keyed by a hash of the
+source, so later loads are a single unpickle. The right hand side is then a
+few NumPy operations, evaluated for many states at once::
+
+    from rasmodel.chen_2009 import simbiology
+    equations = simbiology.load_equations()
+    y = equations.initial_values()
+    dydt = equations.rhs(y, equations.parameter_vector())
+
+The sympy expressions themselves are only built by sympy_odes().
+"""
+
+import re
+import hashlib
+import numpy as np
+import scipy.sparse
+import pkg_resources
+from rasmodel.network import cache
+
+# Bump this whenever the compiled layout changes.
+COMPILED_VERSION = 1
+
+_ode_re = re.compile(r"^odes_by_name\['(\w+)'\]\s*=\s*(.+)$")
+_flux_re = re.compile(r"^ReactionFlux(\d+)\s*=\s*(.+)$")
+_term_re = re.compile(r"\s*([+-]?)\s*([^+-]+)")
+
+_equations = None
+
+
+def _source():
+    return pkg_resources.resource_string(__name__.rpartition('.')[0],
+                                         'simbiology_expressions.py')
+
+
+def _terms(expr):
+    """Split a sum of products into (coefficient, names) terms."""
+    terms = []
+    for sign, product in _term_re.findall(expr.strip()):
+        coefficient = -1.0 if sign == '-' else 1.0
+        names = []
+        for factor in product.split('*'):
+            factor = factor.strip()
+            try:
+                coefficient *= float(factor)
+            except ValueError:
+                names.append(factor)
+        terms.append((coefficient, names))
+    return terms
+
+
+def compile_equations(source):
+    """Parse the source of simbiology_expressions into a record of arrays.
+    """
+    odes = []
+    fluxes = {}
+    for line in source.splitlines():
+        match = _ode_re.match(line)
+        if match:
+            odes.append(match.groups())
+            continue
+        match = _flux_re.match(line)
+        if match:
+            fluxes[int(match.group(1))] = match.group(2)
+    species = sorted((name for name, expr in odes),
+                     key=lambda name: int(name[1:]))
+    species_index = dict((name, i) for i, name in enumerate(species))
+    flux_numbers = sorted(fluxes)
+    flux_index = dict((f, j) for j, f in enumerate(flux_numbers))
+
+    parameters = []
+    parameter_index = {}
+    term_flux = []
+    term_coefficients = []
+    term_parameters = []
+    term_species = []
+    for j, f in enumerate(flux_numbers):
+        for coefficient, names in _terms(fluxes[f]):
+            reactants = [species_index[n] for n in names
+                         if n in species_index]
+            constants = [n for n in names if n not in species_index]
+            if len(constants) != 1:
+                raise ValueError("ReactionFlux%d: expected one rate constant "
+                                 "per term" % f)
+            p = parameter_index.setdefault(constants[0], len(parameters))
+            if p == len(parameters):
+                parameters.append(constants[0])
+            term_flux.append(j)
+            term_coefficients.append(coefficient)
+            term_parameters.append(p)
+            term_species.append(reactants)
+
+    order = max(len(r) for r in term_species)
+    reactants = np.empty((len(term_species), order), dtype=int)
+    reactants.fill(len(species))
+    for t, r in enumerate(term_species):
+        reactants[t, :len(r)] = r
+
+    rows = []
+    cols = []
+    data = []
+    for name, expr in odes:
+        if expr.strip() == '0':
+            continue
+        for coefficient, names in _terms(expr):
+            (flux,) = names
+            rows.append(species_index[name])
+            cols.append(flux_index[int(flux[len('ReactionFlux'):])])
+            data.append(coefficient)
+    stoichiometry = scipy.sparse.csr_matrix(
+        (data, (rows, cols)), shape=(len(species), len(flux_numbers)))
+
+    return {
+        'version': cache.CACHE_VERSION,
+        'species': species,
+        'parameters': parameters,
+        'flux_names': ['ReactionFlux%d' % f for f in flux_numbers],
+        'stoichiometry': stoichiometry,
+        'term_flux': np.array(term_flux, dtype=int),
+        'term_coefficients': np.array(term_coefficients),
+        'term_parameters': np.array(term_parameters, dtype=int),
+        'term_species': reactants,
+        }
+
+
+class SimBiologyEquations(object):
+    """The reference equations in array form.
+
+    Attributes
+    ----------
+    species, parameters, flux_names : list of str
+        Names, in the order of the species, parameter and flux vectors.
+    species_index, parameter_index : dict
+        Positions of the species and parameters by name.
+    stoichiometry : scipy.sparse.csr_matrix
+        Coefficient of each flux in each species' ODE, species by fluxes.
+    term_flux, term_coefficients, term_parameters : numpy.ndarray
+        Flux, numeric factor (with sign) and rate constant of each term of
+        the rate laws.
+    term_species : numpy.ndarray of int
+        Reactant species of each term, padded with len(species) (which
+        refers to a constant 1).
+    """
+
+    def __init__(self, record):
+        for name in ('species', 'parameters', 'flux_names', 'stoichiometry',
+                     'term_flux', 'term_coefficients', 'term_parameters',
+                     'term_species'):
+            setattr(self, name, record[name])
+        self.species_index = dict((s, i) for i, s in enumerate(self.species))
+        self.parameter_index = dict((p, i) for i, p in
+                                    enumerate(self.parameters))
+        self._term_map = scipy.sparse.csr_matrix(
+            (np.ones(len(self.term_flux)),
+             (self.term_flux, np.arange(len(self.term_flux)))),
+            shape=(len(self.flux_names), len(self.term_flux)))
+
+    def parameter_vector(self, values=None):
+        """Return rate constants in `parameters` order.
+
+        Values come from the original SBML model, overridden by the dict
+        `values`.
+        """
+        from .original_sbml import load_model
+        defaults = dict((p.name, p.value) for p in load_model().parameters)
+        defaults.update(values or {})
+        return np.array([defaults[name] for name in self.parameters])
+
+    def initial_values(self):
+        """Return the species' initial amounts from the original SBML model.
+        """
+        from .original_sbml import load_model
+        amounts = dict((s.name, s.initial_amount)
+                       for s in load_model().species)
+        return np.array([amounts[name] for name in self.species])
+
+    def terms(self, y, p):
+        """Return the value of every rate-law term at species values `y`.
+
+        `y` has species along its last axis and may hold any number of
+        states; `p` is a parameter vector. The result has terms along its
+        last axis, signed as they enter their flux.
+        """
+        y = np.asarray(y, dtype=float)
+        padded = np.concatenate((y, np.ones(y.shape[:-1] + (1,))), axis=-1)
+        return (self.term_coefficients * np.asarray(p)[self.term_parameters] *
+                padded[..., self.term_species].prod(axis=-1))
+
+    def fluxes(self, y, p):
+        """Return the flux values at species values `y`, with fluxes along
+        the last axis (see terms())."""
+        terms = self.terms(y, p)
+        flat = terms.reshape(-1, len(self.term_flux))
+        return self._term_map.dot(flat.T).T.reshape(
+            terms.shape[:-1] + (len(self.flux_names),))
+
+    def describe_term(self, t):
+        """Return term `t` as text, e.g. 'ReactionFlux7: -kd7*c12'."""
+        factors = [self.parameters[self.term_parameters[t]]]
+        factors.extend(self.species[i] for i in self.term_species[t]
+                       if i < len(self.species))
+        coefficient = self.term_coefficients[t]
+        sign = '-' if coefficient < 0 else ''
+        if abs(coefficient) != 1:
+            factors.insert(0, '%g' % abs(coefficient))
+        return '%s: %s%s' % (self.flux_names[self.term_flux[t]], sign,
+                             '*'.join(factors))
+
+    def rhs(self, y, p):
+        """Return dy/dt at species values `y` (species along the last axis)
+        given parameter vector `p`."""
+        f = self.fluxes(y, p)
+        flat = f.reshape(-1, len(self.flux_names))
+        return self.stoichiometry.dot(flat.T).T.reshape(
+            f.shape[:-1] + (len(self.species),))
+
+
+def source_key(source):
+    """Return the cache key of the compiled form of `source`."""
+    h = hashlib.sha1()
+    h.update('simbiology %d\n' % COMPILED_VERSION)
+    h.update(source)
+    return 'simbiology-' + h.hexdigest()
+
+
+def load_equations(cache_dir=None):
+    """Return the compiled reference equations, compiling them if needed.
+    """
+    global _equations
+    if _equations is None:
+        source = _source()
+        key = source_key(source)
+        record = cache.load(key, cache_dir)
+        if record is None:
+            record = compile_equations(source)
+            cache.store(key, record, cache_dir)
+        _equations = SimBiologyEquations(record)
+    return _equations
+
+
+def sympy_odes():
+    """Return the reference ODEs as sympy expressions, by species name.
+
+    This imports simbiology_expressions, which builds every expression.
+    """
+    from . import simbiology_expressions
+    return simbiology_expressions.odes_by_name
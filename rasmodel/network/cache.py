@@ -0,0 +1,339 @@
+"""On-disk cache of generated reaction networks.
+
+Running BioNetGen to expand the rules of a model like rasmodel.chen_2009 takes
+seconds to minutes, and every process that simulates the model pays that cost
+again. This module stores the result of network generation (species,
+reactions and observable groups) in a cache directory, keyed by a hash of the
+model *structure*: monomers, rules, parameter and expression names, initial
+condition patterns and observable patterns. Parameter values are deliberately
+not part of the key since they do not affect the generated network, so a
+parameter scan can share one cache entry. Any edit to a component function
+that changes the rule set changes the key, so stale entries are never used.
+
+Use :func:`generate_equations` as a drop-in replacement for
+pysb.bng.generate_equations::
+
+    from rasmodel.network.cache import generate_equations
+    generate_equations(model)
+
+The cache directory defaults to ``~/.cache/rasmodel/networks`` and can be
+overridden with the RASMODEL_CACHE_DIR environment variable.
+
+The cache also remembers the most recent network generated for each model
+name. With the Python generator, when a model is edited its new network is
+derived from that one by re-expanding only the rules that changed (see
+rasmodel.network.generate), which is much faster than a full expansion
+during model development. BNG users can opt in with ``incremental=True``.
+"""
+
+import os
+import errno
+import hashlib
+import tempfile
+import cPickle as pickle
+import sympy
+import pysb
+import pysb.bng
+
+# Bump this whenever the layout of the pickled records changes.
+CACHE_VERSION = 2
+
+
+def default_cache_dir():
+    """Return the cache directory, honoring RASMODEL_CACHE_DIR."""
+    path = os.environ.get('RASMODEL_CACHE_DIR')
+    if path is None:
+        path = os.path.join(os.path.expanduser('~'), '.cache', 'rasmodel',
+                            'networks')
+    return path
+
+
+def _format_monomer(monomer):
+    states = ', '.join('%s=%s' % (site, sorted(monomer.site_states[site]))
+                       for site in sorted(monomer.site_states))
+    return 'Monomer %s(%s) {%s}' % (monomer.name, ','.join(monomer.sites),
+                                    states)
+
+
+def model_structure(model):
+    """Return a list of strings canonically describing the model structure.
+
+    Only the parts of the model that influence network generation are
+    included. Parameters contribute their names but not their values.
+    """
+    lines = ['version %d' % CACHE_VERSION,
+             'pysb %s' % getattr(pysb, '__version__', 'unknown')]
+    lines += [_format_monomer(m) for m in model.monomers]
+    lines += ['Compartment %r' % c for c in model.compartments]
+    lines += ['Parameter %s' % p.name for p in model.parameters]
+    lines += ['Expression %s = %s' % (e.name, e.expr)
+              for e in model.expressions]
+    lines += ['Initial %r @ %s' % (cp, p.name)
+              for cp, p in model.initial_conditions]
+    lines += [repr(r) for r in model.rules]
+    lines += [repr(o) for o in model.observables]
+    return lines
+
+
+def model_hash(model):
+    """Return the cache key for a model as a hex digest string."""
+    h = hashlib.sha1()
+    for line in model_structure(model):
+        h.update(line.encode('utf-8'))
+        h.update(b'\n')
+    return h.hexdigest()
+
+
+def rule_signatures(model):
+    """Return a dict of structural signatures for the rules of `model`.
+
+    A rule whose signature is unchanged between two versions of a model
+    generates the same reactions from the same species.
+    """
+    return dict((r.name, repr(r)) for r in model.rules)
+
+
+def global_signature(model):
+    """Return a signature of the model parts every rule depends on."""
+    return '\n'.join(model_structure(model)[:2] +
+                     [_format_monomer(m) for m in model.monomers])
+
+
+def _rate_terms(reaction):
+    """Split a reaction rate into its non-species factors, as strings."""
+    return tuple(str(t) for t in sympy.Mul.make_args(reaction['rate'])
+                 if not str(t).startswith('__s'))
+
+
+def _make_term(s):
+    try:
+        return sympy.Integer(int(s))
+    except ValueError:
+        pass
+    try:
+        return sympy.Float(float(s))
+    except ValueError:
+        return sympy.Symbol(s)
+
+
+def network_record(model):
+    """Return a picklable record of the generated network in `model`."""
+    species = []
+    for cp in model.species:
+        species.append([(mp.monomer.name,
+                         tuple(sorted(mp.site_conditions.items())),
+                         mp.compartment.name if mp.compartment else None)
+                        for mp in cp.monomer_patterns])
+    reactions = [(r['reactants'], r['products'], _rate_terms(r), r['rule'],
+                  r['reverse'])
+                 for r in model.reactions]
+    observables = dict((o.name, (list(o.species), list(o.coefficients)))
+                       for o in model.observables)
+    return {
+        'version': CACHE_VERSION,
+        'species': species,
+        'reactions': reactions,
+        'observables': observables,
+        'rules': rule_signatures(model),
+        'global': global_signature(model),
+        }
+
+
+def restore_network(model, record):
+    """Fill in the generated-network attributes of `model` from `record`.
+
+    This populates the same attributes as pysb.bng.generate_equations:
+    species, reactions, reactions_bidirectional, odes, and the species and
+    coefficients lists of each observable.
+    """
+    model.species = []
+    for monomers in record['species']:
+        mps = [pysb.MonomerPattern(model.monomers[name], dict(conditions),
+                                   model.compartments.get(compartment)
+                                   if compartment else None)
+               for name, conditions, compartment in monomers]
+        model.species.append(pysb.ComplexPattern(mps, None))
+    model.reactions = []
+    model.reactions_bidirectional = []
+    # Terms of each species' ODE, summed once at the end; adding them to
+    # sympy expressions one by one re-sorts the whole sum every time.
+    ode_terms = [[] for s in model.species]
+    # Replicate the bookkeeping pysb.bng does while parsing a .net file so the
+    # result is indistinguishable from a fresh BNG run.
+    bidirectional = {}
+    for reactants, products, terms, rule, reverse in record['reactions']:
+        factors = ([sympy.Symbol('__s%d' % i) for i in reactants] +
+                   [_make_term(t) for t in terms])
+        rate = sympy.Mul(*factors)
+        reaction = {
+            'reactants': reactants,
+            'products': products,
+            'rate': rate,
+            'rule': rule,
+            'reverse': reverse,
+            }
+        model.reactions.append(reaction)
+        key = (reactants, products)
+        key_reverse = (products, reactants)
+        if key in bidirectional:
+            reaction_bd = bidirectional[key]
+            reaction_bd['rate'] += rate
+            reaction_bd['rule'] += tuple(r for r in rule
+                                         if r not in reaction_bd['rule'])
+        elif key_reverse in bidirectional:
+            reaction_bd = bidirectional[key_reverse]
+            reaction_bd['reversible'] = True
+            reaction_bd['rate'] -= rate
+            reaction_bd['rule'] += tuple(r for r in rule
+                                         if r not in reaction_bd['rule'])
+        else:
+            reaction_bd = dict(reaction)
+            reaction_bd['reversible'] = False
+            bidirectional[key] = reaction_bd
+            model.reactions_bidirectional.append(reaction_bd)
+        for p in products:
+            ode_terms[p].append(rate)
+        for r in reactants:
+            ode_terms[r].append(-rate)
+    for reaction_bd in model.reactions_bidirectional:
+        if all(reaction_bd['reverse']):
+            reaction_bd['reactants'], reaction_bd['products'] = \
+                reaction_bd['products'], reaction_bd['reactants']
+            reaction_bd['rate'] *= -1
+        del reaction_bd['reverse']
+    model.odes = [sympy.Add(*terms) for terms in ode_terms]
+    for obs in model.observables:
+        species, coefficients = record['observables'].get(obs.name, ([], []))
+        obs.species = list(species)
+        obs.coefficients = list(coefficients)
+
+
+def _cache_path(key, cache_dir):
+    return os.path.join(cache_dir, key + '.pkl')
+
+
+def _latest_path(model, cache_dir):
+    name = hashlib.sha1(model.name.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, name + '.latest')
+
+
+def load_latest(model, cache_dir=None):
+    """Return the most recently stored record for a model of this name."""
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    try:
+        with open(_latest_path(model, cache_dir)) as f:
+            key = f.read().strip()
+    except IOError:
+        return None
+    return load(key, cache_dir)
+
+
+def load(key, cache_dir=None):
+    """Return the cached network record for `key`, or None if absent."""
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    try:
+        with open(_cache_path(key, cache_dir), 'rb') as f:
+            record = pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        return None
+    if record.get('version') != CACHE_VERSION:
+        return None
+    return record
+
+
+def _write_atomic(path, data, cache_dir):
+    # Write to a temporary file and rename it into place, so that concurrent
+    # workers never observe a partially written entry.
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+def store(key, record, cache_dir=None, model=None):
+    """Atomically write a network record to the cache.
+
+    If `model` is given, the entry is also remembered as the latest network
+    for the model's name.
+    """
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    try:
+        os.makedirs(cache_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    _write_atomic(_cache_path(key, cache_dir),
+                  pickle.dumps(record, pickle.HIGHEST_PROTOCOL), cache_dir)
+    if model is not None:
+        _write_atomic(_latest_path(model, cache_dir), key, cache_dir)
+
+
+def default_generator():
+    """Return the network generator to use on cache misses.
+
+    This is 'bng' unless the RASMODEL_NETWORK_GENERATOR environment variable
+    says 'python', e.g. on workers where BioNetGen can't be run.
+    """
+    return os.environ.get('RASMODEL_NETWORK_GENERATOR', 'bng')
+
+
+def generate_equations(model, cleanup=True, verbose=False, cache_dir=None,
+                       incremental=None, generator=None, verify=False):
+    """Generate the model's network, using the on-disk cache when possible.
+
+    Accepts the same arguments as pysb.bng.generate_equations, plus
+    `cache_dir` to override the default cache location. On a cache miss the
+    network is generated by `generator`, 'bng' or 'python' (see
+    rasmodel.network.generate), which defaults to default_generator().
+    The result is stored for the next caller.
+
+    If `incremental` is True, a cache miss is instead regenerated
+    incrementally from the latest cached network of the same model name,
+    when there is one. It defaults to True for the 'python' generator only,
+    so asking for 'bng' gets a BNG network. With `verify`, the incremental
+    result is checked against a full Python expansion, and RuntimeError is
+    raised if they differ. That doubles the cost of the miss, so it is off
+    by default: unchanged rules are only applied to new species, which
+    gives the same network as a full expansion as long as the previous
+    record is a faithful expansion of the earlier model, and records are
+    only reused when the monomers and global signature are unchanged.
+    """
+    if generator is None:
+        generator = default_generator()
+    if generator not in ('bng', 'python'):
+        raise ValueError("Unknown network generator: %s" % generator)
+    if incremental is None:
+        incremental = generator == 'python'
+    if model.odes:
+        return
+    # BNG export adds the __source/__sink machinery to the model as a side
+    # effect. Do it up front so the key is the same on hits and misses.
+    if model.has_synth_deg():
+        model.enable_synth_deg()
+    key = model_hash(model)
+    record = load(key, cache_dir)
+    if record is not None:
+        restore_network(model, record)
+        return
+    # Imported here since the generator depends on this module.
+    from . import generate
+    previous = load_latest(model, cache_dir) if incremental else None
+    if generate.can_extend(previous, model):
+        if verbose:
+            print "Regenerating network incrementally"
+        record = generate.generate_network(model, previous, verify=verify)
+        restore_network(model, record)
+    elif generator == 'python':
+        record = generate.generate_network(model)
+        restore_network(model, record)
+    else:
+        pysb.bng.generate_equations(model, cleanup, verbose)
+        record = network_record(model)
+    store(key, record, cache_dir, model)
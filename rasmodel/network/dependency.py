@@ -0,0 +1,172 @@
+"""Species and reactions that observables depend on.
+
+The value of an observable at time t depends only on the species in its
+definition, the derivative of a species only on the reactants of the
+reactions that change it (and the species of any observables their rates
+read), and so on. Closing the observables' species under this relation gives
+their dependency cone: the network restricted to the cone reproduces the
+observables exactly, and everything outside it can be left out::
+
+    from rasmodel.network.dependency import dependency_cone
+    species, reactions = dependency_cone(model, ['pERK', 'pAKT'])
+
+Simulator(model, tspan, targets=['pERK']) integrates just the cone.
+
+Within the cone, some species are only there because they bind (sequester)
+a species of the cone, without which they would not be upstream of the
+targets. Dropping those would be an approximation that ignores the load
+they put on the cone; cone_report() lists them as candidates but they are
+never dropped automatically. For example, with the rules
+
+    K() + A(b=None, s='u') >> K() + A(b=None, s='p')
+    A(b=None) + B(a=None) <> A(b=1) % B(a=1)
+
+the free A(s='p') depends on B and the A:B complexes only because B holds A
+back, so those three are the candidates of an observable of free A(s='p').
+"""
+
+import pysb
+
+
+def target_species(model, targets):
+    """Return the species that observables or expressions are made of.
+
+    `targets` is a list of Observables, Expressions or their names.
+    """
+    if not model.reactions:
+        raise ValueError("Model network has not been generated")
+    components = model.all_components()
+    species = set()
+    for target in targets:
+        if isinstance(target, basestring):
+            target = components[target]
+        if isinstance(target, pysb.Observable):
+            observables = [target]
+        elif isinstance(target, pysb.Expression):
+            observables = target.expand_expr().atoms(pysb.Observable)
+        else:
+            raise ValueError("Not an observable or expression: %s" % target)
+        for obs in observables:
+            species.update(obs.species)
+    return sorted(species)
+
+
+def _rate_species(model):
+    """Map each dynamic expression's name to the species it reads."""
+    return dict((e.name, set(target_species(model, [e])))
+                for e in model.expressions_dynamic())
+
+
+def _dissociations(model):
+    """Return the indexes of reactions that only undo a binding step.
+
+    These are reactions with more products than reactants whose exact
+    reverse is in the network, and whose reactants (the complex) are formed
+    by no other reaction. A complex that can also form another way, as in
+    E + S <-> C <-> E + P, carries that signal into its dissociation.
+    """
+    sides = set((tuple(sorted(r['reactants'])), tuple(sorted(r['products'])))
+                for r in model.reactions)
+    formed_from = [set() for s in model.species]
+    for r in model.reactions:
+        for i in set(r['products']):
+            if r['products'].count(i) > r['reactants'].count(i):
+                formed_from[i].add(tuple(sorted(r['reactants'])))
+    dissociations = set()
+    for j, r in enumerate(model.reactions):
+        products = tuple(sorted(r['products']))
+        if len(r['products']) > len(r['reactants']) and \
+                (products, tuple(sorted(r['reactants']))) in sides and \
+                all(formed_from[i] == set([products])
+                    for i in r['reactants']):
+            dissociations.add(j)
+    return dissociations
+
+
+def _influences(model, sequestration=True):
+    """Map each species to the species that its derivative depends on.
+
+    With `sequestration` False, a binding step and its reverse count as one
+    step: the binding partners only influence the complex they form, not
+    each other (the binding consumes them), and a complex that only forms
+    from them does not influence them by dissociating back (see
+    _dissociations).
+    """
+    influences = [set() for s in model.species]
+    dynamic = _rate_species(model)
+    dissociations = set() if sequestration else _dissociations(model)
+    for j, r in enumerate(model.reactions):
+        reactants = set(r['reactants'])
+        sources = set(reactants)
+        for symbol in r['rate'].free_symbols:
+            sources |= dynamic.get(symbol.name, set())
+        for i in set(r['reactants'] + r['products']):
+            change = r['products'].count(i) - r['reactants'].count(i)
+            if sequestration or change > 0 and j not in dissociations:
+                influences[i] |= sources
+            elif change < 0:
+                influences[i] |= sources - (reactants - set([i]))
+            elif change > 0:
+                influences[i] |= sources - reactants
+    return influences
+
+
+def _cone(influences, seeds):
+    cone = set(seeds)
+    queue = list(cone)
+    while queue:
+        for i in influences[queue.pop()]:
+            if i not in cone:
+                cone.add(i)
+                queue.append(i)
+    return cone
+
+
+def dependency_cone(model, targets):
+    """Find the species and reactions that observables depend on.
+
+    Parameters
+    ----------
+    model : pysb.Model
+        Model with its network generated.
+    targets : list
+        Observables, expressions or their names.
+
+    Returns
+    -------
+    species : list of int
+        Species in the cone, sorted.
+    reactions : list of int
+        Reactions that change a species of the cone, sorted.
+    """
+    cone = _cone(_influences(model), target_species(model, targets))
+    return sorted(cone), _cone_reactions(model, cone)
+
+
+def _cone_reactions(model, cone):
+    return [j for j, r in enumerate(model.reactions)
+            if any(r['reactants'].count(i) != r['products'].count(i)
+                   for i in cone.intersection(r['reactants'] +
+                                              r['products']))]
+
+
+def cone_report(model, targets):
+    """Summarize the dependency cone of each target.
+
+    Returns a list of dicts, one per target (and one for all of them,
+    named 'all'), with the target's 'name', the number of 'species' and
+    'reactions' in its cone, and the 'candidates': species in the cone only
+    through sequestration (see the module docstring), sorted.
+    """
+    exact = _influences(model)
+    signaling = _influences(model, sequestration=False)
+    report = []
+    named = [(t if isinstance(t, basestring) else t.name, [t])
+             for t in targets]
+    for name, group in named + [('all', targets)]:
+        seeds = target_species(model, group)
+        cone = _cone(exact, seeds)
+        report.append({'name': name, 'species': len(cone),
+                       'reactions': len(_cone_reactions(model, cone)),
+                       'candidates': sorted(cone - _cone(signaling, seeds))})
+    return report
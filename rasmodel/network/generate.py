@@ -0,0 +1,709 @@
+"""Rule expansion in Python, with incremental regeneration.
+
+This module expands the rules of a PySB model into a reaction network
+without calling BioNetGen. It covers the subset of BNGL that REM rules use:
+site states, bonds (including several bonds on one site), ANY/WILD,
+reversible and irreversible rules, synthesis and degradation through
+``None``, and MatchOnce patterns. Rate factors
+follow BioNetGen's conventions: each reaction's rate constant is multiplied
+by the number of distinct ways the rule applies, divided by the number of
+symmetries of the rule.
+
+The result is a network record in the format used by rasmodel.network.cache,
+so it can be stored in and restored from the same cache.
+
+Use :func:`generate_equations` as a drop-in replacement for
+pysb.bng.generate_equations, or select this generator for cache misses in
+rasmodel.network.cache with ``generator='python'`` or
+RASMODEL_NETWORK_GENERATOR=python.
+
+The main entry point for regenerating a network after a rule edit is
+:func:`generate_network` with a `previous` record. Only rules that were
+added, removed or changed are re-expanded against the surviving species;
+unchanged rules are applied only to species that did not exist before.
+Species that are no longer reachable from the initial conditions are
+dropped. Pass ``verify=True`` to check the result against a full
+regeneration.
+"""
+
+import time
+import itertools
+import collections
+import pysb
+from . import graph as ng
+from . import cache
+
+# Default limits on network size, which guard against runaway expansion.
+MAX_ITERATIONS = 100
+MAX_SPECIES = 20000
+
+
+class NetworkSizeError(RuntimeError):
+    """Network generation exceeded the configured limits.
+
+    The `expansion` attribute holds the partial network.
+    """
+
+    def __init__(self, message, expansion=None):
+        RuntimeError.__init__(self, message)
+        self.expansion = expansion
+
+
+class RuleTemplate(object):
+    """One direction of a pysb Rule, compiled for application to species."""
+
+    def __init__(self, rule, reverse, sites, default_states):
+        self.rule = rule
+        self.name = rule.name
+        self.reverse = reverse
+        if rule.delete_molecules or rule.move_connected:
+            raise NotImplementedError("Rule %s: DeleteMolecules and "
+                                      "MoveConnected are not supported"
+                                      % rule.name)
+        # Synthesis and degradation are written with __source and __sink, as
+        # pysb presents them to BNG.
+        lhs = [ng.compile_pattern(cp)
+               for cp in rule.reactant_pattern.complex_patterns]
+        rhs = [ng.compile_pattern(cp)
+               for cp in rule.product_pattern.complex_patterns]
+        if rule.is_synth():
+            lhs = [ng.Pattern(['__source'], [{}])]
+            rhs = rhs + [ng.Pattern(['__source'], [{}])]
+        if rule.is_deg():
+            rhs = [ng.Pattern(['__sink'], [{}])]
+        if reverse:
+            self.reactants, self.products = rhs, lhs
+            self.rate = rule.rate_reverse
+        else:
+            self.reactants, self.products = lhs, rhs
+            self.rate = rule.rate_forward
+        self.sites = sites
+        self.default_states = default_states
+        self._compile()
+
+    def __repr__(self):
+        return '<RuleTemplate %s%s>' % (self.name,
+                                       ' (reverse)' if self.reverse else '')
+
+    def _flatten(self, patterns):
+        agents = []
+        for i, p in enumerate(patterns):
+            for a in range(len(p)):
+                agents.append((i, a))
+        return agents
+
+    def _compile(self):
+        r_agents = self._flatten(self.reactants)
+        p_agents = self._flatten(self.products)
+        self.r_agents = r_agents
+        self.p_agents = p_agents
+        r_names = [self.reactants[i].names[a] for i, a in r_agents]
+        p_names = [self.products[i].names[a] for i, a in p_agents]
+        r_conditions = [self.reactants[i].conditions[a] for i, a in r_agents]
+        p_conditions = [self.products[i].conditions[a] for i, a in p_agents]
+
+        # Map product agents to reactant agents of the same monomer, in
+        # order of appearance.
+        corr = {}
+        taken = set()
+        for p, name in enumerate(p_names):
+            for r, r_name in enumerate(r_names):
+                if r not in taken and r_name == name:
+                    corr[p] = r
+                    taken.add(r)
+                    break
+        self.corr = corr
+        inverse = dict((r, p) for p, r in corr.items())
+        self.deleted = [r for r in range(len(r_agents)) if r not in inverse]
+        self.new_agents = [p for p in range(len(p_agents)) if p not in corr]
+        # Reactant complexes that vanish entirely are deleted as a whole,
+        # including any agents not mentioned in the pattern.
+        self.deleted_complexes = set(
+            i for i in range(len(self.reactants))
+            if all(r in self.deleted for r, (j, a) in enumerate(r_agents)
+                   if j == i))
+
+        def flat_partners(patterns, agents):
+            index = dict((pa, f) for f, pa in enumerate(agents))
+            partners = {}
+            for f, (i, a) in enumerate(agents):
+                for site in patterns[i].conditions[a]:
+                    for b, b_site in patterns[i].partners.get((a, site), ()):
+                        partners.setdefault((f, site), []).append(
+                            (index[(i, b)], b_site))
+            return partners
+
+        def edges(partners, translate):
+            result = set()
+            for end, others in partners.items():
+                for other in others:
+                    pair = [translate(end), translate(other)]
+                    if None not in pair:
+                        result.add(tuple(sorted(pair)))
+            return result
+
+        r_partners = flat_partners(self.reactants, r_agents)
+        p_partners = flat_partners(self.products, p_agents)
+        self.r_partners = r_partners
+        self.p_partners = p_partners
+        # Bonds in terms of product agents, on both sides of the rule.
+        r_edges = edges(r_partners, lambda (r, site): (inverse[r], site)
+                        if r in inverse else None)
+        p_edges = edges(p_partners, lambda end: end)
+
+        # State changes on preserved agents.
+        self.state_changes = []
+        for p, r in corr.items():
+            for site, (state, bond) in p_conditions[p].items():
+                if state is not None and r_conditions[r].get(site, (None,))[0] \
+                        != state:
+                    self.state_changes.append((r, site, state))
+        # Bonds broken between preserved agents. Bonds to deleted agents go
+        # away with them.
+        self.breaks = sorted((corr[p], site, corr[p2], site2)
+                             for (p, site), (p2, site2) in r_edges - p_edges)
+        # Sites that must end up free but were not required free before lose
+        # all their bonds.
+        self.clears = []
+        for p, r in corr.items():
+            for site, (state, bond) in p_conditions[p].items():
+                if bond is ng.FREE and \
+                        r_conditions[r].get(site, (None, ng.WILD))[1] \
+                        is not ng.FREE:
+                    self.clears.append((r, site))
+        # Bonds formed, in terms of product agents.
+        self.adds = sorted(p_edges - r_edges)
+        self.p_names = p_names
+        self.p_conditions = p_conditions
+        self.r_names = r_names
+        self.r_conditions = r_conditions
+        self.symmetry = self._symmetry()
+
+    def _symmetry(self):
+        """Count the automorphisms of the rule.
+
+        A symmetry must map the reactant side onto itself and be consistent
+        with some symmetry of the product side, so that the transformation
+        the rule performs is preserved. MatchOnce patterns are held fixed.
+        """
+        r_groups = [i for i, a in self.r_agents]
+        p_groups = [i for i, a in self.p_agents]
+        fixed = dict((r, r) for r, (i, a) in enumerate(self.r_agents)
+                     if self.reactants[i].match_once)
+        inverse = dict((r, p) for p, r in self.corr.items())
+        count = 0
+        for sigma in ng.automorphisms(self.r_names, self.r_conditions,
+                                      self.r_partners, r_groups, fixed):
+            forced = {}
+            ok = True
+            for p, r in self.corr.items():
+                image = inverse.get(sigma[r])
+                if image is None:
+                    ok = False
+                    break
+                forced[p] = image
+            if not ok:
+                continue
+            for tau in ng.automorphisms(self.p_names, self.p_conditions,
+                                        self.p_partners, p_groups, forced):
+                count += 1
+                break
+        return count
+
+    def apply(self, graphs, maps):
+        """Apply the rule to reactant species through the given embeddings.
+
+        Returns the list of product species graphs, ordered by the product
+        pattern they derive from, or None if the result does not have the
+        number of complexes the rule's products require.
+        """
+        # Merge the reactant species into one working graph.
+        names = []
+        states = []
+        bonds = {}
+        offsets = []
+        for g in graphs:
+            offset = len(names)
+            offsets.append(offset)
+            names.extend(g.names)
+            states.extend(dict(s) for s in g.states)
+            for (a, s), partners in g.bonds.items():
+                bonds[(a + offset, s)] = [(b + offset, t) for b, t in partners]
+        # Working-graph agent for each flattened reactant agent.
+        r_target = [offsets[i] + maps[i][a] for i, a in self.r_agents]
+        for r, site, state in self.state_changes:
+            states[r_target[r]][site] = state
+        for r, site, r2, site2 in self.breaks:
+            a, b = (r_target[r], site), (r_target[r2], site2)
+            bonds[a].remove(b)
+            bonds[b].remove(a)
+        for r, site in self.clears:
+            a = (r_target[r], site)
+            for b in bonds.pop(a, ()):
+                bonds[b].remove(a)
+        p_target = {}
+        for p, r in self.corr.items():
+            p_target[p] = r_target[r]
+        for p in self.new_agents:
+            name = self.p_names[p]
+            agent_states = dict(self.default_states.get(name, {}))
+            for site, (state, bond) in self.p_conditions[p].items():
+                if state is not None:
+                    agent_states[site] = state
+            p_target[p] = len(names)
+            names.append(name)
+            states.append(agent_states)
+        for (p, site), (p2, site2) in self.adds:
+            a, b = (p_target[p], site), (p_target[p2], site2)
+            bonds.setdefault(a, []).append(b)
+            bonds.setdefault(b, []).append(a)
+        # Delete agents, or whole complexes.
+        dead = set(r_target[r] for r in self.deleted)
+        for i in self.deleted_complexes:
+            dead.update(range(offsets[i], offsets[i] + len(graphs[i])))
+        # Split into connected components.
+        component = {}
+        components = []
+        for start in range(len(names)):
+            if start in dead or start in component:
+                continue
+            members = [start]
+            component[start] = len(components)
+            k = 0
+            while k < len(members):
+                a = members[k]
+                k += 1
+                for site in self.sites[names[a]]:
+                    for b, t in bonds.get((a, site), ()):
+                        # Bonds to deleted agents vanish with them.
+                        if b not in dead and b not in component:
+                            component[b] = len(components)
+                            members.append(b)
+            components.append(members)
+        if len(components) != len(self.products):
+            return None
+        # Order the products by the first product pattern mapped into each.
+        order = []
+        for i, p_cp in enumerate(self.products):
+            first = self.p_agents.index((i, 0))
+            c = component[p_target[first]]
+            if c not in order:
+                order.append(c)
+        if len(order) != len(components):
+            return None
+        products = []
+        for c in order:
+            members = components[c]
+            position = dict((a, j) for j, a in enumerate(members))
+            sub_bonds = {}
+            for (a, s), partners in bonds.items():
+                if a in position:
+                    partners = tuple((position[b], t) for b, t in partners
+                                     if b in position)
+                    if partners:
+                        sub_bonds[(position[a], s)] = partners
+            g = ng.SpeciesGraph([names[a] for a in members],
+                                [states[a] for a in members], sub_bonds,
+                                self.sites)
+            products.append(ng.canonical_graph(g))
+        return products
+
+
+def rule_templates(model, sites=None):
+    """Compile all rules of `model`, in BNG order (forward, then reverse)."""
+    if sites is None:
+        sites = ng.monomer_sites(model)
+    default_states = dict(
+        (m.name, dict((site, states[0])
+                      for site, states in m.site_states.items()))
+        for m in model.monomers)
+    templates = []
+    for rule in model.rules:
+        templates.append(RuleTemplate(rule, False, sites, default_states))
+        if rule.is_reversible:
+            templates.append(RuleTemplate(rule, True, sites, default_states))
+    return templates
+
+
+class _Expansion(object):
+    """State of a network expansion: species, matches and reactions."""
+
+    def __init__(self, templates, observer=None, max_iterations=None,
+                 max_species=None):
+        self.templates = templates
+        self.species = []
+        self.index = {}
+        # For each template and reactant position, the species that match and
+        # their embeddings.
+        self.matches = [[[] for p in t.reactants] for t in templates]
+        # Reactant patterns grouped by the set of monomers they require, so a
+        # new species is only matched against patterns it could contain.
+        self.requirements = collections.defaultdict(list)
+        for t, template in enumerate(templates):
+            for k, pattern in enumerate(template.reactants):
+                self.requirements[frozenset(pattern.names)].append(
+                    (t, k, pattern))
+        # Reaction key -> [reactants, products, template, map count]
+        self.reactions = collections.OrderedDict()
+        self.observer = observer
+        self.iteration = 0
+        self.max_iterations = MAX_ITERATIONS if max_iterations is None \
+            else max_iterations
+        self.max_species = MAX_SPECIES if max_species is None \
+            else max_species
+
+    def add_species(self, g):
+        """Add a canonical species graph if new, and return its index."""
+        i = self.index.get(g.key)
+        if i is not None:
+            return i
+        i = len(self.species)
+        if i >= self.max_species:
+            raise NetworkSizeError("Network exceeds %d species"
+                                   % self.max_species, self)
+        self.species.append(g)
+        self.index[g.key] = i
+        names = set(g.names)
+        for required, patterns in self.requirements.items():
+            if not required <= names:
+                continue
+            for t, k, pattern in patterns:
+                maps = pattern.embeddings(g, first_only=pattern.match_once)
+                if maps:
+                    self.matches[t][k].append((i, maps))
+        return i
+
+    def add_reaction(self, template, reactants, products, count):
+        reactants = tuple(sorted(reactants))
+        products = tuple(sorted(products))
+        key = (template.name, template.reverse, reactants, products)
+        entry = self.reactions.get(key)
+        if entry is None:
+            self.reactions[key] = [reactants, products, template, count]
+        else:
+            entry[3] += count
+
+    def apply(self, t, is_new, limit):
+        """Apply template `t` to species tuples with at least one new member.
+
+        Only species with index below `limit` are considered. Returns the
+        number of reactant tuples examined.
+        """
+        template = self.templates[t]
+        candidates = [[(i, maps) for i, maps in m if i < limit]
+                      for m in self.matches[t]]
+        started = time.time()
+        species_before = len(self.species)
+        reactions_before = len(self.reactions)
+        tuples = 0
+        # Report even if a size limit is hit, so the rule responsible shows
+        # up in profiles.
+        try:
+            for combo in itertools.product(*candidates):
+                if not any(is_new(i) for i, maps in combo):
+                    continue
+                tuples += 1
+                graphs = [self.species[i] for i, maps in combo]
+                counts = {}
+                for maps in itertools.product(*[m for i, m in combo]):
+                    products = template.apply(graphs, maps)
+                    if products is None:
+                        continue
+                    indexes = tuple(self.add_species(p) for p in products)
+                    counts[indexes] = counts.get(indexes, 0) + 1
+                for products, count in counts.items():
+                    self.add_reaction(template, [i for i, m in combo],
+                                      products, count)
+        finally:
+            if self.observer is not None:
+                self.observer(template, self.iteration, tuples,
+                              len(self.species) - species_before,
+                              len(self.reactions) - reactions_before,
+                              time.time() - started)
+        return tuples
+
+    def run(self, start, first_pass=None):
+        """Iterate to closure, treating species from `start` on as new.
+
+        `first_pass` optionally maps template indexes to a predicate used in
+        place of the default newness test during the first iteration.
+        """
+        self.iteration = 0
+        while start < len(self.species) or first_pass:
+            self.iteration += 1
+            if self.iteration > self.max_iterations:
+                raise NetworkSizeError("Network generation did not converge "
+                                       "in %d iterations"
+                                       % self.max_iterations, self)
+            limit = len(self.species)
+            is_new = lambda i, start=start: i >= start
+            for t in range(len(self.templates)):
+                predicate = is_new
+                if first_pass is not None and t in first_pass:
+                    predicate = first_pass[t]
+                self.apply(t, predicate, limit)
+            first_pass = None
+            start = limit
+        return self.iteration
+
+
+def _seed_graphs(model, sites):
+    graphs = []
+    for cp, parameter in model.initial_conditions:
+        graphs.append(ng.canonical_graph(ng.species_graph(cp, sites)))
+    return graphs
+
+
+def _observable_groups(model, species):
+    groups = {}
+    for obs in model.observables:
+        patterns = [ng.compile_pattern(cp)
+                    for cp in obs.reaction_pattern.complex_patterns]
+        indexes = []
+        coefficients = []
+        for i, g in enumerate(species):
+            total = 0
+            for pattern in patterns:
+                maps = pattern.embeddings(g)
+                if not maps:
+                    continue
+                if obs.match == 'species':
+                    total = 1
+                    break
+                symmetry = sum(1 for sigma in ng.automorphisms(
+                    pattern.names, pattern.conditions, pattern.partners,
+                    [0] * len(pattern)))
+                total += len(maps) // symmetry
+            if total:
+                indexes.append(i)
+                coefficients.append(total)
+        groups[obs.name] = (indexes, coefficients)
+    return groups
+
+
+def _rate_terms(template, count):
+    factor = float(count) / template.symmetry
+    terms = ()
+    if factor != 1:
+        if factor == int(factor):
+            terms += (str(int(factor)),)
+        else:
+            terms += (repr(factor),)
+    return terms + (template.rate.name,)
+
+
+def _record(model, expansion, extra_reactions=()):
+    species = [[(name, tuple(sorted(conditions.items())), None)
+                for name, conditions in g.site_conditions()]
+               for g in expansion.species]
+    reactions = list(extra_reactions)
+    for reactants, products, template, count in expansion.reactions.values():
+        reactions.append((reactants, products, _rate_terms(template, count),
+                          (template.name,), (template.reverse,)))
+    return {
+        'version': cache.CACHE_VERSION,
+        'species': species,
+        'reactions': reactions,
+        'observables': _observable_groups(model, expansion.species),
+        'rules': cache.rule_signatures(model),
+        'global': cache.global_signature(model),
+        }
+
+
+def _prepare(model):
+    if not model.rules:
+        raise pysb.bng.NoRulesError()
+    if model.has_synth_deg():
+        model.enable_synth_deg()
+
+
+def _expand_full(model, observer=None, max_iterations=None, max_species=None):
+    _prepare(model)
+    sites = ng.monomer_sites(model)
+    templates = rule_templates(model, sites)
+    expansion = _Expansion(templates, observer, max_iterations, max_species)
+    for g in _seed_graphs(model, sites):
+        expansion.add_species(g)
+    expansion.run(0)
+    return expansion
+
+
+def _graph_from_record(monomers, sites):
+    return ng.canonical_graph(ng.graph_from_conditions(
+        [(name, conditions) for name, conditions, compartment in monomers],
+        sites))
+
+
+def _expand_incremental(model, previous, observer=None, max_iterations=None,
+                        max_species=None):
+    _prepare(model)
+    sites = ng.monomer_sites(model)
+    templates = rule_templates(model, sites)
+    old_signatures = previous['rules']
+    new_signatures = cache.rule_signatures(model)
+    unchanged = set(name for name, signature in new_signatures.items()
+                    if old_signatures.get(name) == signature)
+    old_species = [_graph_from_record(s, sites) for s in previous['species']]
+    seeds = _seed_graphs(model, sites)
+
+    # Keep reactions of unchanged rules, then find which old species are
+    # still reachable from the new initial conditions through them.
+    kept = [r for r in previous['reactions']
+            if len(r[3]) == 1 and r[3][0] in unchanged]
+    reachable = set(g.key for g in seeds)
+    changed = True
+    while changed:
+        changed = False
+        for reactants, products, terms, rule, reverse in kept:
+            if all(old_species[i].key in reachable for i in reactants):
+                for i in products:
+                    key = old_species[i].key
+                    if key not in reachable:
+                        reachable.add(key)
+                        changed = True
+
+    expansion = _Expansion(templates, observer, max_iterations, max_species)
+    old_to_new = {}
+    for i, g in enumerate(old_species):
+        if g.key in reachable:
+            old_to_new[i] = expansion.add_species(g)
+    old_count = len(expansion.species)
+    for g in seeds:
+        expansion.add_species(g)
+    # Renumber the surviving reactions of unchanged rules. Reactions whose
+    # species all survive were generated from tuples of surviving species,
+    # which the expansion below won't revisit for unchanged rules.
+    template_by_key = dict(((t.name, t.reverse), t) for t in templates)
+    for reactants, products, terms, rule, reverse in kept:
+        if not all(i in old_to_new for i in reactants + products):
+            continue
+        template = template_by_key[(rule[0], reverse[0])]
+        count = _count_from_terms(template, terms)
+        expansion.add_reaction(template, [old_to_new[i] for i in reactants],
+                               [old_to_new[i] for i in products], count)
+
+    # First pass: changed rules see every species, unchanged rules only see
+    # tuples involving species that did not exist in the old network.
+    everything = lambda i: True
+    first_pass = dict((t, everything) for t, template in enumerate(templates)
+                      if template.name not in unchanged)
+    is_new = lambda i: i >= old_count
+    for t in range(len(templates)):
+        first_pass.setdefault(t, is_new)
+    expansion.run(len(expansion.species), first_pass)
+    return expansion
+
+
+def _count_from_terms(template, terms):
+    """Recover the number of rule applications from stored rate terms."""
+    factor = 1.0
+    for term in terms[:-1]:
+        factor *= float(term)
+    return int(round(factor * template.symmetry))
+
+
+def network_keys(record, model):
+    """Return species keys and a reaction multiset for comparing networks.
+    """
+    sites = ng.monomer_sites(model)
+    keys = [_graph_from_record(s, sites).key for s in record['species']]
+    reactions = collections.Counter()
+    for reactants, products, terms, rule, reverse in record['reactions']:
+        reactions[(rule, reverse,
+                   tuple(sorted(keys[i] for i in reactants)),
+                   tuple(sorted(keys[i] for i in products)),
+                   tuple(terms))] += 1
+    observables = {}
+    for name, (indexes, coefficients) in record['observables'].items():
+        observables[name] = sorted((keys[i], c)
+                                   for i, c in zip(indexes, coefficients))
+    return set(keys), reactions, observables
+
+
+def compare_networks(a, b, model):
+    """Return a list of human-readable differences between two records."""
+    species_a, reactions_a, observables_a = network_keys(a, model)
+    species_b, reactions_b, observables_b = network_keys(b, model)
+    differences = []
+    for key in sorted(species_a - species_b):
+        differences.append('species only in first: %s' % key)
+    for key in sorted(species_b - species_a):
+        differences.append('species only in second: %s' % key)
+    for key in sorted((reactions_a - reactions_b).elements()):
+        differences.append('reaction only in first: %r' % (key,))
+    for key in sorted((reactions_b - reactions_a).elements()):
+        differences.append('reaction only in second: %r' % (key,))
+    for name in sorted(set(observables_a) | set(observables_b)):
+        if observables_a.get(name) != observables_b.get(name):
+            differences.append('observable %s differs' % name)
+    return differences
+
+
+def can_extend(previous, model):
+    """Return whether `previous` can seed an incremental regeneration."""
+    if previous is None or 'rules' not in previous:
+        return False
+    _prepare(model)
+    if previous.get('global') != cache.global_signature(model):
+        return False
+    # BNG merges identical reactions generated by different rules, and such
+    # reactions can't be attributed to a single rule.
+    return all(len(r[3]) == 1 for r in previous['reactions'])
+
+
+def generate_network(model, previous=None, verify=False, observer=None,
+                     max_iterations=None, max_species=None):
+    """Expand the rules of `model` and return a network record.
+
+    Parameters
+    ----------
+    model : pysb.Model
+        Model to expand. The model itself is not modified, except that the
+        __source/__sink components are added if it has synthesis or
+        degradation rules (as pysb.bng does).
+    previous : dict, optional
+        Network record of an earlier version of the model, as stored in the
+        network cache. If given, the network is regenerated incrementally.
+        A full expansion is done anyway if the monomers changed.
+    verify : bool, optional
+        If True and `previous` is given, also run a full expansion and raise
+        RuntimeError if the incremental result differs from it.
+    observer : callable, optional
+        Called as ``observer(template, iteration, tuples, species, reactions,
+        seconds)`` after each application of a rule template during
+        expansion, with the number of reactant tuples examined and of species
+        and reactions created. See rasmodel.network.profile.
+    max_iterations, max_species : int, optional
+        Limits on the expansion; NetworkSizeError is raised when exceeded.
+    """
+    limits = dict(observer=observer, max_iterations=max_iterations,
+                  max_species=max_species)
+    if can_extend(previous, model):
+        expansion = _expand_incremental(model, previous, **limits)
+        record = _record(model, expansion)
+        if verify:
+            full = _record(model, _expand_full(model, **limits))
+            differences = compare_networks(record, full, model)
+            if differences:
+                raise RuntimeError("Incremental network differs from full "
+                                   "regeneration:\n  " +
+                                   '\n  '.join(differences[:20]))
+        return record
+    return _record(model, _expand_full(model, **limits))
+
+
+def generate_equations(model, cleanup=True, verbose=False):
+    """Generate the network of `model` in-process.
+
+    A drop-in replacement for pysb.bng.generate_equations that needs neither
+    BioNetGen nor temporary files. It fills in the same model attributes:
+    species, reactions, reactions_bidirectional, odes and observable species
+    and coefficients. `cleanup` is accepted for compatibility and ignored.
+    """
+    if model.odes:
+        return
+    record = generate_network(model)
+    if verbose:
+        print "Generated %d species and %d reactions" % (
+            len(record['species']), len(record['reactions']))
+    cache.restore_network(model, record)
@@ -0,0 +1,509 @@
+"""Species graphs, rule patterns and canonical labelling.
+
+A species is a connected graph of monomers ("agents"). Each agent has a
+state for every site that has states, and each site may be bonded to sites
+on other agents. Most sites carry at most one bond, but BioNetGen allows
+several (written ``pip2=[1, 2]`` in pysb), so a site holds a tuple of
+partners.
+
+Species are identified by a canonical label. Agents are first colored by
+iterated refinement of their name, states and neighborhood. A breadth-first
+traversal from an agent of the smallest color class, visiting sites in the
+monomer's declared site order and the partners of a multi-bond site in color
+order, is then serialized into a string; the smallest such string over all
+candidate roots is the label. Two species with equal labels are isomorphic.
+Conversely, isomorphic species get equal labels unless a multi-bond site has
+partners whose colors are equal but whose positions in the graph are not
+interchangeable, which does not occur in the networks built here.
+
+Patterns are the left and right hand sides of rules and observables. They
+are matched against species graphs by a small backtracking search that
+follows bonds wherever it can.
+"""
+
+import pysb
+
+# Bond requirements in a pattern site condition, besides tuples of explicit
+# bond labels.
+FREE = 'free'
+BOUND = 'bound'
+WILD = 'wild'
+
+
+class SpeciesGraph(object):
+    """A species as a graph of agents.
+
+    Parameters
+    ----------
+    names : list of str
+        Monomer name of each agent.
+    states : list of dict
+        For each agent, the state of each of its sites that has states.
+    bonds : dict
+        Maps (agent, site) to a tuple of (partner agent, partner site)
+        pairs. Must be symmetric; sites without bonds are omitted.
+    sites : dict
+        Maps monomer name to the tuple of its site names, in declared order.
+    """
+
+    __slots__ = ('names', 'states', 'bonds', 'sites', '_by_name', '_key')
+
+    def __init__(self, names, states, bonds, sites):
+        self.names = names
+        self.states = states
+        self.bonds = bonds
+        self.sites = sites
+        self._by_name = None
+        self._key = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def __repr__(self):
+        return 'SpeciesGraph(%r)' % self.key
+
+    @property
+    def by_name(self):
+        """Agent indexes grouped by monomer name."""
+        if self._by_name is None:
+            by_name = {}
+            for i, name in enumerate(self.names):
+                by_name.setdefault(name, []).append(i)
+            self._by_name = by_name
+        return self._by_name
+
+    @property
+    def key(self):
+        """Canonical label of this species."""
+        if self._key is None:
+            self._key = canonicalize(self)[0]
+        return self._key
+
+    def colors(self):
+        """Return a refined, labelling-independent color for each agent."""
+        signatures = [(name, sorted(self.states[a].items()),
+                       [len(self.bonds.get((a, site), ()))
+                        for site in self.sites[name]])
+                      for a, name in enumerate(self.names)]
+        colors = _rank(signatures)
+        classes = len(set(colors))
+        while True:
+            signatures = [
+                (colors[a], [sorted((colors[b], t) for b, t in
+                                    self.bonds.get((a, site), ()))
+                             for site in self.sites[name]])
+                for a, name in enumerate(self.names)]
+            refined = _rank(signatures)
+            refined_classes = len(set(refined))
+            if refined_classes == classes:
+                return refined
+            colors, classes = refined, refined_classes
+
+    def _serialize(self, root, colors):
+        """Return the traversal string and agent order starting at `root`."""
+        order = [root]
+        position = {root: 0}
+        bond_numbers = {}
+        parts = []
+        i = 0
+        while i < len(order):
+            a = order[i]
+            i += 1
+            name = self.names[a]
+            states = self.states[a]
+            site_parts = []
+            for site in self.sites[name]:
+                text = site
+                state = states.get(site)
+                if state is not None:
+                    text += '~' + state
+                partners = self.bonds.get((a, site), ())
+                if len(partners) > 1:
+                    partners = sorted(
+                        partners, key=lambda (b, t): (position.get(b, i + len(
+                            self.names)), colors[b], t))
+                for partner in partners:
+                    b = partner[0]
+                    if b not in position:
+                        position[b] = len(order)
+                        order.append(b)
+                    edge = frozenset([(a, site), partner])
+                    number = bond_numbers.get(edge)
+                    if number is None:
+                        number = bond_numbers[edge] = len(bond_numbers) + 1
+                    text += '!%d' % number
+                site_parts.append(text)
+            parts.append('%s(%s)' % (name, ','.join(site_parts)))
+        if len(order) != len(self.names):
+            raise ValueError("Species graph is not connected")
+        return '.'.join(parts), order
+
+    def relabel(self, order):
+        """Return a copy with agents renumbered so `order[i]` becomes `i`."""
+        position = dict((a, i) for i, a in enumerate(order))
+        bonds = dict(((position[a], s), tuple((position[b], t)
+                                              for b, t in partners))
+                     for (a, s), partners in self.bonds.items())
+        return SpeciesGraph([self.names[a] for a in order],
+                            [self.states[a] for a in order], bonds, self.sites)
+
+    def site_conditions(self):
+        """Return pysb-style site conditions for each agent.
+
+        Bonds are numbered from 1 in order of first appearance, as in
+        BioNetGen species strings.
+        """
+        numbers = {}
+        agents = []
+        for a, name in enumerate(self.names):
+            conditions = {}
+            for site in self.sites[name]:
+                state = self.states[a].get(site)
+                bond = [numbers.setdefault(frozenset([(a, site), partner]),
+                                           len(numbers) + 1)
+                        for partner in self.bonds.get((a, site), ())]
+                if not bond:
+                    bond = None
+                elif len(bond) == 1:
+                    bond = bond[0]
+                if state is not None and bond is not None:
+                    conditions[site] = (state, bond)
+                elif state is not None:
+                    conditions[site] = state
+                else:
+                    conditions[site] = bond
+            agents.append((name, conditions))
+        return agents
+
+
+def _rank(signatures):
+    """Replace each signature by its rank among the distinct signatures."""
+    ranks = dict((s, i) for i, s in
+                 enumerate(sorted(set(repr(s) for s in signatures))))
+    return [ranks[repr(s)] for s in signatures]
+
+
+def canonicalize(graph):
+    """Return the canonical label of `graph` and the agent order producing it.
+    """
+    colors = graph.colors()
+    first = min(colors)
+    best = None
+    for root, color in enumerate(colors):
+        if color != first:
+            continue
+        candidate = graph._serialize(root, colors)
+        if best is None or candidate[0] < best[0]:
+            best = candidate
+    return best
+
+
+def canonical_graph(graph):
+    """Return `graph` relabelled into canonical agent order."""
+    key, order = canonicalize(graph)
+    canonical = graph.relabel(order)
+    canonical._key = key
+    return canonical
+
+
+def monomer_sites(model):
+    """Return a dict mapping each monomer name in `model` to its sites."""
+    return dict((m.name, tuple(m.sites)) for m in model.monomers)
+
+
+def _bond_labels(bond):
+    if bond is None:
+        return ()
+    if isinstance(bond, list):
+        return tuple(bond)
+    if isinstance(bond, int):
+        return (bond,)
+    raise ValueError("Not a concrete bond: %r" % (bond,))
+
+
+def graph_from_conditions(agents, sites):
+    """Build a SpeciesGraph from (monomer name, site conditions) pairs.
+
+    The site conditions must be concrete, as in a species: a state, bond
+    labels, or both.
+    """
+    names = []
+    states = []
+    ends = {}
+    for a, (name, conditions) in enumerate(agents):
+        names.append(name)
+        agent_states = {}
+        for site, condition in dict(conditions).items():
+            bond = condition
+            if isinstance(condition, tuple):
+                agent_states[site], bond = condition
+            elif isinstance(condition, basestring):
+                agent_states[site], bond = condition, None
+            for label in _bond_labels(bond):
+                ends.setdefault(label, []).append((a, site))
+        states.append(agent_states)
+    bonds = {}
+    for label, pair in ends.items():
+        if len(pair) != 2:
+            raise ValueError("Dangling bond %d in species" % label)
+        bonds[pair[0]] = bonds.get(pair[0], ()) + (pair[1],)
+        bonds[pair[1]] = bonds.get(pair[1], ()) + (pair[0],)
+    return SpeciesGraph(names, states, bonds, sites)
+
+
+def species_graph(cp, sites):
+    """Build a SpeciesGraph from a fully specified pysb ComplexPattern."""
+    agents = []
+    for mp in cp.monomer_patterns:
+        if mp.compartment is not None:
+            raise NotImplementedError("Compartments are not supported")
+        agents.append((mp.monomer.name, mp.site_conditions))
+    return graph_from_conditions(agents, sites)
+
+
+def complex_pattern(graph, model):
+    """Build a pysb ComplexPattern from a SpeciesGraph."""
+    mps = [pysb.MonomerPattern(model.monomers[name], conditions, None)
+           for name, conditions in graph.site_conditions()]
+    return pysb.ComplexPattern(mps, None)
+
+
+class Pattern(object):
+    """A ComplexPattern compiled for matching against species graphs.
+
+    Each agent carries a dict of site conditions mapping site to a
+    (state, bond) pair. `state` is None when unconstrained. `bond` is FREE,
+    BOUND, WILD or a tuple of integer bond labels; the site must then carry
+    exactly that many bonds. A label shared with another site in the pattern
+    fixes the partner, while a label that appears only once just requires a
+    bond to something outside the pattern.
+    """
+
+    def __init__(self, names, conditions, match_once=False):
+        self.names = names
+        self.conditions = conditions
+        self.match_once = match_once
+        # Bond partners within the pattern.
+        ends = {}
+        for a, agent_conditions in enumerate(conditions):
+            for site, (state, bond) in agent_conditions.items():
+                if isinstance(bond, tuple):
+                    for label in bond:
+                        ends.setdefault(label, []).append((a, site))
+        self.partners = {}
+        for label, pair in sorted(ends.items()):
+            if len(pair) > 2:
+                raise ValueError("Bond %d joins more than two sites" % label)
+            if len(pair) == 2:
+                self.partners.setdefault(pair[0], []).append(pair[1])
+                self.partners.setdefault(pair[1], []).append(pair[0])
+        # Choose a search order that follows bonds, so most agents are
+        # reached through an already matched neighbor rather than by trying
+        # every agent of the right name.
+        self.order = []
+        self.anchors = {}
+        visited = set()
+        for start in range(len(names)):
+            if start in visited:
+                continue
+            visited.add(start)
+            queue = [start]
+            while queue:
+                a = queue.pop(0)
+                self.order.append(a)
+                for site in sorted(conditions[a]):
+                    for b, b_site in self.partners.get((a, site), ()):
+                        if b not in visited:
+                            visited.add(b)
+                            self.anchors[b] = (a, site, b_site)
+                            queue.append(b)
+        self.name_counts = {}
+        for name in names:
+            self.name_counts[name] = self.name_counts.get(name, 0) + 1
+
+    def __len__(self):
+        return len(self.names)
+
+    def _agent_matches(self, a, graph, ga):
+        if graph.names[ga] != self.names[a]:
+            return False
+        states = graph.states[ga]
+        for site, (state, bond) in self.conditions[a].items():
+            if state is not None and states.get(site) != state:
+                return False
+            if bond is WILD:
+                continue
+            count = len(graph.bonds.get((ga, site), ()))
+            if bond is FREE:
+                if count:
+                    return False
+            elif bond is BOUND:
+                if not count:
+                    return False
+            elif count != len(bond):
+                return False
+        return True
+
+    def could_match(self, graph):
+        """Cheap test on monomer counts before a full search."""
+        by_name = graph.by_name
+        for name, count in self.name_counts.items():
+            if len(by_name.get(name, ())) < count:
+                return False
+        return True
+
+    def embeddings(self, graph, first_only=False):
+        """Return all injective maps of this pattern into `graph`.
+
+        Each map is a tuple giving the graph agent for each pattern agent.
+        """
+        if not self.could_match(graph):
+            return []
+        results = []
+        n = len(self.names)
+        mapping = [None] * n
+        used = set()
+        order = self.order
+
+        def extend(k):
+            if k == n:
+                results.append(tuple(mapping))
+                return first_only
+            a = order[k]
+            anchor = self.anchors.get(a)
+            if anchor is not None:
+                b, b_site, a_site = anchor
+                candidates = [p for p, p_site in
+                              graph.bonds.get((mapping[b], b_site), ())
+                              if p_site == a_site]
+            else:
+                candidates = graph.by_name.get(self.names[a], ())
+            for ga in candidates:
+                if ga in used or not self._agent_matches(a, graph, ga):
+                    continue
+                # Check bonds to agents that are already placed.
+                ok = True
+                for site in self.conditions[a]:
+                    for b, b_site in self.partners.get((a, site), ()):
+                        if mapping[b] is not None and (mapping[b], b_site) \
+                                not in graph.bonds.get((ga, site), ()):
+                            ok = False
+                            break
+                    if not ok:
+                        break
+                if not ok:
+                    continue
+                mapping[a] = ga
+                used.add(ga)
+                if extend(k + 1):
+                    return True
+                used.discard(ga)
+                mapping[a] = None
+            return False
+
+        extend(0)
+        return results
+
+
+def _site_condition(condition):
+    """Translate a pysb site condition to a (state, bond) pair."""
+    if isinstance(condition, tuple):
+        state, bond = condition
+    elif isinstance(condition, basestring):
+        state, bond = condition, None
+    else:
+        state, bond = None, condition
+    if bond is None:
+        bond = FREE
+    elif bond is pysb.ANY:
+        bond = BOUND
+    elif bond is pysb.WILD:
+        bond = WILD
+    elif isinstance(bond, int):
+        bond = (bond,)
+    elif isinstance(bond, list) and all(isinstance(b, int) for b in bond):
+        bond = tuple(bond)
+    else:
+        raise NotImplementedError("Unsupported site condition: %r"
+                                  % (condition,))
+    return state, bond
+
+
+def compile_pattern(cp):
+    """Compile a pysb ComplexPattern (or MonomerPattern) into a Pattern."""
+    cp = pysb.core.as_complex_pattern(cp)
+    if cp.compartment is not None:
+        raise NotImplementedError("Compartments are not supported")
+    names = []
+    conditions = []
+    for mp in cp.monomer_patterns:
+        if mp.compartment is not None:
+            raise NotImplementedError("Compartments are not supported")
+        names.append(mp.monomer.name)
+        conditions.append(dict((site, _site_condition(c))
+                               for site, c in mp.site_conditions.items()))
+    return Pattern(names, conditions, cp.match_once)
+
+
+def _condition_signature(state, bond):
+    if isinstance(bond, tuple):
+        bond = len(bond)
+    return state, bond
+
+
+def automorphisms(names, conditions, partners, groups, forced=None):
+    """Generate the symmetries of a set of patterns.
+
+    An automorphism maps each agent to one with the same name and site
+    conditions, preserves bonds, and maps agents in the same group (complex
+    pattern) to agents in the same group. `partners` maps (agent, site) to
+    a list of (agent, site) bond partners. `forced` optionally fixes the
+    image of some agents. Each automorphism is yielded as a tuple giving the
+    image of every agent.
+    """
+    n = len(names)
+    signature = [(names[a], sorted((site,) + _condition_signature(*c)
+                                   for site, c in conditions[a].items()))
+                 for a in range(n)]
+    forced = forced or {}
+    mapping = [None] * n
+    used = set()
+    group_map = {}
+
+    def extend(a):
+        if a == n:
+            yield tuple(mapping)
+            return
+        candidates = [forced[a]] if a in forced else range(n)
+        for b in candidates:
+            if b in used or signature[b] != signature[a]:
+                continue
+            new_group = groups[a] not in group_map
+            if new_group:
+                if groups[b] in group_map.values():
+                    continue
+            elif group_map[groups[a]] != groups[b]:
+                continue
+            ok = True
+            for site in conditions[a]:
+                for c, c_site in partners.get((a, site), ()):
+                    if mapping[c] is not None and (mapping[c], c_site) \
+                            not in partners.get((b, site), ()):
+                        ok = False
+                        break
+                if not ok:
+                    break
+            if not ok:
+                continue
+            if new_group:
+                group_map[groups[a]] = groups[b]
+            mapping[a] = b
+            used.add(b)
+            for result in extend(a + 1):
+                yield result
+            used.discard(b)
+            mapping[a] = None
+            if new_group:
+                del group_map[groups[a]]
+
+    return extend(0)
@@ -0,0 +1,103 @@
+"""Constant-time lookup of species by structure.
+
+Finding a ComplexPattern among a model's generated species with
+ComplexPattern.is_equivalent_to means a graph-isomorphism test per species,
+so resolving many patterns costs O(species^2) isomorphism tests. Here each
+species is reduced once to its canonical label (see rasmodel.network.graph),
+and lookups are dict accesses::
+
+    from rasmodel.network.index import species_index
+    index = species_index(model)
+    i = index[initial_condition_pattern]
+"""
+
+import numbers
+import weakref
+from . import graph as ng
+
+
+def _sites(cp):
+    return dict((mp.monomer.name, tuple(mp.monomer.sites))
+                for mp in cp.monomer_patterns)
+
+
+def canonical_key(cp):
+    """Return the canonical label of a fully specified ComplexPattern.
+
+    Two concrete species have the same label if and only if they are
+    equivalent.
+    """
+    return ng.species_graph(cp, _sites(cp)).key
+
+
+class SpeciesIndex(object):
+    """Maps species patterns to their position in a list of species.
+
+    Supports ``index[cp]`` (raising KeyError), ``index.get(cp)``,
+    ``cp in index`` and ``index.key(cp)``.
+    """
+
+    def __init__(self, species):
+        self.species = species
+        self.keys = [canonical_key(cp) for cp in species]
+        self._positions = {}
+        for i, key in enumerate(self.keys):
+            self._positions.setdefault(key, i)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def key(self, cp):
+        """Return the canonical label of `cp`."""
+        return canonical_key(cp)
+
+    def __getitem__(self, cp):
+        try:
+            return self._positions[canonical_key(cp)]
+        except KeyError:
+            raise KeyError("Species not found: %s" % cp)
+
+    def get(self, cp, default=None):
+        return self._positions.get(canonical_key(cp), default)
+
+    def __contains__(self, cp):
+        return canonical_key(cp) in self._positions
+
+
+_indexes = weakref.WeakKeyDictionary()
+
+
+def species_index(model):
+    """Return a SpeciesIndex of the generated species of `model`.
+
+    The index is built on first use and rebuilt only when the model's
+    network is regenerated.
+    """
+    index = _indexes.get(model)
+    if index is None or index.species is not model.species or \
+            len(index) != len(model.species):
+        index = _indexes[model] = SpeciesIndex(model.species)
+    return index
+
+
+def species_indexes(model, species):
+    """Resolve a list of species to their indexes in model.species.
+
+    Items may be species indexes, ComplexPatterns, or MonomerPatterns and
+    Monomers standing for single-monomer species. Patterns must be concrete
+    and present in the generated network.
+    """
+    import pysb
+    from pysb.core import as_complex_pattern
+    index = species_index(model)
+    indexes = []
+    for s in species:
+        if isinstance(s, numbers.Integral):
+            if not 0 <= s < len(model.species):
+                raise IndexError("Species index out of range: %d" % s)
+            indexes.append(s)
+            continue
+        if isinstance(s, pysb.Monomer):
+            s = s()
+        indexes.append(index[as_complex_pattern(s)])
+    return indexes
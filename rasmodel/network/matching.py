@@ -0,0 +1,244 @@
+"""Structural matching of the species and reactions of two networks.
+
+Comparing two versions of a model, or a PySB model with the SBML it was
+ported from, means pairing up their species and reactions. Rather than
+rewriting names into a common form and aligning sorted lists, every species
+is reduced to a hashable structural signature and the two sides are joined
+on equal signatures, so matching is linear in the number of species:
+
+- the composition of a species is the multiset of its monomers, each with
+  its site states (phosphorylation, compartment, ...);
+- its graph signature is the canonical label of rasmodel.network.graph,
+  which adds the bond graph.
+
+Reactions are then joined on their reactants and products, translated to
+the other side through the species matching, regardless of which side is
+written first::
+
+    from rasmodel.network import matching
+    result = matching.compare_models(old_model, new_model)
+    result.species.unmatched_right    # species only the new model has
+    result.reactions.unmatched_left   # reactions only the old model has
+
+Matchings are stored with the network cache (see rasmodel.network.cache)
+under a key of both networks, so repeated comparisons are a single unpickle.
+"""
+
+import collections
+import hashlib
+from . import cache
+from . import graph as ng
+
+# Bump this whenever matching results or the record layout change.
+MATCHING_VERSION = 1
+
+
+class Matching(object):
+    """The result of join().
+
+    Attributes
+    ----------
+    left_to_right, right_to_left : dict
+        Matched positions of one side to those of the other.
+    ambiguous : list of (list, list)
+        Groups of left and right positions sharing a signature that could
+        not be paired one to one.
+    unmatched_left, unmatched_right : list of int
+        Positions whose signature the other side does not have.
+    reversed : set of int
+        Left positions of reactions matched in the opposite direction (see
+        match_reactions()).
+    """
+
+    def __init__(self, left_to_right, ambiguous, unmatched_left,
+                 unmatched_right, reversed=()):
+        self.left_to_right = left_to_right
+        self.right_to_left = dict((j, i) for i, j in left_to_right.items())
+        self.ambiguous = ambiguous
+        self.unmatched_left = unmatched_left
+        self.unmatched_right = unmatched_right
+        self.reversed = set(reversed)
+
+    @property
+    def complete(self):
+        """Whether every item on both sides is matched."""
+        return not (self.ambiguous or self.unmatched_left or
+                    self.unmatched_right)
+
+    def record(self):
+        """Return the matching as a picklable dict."""
+        return {'left_to_right': self.left_to_right,
+                'ambiguous': self.ambiguous,
+                'unmatched_left': self.unmatched_left,
+                'unmatched_right': self.unmatched_right,
+                'reversed': sorted(self.reversed)}
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(record['left_to_right'], record['ambiguous'],
+                   record['unmatched_left'], record['unmatched_right'],
+                   record['reversed'])
+
+    def __str__(self):
+        return ('%d matched, %d ambiguous groups, %d left only, %d right only'
+                % (len(self.left_to_right), len(self.ambiguous),
+                   len(self.unmatched_left), len(self.unmatched_right)))
+
+
+def join(left, right):
+    """Match two lists of signatures by equality.
+
+    Positions with a signature that occurs exactly once on each side are
+    matched; a None signature never matches.
+
+    Returns
+    -------
+    Matching
+    """
+    groups = collections.OrderedDict()
+    for side, signatures in enumerate((left, right)):
+        for i, signature in enumerate(signatures):
+            if signature is not None:
+                groups.setdefault(signature, ([], []))[side].append(i)
+    left_to_right = {}
+    ambiguous = []
+    for lefts, rights in groups.values():
+        if len(lefts) == 1 and len(rights) == 1:
+            left_to_right[lefts[0]] = rights[0]
+        elif lefts and rights:
+            ambiguous.append((lefts, rights))
+    grouped = set(i for lefts, rights in ambiguous for i in lefts)
+    unmatched_left = [i for i in range(len(left))
+                      if i not in left_to_right and i not in grouped]
+    matched = set(left_to_right.values())
+    grouped = set(j for lefts, rights in ambiguous for j in rights)
+    unmatched_right = [j for j in range(len(right))
+                       if j not in matched and j not in grouped]
+    return Matching(left_to_right, ambiguous, unmatched_left,
+                    unmatched_right)
+
+
+def composition(names, states):
+    """Return the composition signature of a species.
+
+    `names` are the monomer names of its agents and `states` their site
+    states as dicts, as in a SpeciesGraph.
+    """
+    return tuple(sorted((name, tuple(sorted(agent_states.items())))
+                        for name, agent_states in zip(names, states)))
+
+
+def species_signatures(model, level='graph'):
+    """Return a signature of each generated species of `model`.
+
+    `level` is 'graph' for the canonical labels (including the bond graph)
+    or 'composition'.
+    """
+    sites = ng.monomer_sites(model)
+    graphs = [ng.species_graph(cp, sites) for cp in model.species]
+    if level == 'graph':
+        return [g.key for g in graphs]
+    if level == 'composition':
+        return [composition(g.names, g.states) for g in graphs]
+    raise ValueError("Unknown signature level: %s" % level)
+
+
+def reaction_signature(reactants, products, species):
+    """Return the signature of a reaction on the other side, and whether it
+    is written in reverse.
+
+    `species` maps species of this side to the other; the signature is None
+    if a species is not mapped. Reactions written in either direction get
+    the same signature.
+    """
+    try:
+        sides = (tuple(sorted(species[i] for i in reactants)),
+                 tuple(sorted(species[i] for i in products)))
+    except KeyError:
+        return None, False
+    if sides[1] < sides[0]:
+        return (sides[1], sides[0]), True
+    return sides, False
+
+
+def match_reactions(left, right, species):
+    """Match two lists of (reactants, products) species tuples.
+
+    `species` maps left species to right species, e.g. the left_to_right
+    of a species matching.
+
+    Returns
+    -------
+    Matching
+        With the left reactions matched in the opposite direction in
+        `reversed`.
+    """
+    identity = dict((j, j) for r in right for side in r for j in side)
+    left_signatures = [reaction_signature(reactants, products, species)
+                       for reactants, products in left]
+    right_signatures = [reaction_signature(reactants, products, identity)
+                        for reactants, products in right]
+    result = join([s for s, flipped in left_signatures],
+                  [s for s, flipped in right_signatures])
+    result.reversed = set(i for i, j in result.left_to_right.items()
+                          if left_signatures[i][1] != right_signatures[j][1])
+    return result
+
+
+def network_key(model):
+    """Return a digest of the generated network of `model`."""
+    h = hashlib.sha1()
+    h.update(cache.model_hash(model))
+    for cp in model.species:
+        h.update('\n%s' % cp)
+    return h.hexdigest()
+
+
+def cached(key, compute, cache_dir=None):
+    """Return the dict of Matchings cached under `key`, computing and
+    storing it with `compute()` if absent."""
+    key = 'matching-%d-%s' % (MATCHING_VERSION, key)
+    record = cache.load(key, cache_dir)
+    if record is not None:
+        return dict((name, Matching.from_record(r))
+                    for name, r in record['matchings'].items())
+    matchings = compute()
+    cache.store(key, {'version': cache.CACHE_VERSION,
+                      'matchings': dict((name, m.record())
+                                        for name, m in matchings.items())},
+                cache_dir)
+    return matchings
+
+
+ModelMatching = collections.namedtuple('ModelMatching', 'species reactions')
+
+
+def compare_models(left, right, level='graph', cache_dir=None):
+    """Match the species and reactions of two PySB models.
+
+    Both networks are generated if needed. Species are joined on their
+    `level` signatures (see species_signatures()) and reactions, from
+    reactions_bidirectional, on their matched species.
+
+    Returns
+    -------
+    ModelMatching
+        Of the species and of the reactions, with `left` on the left.
+    """
+    cache.generate_equations(left)
+    cache.generate_equations(right)
+
+    def compute():
+        species = join(species_signatures(left, level),
+                       species_signatures(right, level))
+        reactions = match_reactions(
+            [(r['reactants'], r['products'])
+             for r in left.reactions_bidirectional],
+            [(r['reactants'], r['products'])
+             for r in right.reactions_bidirectional],
+            species.left_to_right)
+        return {'species': species, 'reactions': reactions}
+
+    key = '%s-%s-%s' % (level, network_key(left), network_key(right))
+    matchings = cached(hashlib.sha1(key).hexdigest(), compute, cache_dir)
+    return ModelMatching(matchings['species'], matchings['reactions'])
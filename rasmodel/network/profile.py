@@ -0,0 +1,168 @@
+"""Per-rule profiling of network generation.
+
+Expands a model's rules with rasmodel.network.generate and attributes the
+reactant tuples examined, species and reactions created, wall time and
+number of iterations to each rule. Rules can be mapped to the component
+function that declared them (see rasmodel.chen_2009.rule_origins), and the
+profile rolls up to those functions and to their modules.
+
+If expansion exceeds the size limits, the profile of the partial network is
+still returned, so the rules responsible for the explosion are visible::
+
+    from rasmodel import chen_2009
+    from rasmodel.network.profile import profile_network
+    profile = profile_network(chen_2009.model,
+                              chen_2009.rule_origins(chen_2009.model))
+    profile.report()
+"""
+
+import sys
+import time
+import collections
+from . import generate
+
+UNKNOWN_ORIGIN = '?'
+
+
+class Stats(object):
+    """Network generation statistics for a rule or a group of rules."""
+
+    def __init__(self, name, origin=UNKNOWN_ORIGIN):
+        self.name = name
+        self.origin = origin
+        self.tuples = 0
+        self.species = 0
+        self.reactions = 0
+        self.seconds = 0.0
+        self.iterations = set()
+
+    def __repr__(self):
+        return ('<%s %s: %d species, %d reactions, %.3fs>' %
+                (self.__class__.__name__, self.name, self.species,
+                 self.reactions, self.seconds))
+
+    @property
+    def last_iteration(self):
+        """The last iteration in which this rule created anything."""
+        return max(self.iterations) if self.iterations else 0
+
+    def add(self, other):
+        self.tuples += other.tuples
+        self.species += other.species
+        self.reactions += other.reactions
+        self.seconds += other.seconds
+        self.iterations |= other.iterations
+
+
+class NetworkProfile(object):
+    """The result of profile_network.
+
+    Attributes
+    ----------
+    rules : OrderedDict
+        Stats for each rule, by rule name, in model order.
+    species, reactions, iterations : int
+        Size of the generated (possibly partial) network, and the number of
+        expansion iterations.
+    seconds : float
+        Total wall time.
+    error : NetworkSizeError or None
+        Set if expansion was stopped by the size limits.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.species = 0
+        self.reactions = 0
+        self.iterations = 0
+        self.seconds = 0.0
+        self.error = None
+
+    def _rollup(self, key):
+        groups = collections.OrderedDict()
+        for stats in self.rules.values():
+            name = key(stats)
+            group = groups.get(name)
+            if group is None:
+                group = groups[name] = Stats(name)
+            group.add(stats)
+        return groups
+
+    def by_origin(self):
+        """Stats summed over the rules of each component function."""
+        return self._rollup(lambda s: s.origin)
+
+    def by_module(self):
+        """Stats summed over the rules of each component module."""
+        return self._rollup(lambda s: s.origin.split('.')[0])
+
+    def report(self, out=sys.stdout, limit=20, sort='species'):
+        """Print the top `limit` rules, functions and modules.
+
+        `sort` is the Stats attribute to rank by: 'species', 'reactions',
+        'seconds' or 'tuples'.
+        """
+        status = 'complete'
+        if self.error is not None:
+            status = 'STOPPED: %s' % self.error
+        print >> out, ('Network: %d species, %d reactions, %d iterations, '
+                       '%.2fs (%s)' % (self.species, self.reactions,
+                                       self.iterations, self.seconds, status))
+        for title, groups in [('Modules', self.by_module()),
+                              ('Component functions', self.by_origin()),
+                              ('Rules', self.rules)]:
+            ranked = sorted(groups.values(), key=lambda s: getattr(s, sort),
+                            reverse=True)
+            print >> out
+            print >> out, '%-40s %8s %9s %10s %8s %5s' % (
+                title, 'species', 'reactions', 'tuples', 'seconds', 'iter')
+            for stats in ranked[:limit]:
+                line = '%-40s %8d %9d %10d %8.3f %5d' % (
+                    stats.name, stats.species, stats.reactions, stats.tuples,
+                    stats.seconds, stats.last_iteration)
+                if groups is self.rules:
+                    line += '  ' + stats.origin
+                print >> out, line
+
+
+def profile_network(model, origins=None, max_iterations=None,
+                    max_species=None):
+    """Expand the rules of `model` and return a NetworkProfile.
+
+    Parameters
+    ----------
+    model : pysb.Model
+        Model to expand. Its generated-network attributes are not modified.
+    origins : dict, optional
+        Maps rule names to the component function that declared them, as
+        'module.function'.
+    max_iterations, max_species : int, optional
+        Limits on the expansion, as for generate.generate_network.
+    """
+    origins = origins or {}
+    rules = collections.OrderedDict(
+        (r.name, Stats(r.name, origins.get(r.name, UNKNOWN_ORIGIN)))
+        for r in model.rules)
+
+    def observer(template, iteration, tuples, species, reactions, seconds):
+        stats = rules[template.name]
+        stats.tuples += tuples
+        stats.species += species
+        stats.reactions += reactions
+        stats.seconds += seconds
+        if species or reactions:
+            stats.iterations.add(iteration)
+
+    profile = NetworkProfile(rules)
+    started = time.time()
+    try:
+        expansion = generate._expand_full(model, observer, max_iterations,
+                                          max_species)
+    except generate.NetworkSizeError as e:
+        profile.error = e
+        expansion = e.expansion
+    profile.seconds = time.time() - started
+    profile.species = len(expansion.species)
+    profile.reactions = len(expansion.reactions)
+    profile.iterations = expansion.iteration
+    return profile
@@ -0,0 +1,67 @@
+"""Reachability of species from an initial state.
+
+A species that starts at zero becomes nonzero only if some reaction that
+produces it fires, and a mass-action reaction fires only if all of its
+reactants are nonzero. Propagating this from the species that are nonzero
+initially finds every species that can ever be nonzero; the rest stay
+identically zero, as do the fluxes of the reactions that consume them. For
+example, with HRG_0 = 0 the whole HRG branch of the Chen 2009 model is
+unreachable::
+
+    from rasmodel.network.reachability import reachable
+    species, reactions = reachable(model, y0 != 0)
+"""
+
+import numpy as np
+
+
+def reachable(model, seeds):
+    """Find the species and reactions of `model` that can become active.
+
+    Parameters
+    ----------
+    model : pysb.Model
+        Model with its network generated.
+    seeds : vector-like of bool or list of int
+        Species that are nonzero initially (or otherwise held nonzero), as
+        a mask over model.species or a list of indexes.
+
+    Returns
+    -------
+    species : numpy.ndarray of bool
+        Species that can ever be nonzero.
+    reactions : numpy.ndarray of bool
+        Reactions that can ever have nonzero flux.
+    """
+    n = len(model.species)
+    seeds = np.asarray(seeds)
+    species = np.zeros(n, dtype=bool)
+    if seeds.dtype == bool:
+        species[:] = seeds
+    else:
+        species[seeds.astype(int)] = True
+    reactions = np.zeros(len(model.reactions), dtype=bool)
+    # Number of distinct reactants of each reaction not yet reachable.
+    missing = [len(set(r['reactants'])) for r in model.reactions]
+    consumers = [[] for i in range(n)]
+    for j, r in enumerate(model.reactions):
+        for i in set(r['reactants']):
+            consumers[i].append(j)
+    for i in np.nonzero(species)[0]:
+        for j in consumers[i]:
+            missing[j] -= 1
+    queue = [j for j, count in enumerate(missing) if count == 0]
+    while queue:
+        j = queue.pop()
+        if reactions[j]:
+            continue
+        reactions[j] = True
+        for i in model.reactions[j]['products']:
+            if species[i]:
+                continue
+            species[i] = True
+            for c in consumers[i]:
+                missing[c] -= 1
+                if missing[c] == 0:
+                    queue.append(c)
+    return species, reactions
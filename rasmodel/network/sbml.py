@@ -0,0 +1,635 @@
+"""Streaming loader for SBML Level 2 and 3 reaction networks.
+
+Literature models of the Ras and ErbB pathways are published as SBML, some
+with tens of thousands of reactions. This module reads their species,
+parameters and reactions into the compact Species, Parameter and Reaction
+tuples of a Model, which rasmodel.chen_2009.sbml_simulation turns into the
+arrays of the fast simulator. The file is read with one lxml iterparse pass
+that frees every element once it has been read, so memory use does not grow
+with the size of the XML tree, only with the number of components kept::
+
+    from rasmodel.network import sbml
+    model = sbml.load('BIOMD0000000255.xml')
+    model.unrecognized    # reactions left out, with the reason
+
+Files differ in where they keep human readable names. A Convention decides
+the name, label and compartment of each species, the name of each parameter,
+and the name and label of each reaction; subclass it for a particular file
+(rasmodel.chen_2009.original_sbml.ChenConvention is one). The default uses
+the SBML ids as names, and the SBML names as labels.
+
+Rate constants are recognized from the kinetic laws, which must be mass
+action: a sum of at most two products, one of a single parameter and the
+reactants (with multiplicity), and, subtracted, one of a single parameter
+and the products. Local parameters become parameters named
+'<reaction id>_<local id>'. Reactions with any other kinetic law, or with
+non-integer stoichiometry, are left out and listed in Model.unrecognized.
+Irreversible reactions get the shared zero parameter '_zero' as their
+reverse rate constant. Initial assignments, rules and events are ignored.
+
+Species values are amounts: the initial amount, or else the initial
+concentration times the size of the compartment. A kinetic law gives the
+rate in amounts per time of species concentrations, so a term
+c * k * A * B, where c collects the numeric and compartment factors,
+becomes the mass action flux kf_scale * k * a * b of the amounts a and b,
+with kf_scale = c / (V_A * V_B), and likewise kr_scale for the reverse
+term. Species with hasOnlySubstanceUnits stand for their amount in the
+law and are not divided by their compartment size.
+
+Parsed models are cached with the network cache (see rasmodel.network.cache),
+keyed by a hash of the file and the convention.
+"""
+
+import collections
+import hashlib
+import inspect
+import numpy as np
+import lxml.etree
+from . import cache
+
+# Bump this whenever the layout of the parsed records changes.
+PARSED_VERSION = 3
+
+
+def simple_repr(x):
+    fields = list(x._fields)
+    fields.remove('id')
+    fields_repr = ', '.join('{0}={1!r}'.format(f, getattr(x, f))
+                            for f in fields)
+    return '{0}({1})'.format(type(x).__name__, fields_repr)
+
+class Species(collections.namedtuple(
+        'SpeciesBase',
+        'id name label compartment initial_amount constant')):
+
+    __repr__ = simple_repr
+
+    def __str__(self):
+        return self.name
+
+class Parameter(collections.namedtuple(
+        'ParameterBase',
+        'id name value constant notes')):
+
+    __repr__ = simple_repr
+
+    def __str__(self):
+        return self.name
+
+class Reaction(collections.namedtuple(
+        'ReactionBase',
+        'id name label reactants products kf kr kf_scale kr_scale')):
+    """A reaction with mass action fluxes kf_scale * kf * reactants and
+    kr_scale * kr * products, in species amounts."""
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        simple_attrs = ('name', 'label')
+        simple_attr_repr = ', '.join('{0}={1!r}'.format(a, getattr(self, a))
+                                     for a in simple_attrs)
+        species_repr = ', '.join(
+            ['{0}=({1})'.format(et, ', '.join(s.name for s in getattr(self, et)))
+             for et in 'reactants', 'products'])
+        param_repr = ', '.join(['{0}={1}'.format(pt, getattr(self, pt))
+                                for pt in 'kf', 'kr'])
+        return '{0}({1}, {2}, {3})'.format(type(self).__name__,
+                                           simple_attr_repr, species_repr,
+                                           param_repr)
+
+class Model(collections.namedtuple(
+        'ModelBase',
+        'species parameters reactions')):
+    """The species, parameters and reactions of an SBML model.
+
+    Lookups by name, id, label and compartment, and the reactions consuming
+    and producing each species, go through hash indexes built on first use
+    (load_model() builds them right away). Call build_indexes() after
+    modifying the lists.
+
+    `unrecognized` lists the (id, reason) of the reactions the loader left
+    out.
+    """
+
+    unrecognized = ()
+
+    def build_indexes(self):
+        """Build the lookup indexes from the current lists."""
+        self._species_by_name = {}
+        self._species_by_id = {}
+        self._species_by_label = collections.defaultdict(list)
+        self._species_by_compartment = collections.defaultdict(list)
+        for s in self.species:
+            self._species_by_name[s.name] = s
+            self._species_by_id[s.id] = s
+            self._species_by_label[s.label].append(s)
+            self._species_by_compartment[s.compartment].append(s)
+        self._parameters_by_name = dict((p.name, p) for p in self.parameters)
+        self._reactions_by_name = dict((r.name, r) for r in self.reactions)
+        self._consumers = collections.defaultdict(list)
+        self._producers = collections.defaultdict(list)
+        for r in self.reactions:
+            for s in set(r.reactants):
+                self._consumers[s.name].append(r)
+            for s in set(r.products):
+                self._producers[s.name].append(r)
+        # Label pattern -> matching species, filled in by queries.
+        self._pattern_matches = {}
+
+    def _indexes(self):
+        if '_species_by_name' not in self.__dict__:
+            self.build_indexes()
+        return self
+
+    def species_by_name(self, name):
+        """Return the species named `name` (KeyError if there is none)."""
+        return self._indexes()._species_by_name[name]
+
+    def species_by_id(self, species_id):
+        """Return the species with SBML id `species_id`."""
+        return self._indexes()._species_by_id[species_id]
+
+    def parameter_by_name(self, name):
+        return self._indexes()._parameters_by_name[name]
+
+    def reaction_by_name(self, name):
+        return self._indexes()._reactions_by_name[name]
+
+    def species_by_label(self, pattern, multi=False):
+        """Return the species with label `pattern`.
+
+        A string is matched exactly; a compiled regular expression is
+        searched for in every label, and its matches are remembered. Returns
+        the first species, or the list of all of them if `multi` is True.
+        """
+        self._indexes()
+        if isinstance(pattern, basestring):
+            matches = self._species_by_label.get(pattern, [])
+        else:
+            key = (pattern.pattern, pattern.flags)
+            matches = self._pattern_matches.get(key)
+            if matches is None:
+                matches = self._pattern_matches[key] = [
+                    s for s in self.species if pattern.search(s.label)]
+        if multi:
+            return list(matches)
+        if not matches:
+            raise StopIteration
+        return matches[0]
+
+    def species_in_compartment(self, compartment):
+        """Return the species in `compartment` (as in Species.compartment).
+        """
+        return list(self._indexes()._species_by_compartment.get(compartment,
+                                                                 []))
+
+    def consuming_reactions(self, species):
+        """Return the reactions with `species` (or its name) as a reactant.
+        """
+        return list(self._indexes()._consumers.get(str(species), []))
+
+    def producing_reactions(self, species):
+        """Return the reactions with `species` (or its name) as a product.
+        """
+        return list(self._indexes()._producers.get(str(species), []))
+
+    def neighbors(self, species):
+        """Return the species sharing a reaction with `species`."""
+        name = str(species)
+        result = collections.OrderedDict()
+        for r in (self.consuming_reactions(name) +
+                  self.producing_reactions(name)):
+            for s in r.reactants + r.products:
+                if s.name != name:
+                    result[s.name] = s
+        return result.values()
+
+    def export_globals(self, dest=None):
+        if dest is None:
+            dest = inspect.currentframe().f_back.f_globals
+        # First collect elements in a dict rather than updating the dest
+        # namespace directly. This lets us raise an exception if there's a
+        # duplicate without leaving the dest namespace in a partially updated
+        # state.
+        elements = {}
+        for container in self:
+            for elt in container:
+                if elt.name in elements:
+                    raise RuntimeError('duplicate component name: {}'
+                                       .format(elt.name))
+                elements[elt.name] = elt
+        # Now that we're sure there are no duplicates, update the namespace in
+        # one shot.
+        dest.update(elements)
+
+    def get_duplicate_names(self):
+        names = set()
+        duplicates = set()
+        for container in self:
+            for elt in container:
+                if elt.name in names:
+                    duplicates.add(elt.name)
+                else:
+                    names.add(elt.name)
+        return duplicates
+
+
+class Convention(object):
+    """How names and labels are read from the SBML elements.
+
+    Methods receive the element's attributes as a dict; `notes` is the text
+    of its notes and `annotation` the text directly inside its annotation,
+    stripped, or None.
+    """
+
+    #: Identifies the convention in the cache key; change it along with the
+    #: behavior of a subclass.
+    key = 'default'
+
+    def species(self, attributes, notes, annotation):
+        """Return the (name, label, compartment) of a species."""
+        return (attributes['id'], attributes.get('name', attributes['id']),
+                attributes.get('compartment'))
+
+    def parameter(self, attributes, notes, annotation):
+        """Return the name of a global parameter."""
+        return attributes['id']
+
+    def reaction(self, attributes, notes, annotation):
+        """Return the (name, label, kf, kr) of a reaction.
+
+        kf and kr are parameter names, or None to recognize the rate
+        constants from the kinetic law.
+        """
+        return (attributes['id'], attributes.get('name', attributes['id']),
+                None, None)
+
+
+class UnsupportedKineticLaw(ValueError):
+    """A kinetic law that is not recognized as mass action."""
+
+
+def _local(tag):
+    """Return `tag` without its namespace."""
+    return tag.rpartition('}')[2]
+
+
+def _children(element):
+    return [child for child in element if isinstance(child.tag, basestring)]
+
+
+def _child(element, name):
+    for child in element.iterchildren('{*}' + name):
+        return child
+    return None
+
+
+def _notes(element):
+    notes = _child(element, 'notes')
+    if notes is None:
+        return None
+    return ' '.join(t.strip() for t in notes.itertext() if t.strip())
+
+
+def _annotation(element):
+    annotation = _child(element, 'annotation')
+    if annotation is None or annotation.text is None:
+        return None
+    return annotation.text.strip()
+
+
+def _boolean(value, default, what):
+    if value is None:
+        return default
+    if value in ('true', '1'):
+        return True
+    if value in ('false', '0'):
+        return False
+    raise RuntimeError('bad {} value: {}'.format(what, value))
+
+
+def _number(cn):
+    """Return the value of a MathML <cn> element."""
+    kind = cn.get('type', 'real')
+    if kind in ('e-notation', 'rational'):
+        (sep,) = _children(cn)
+        a, b = float(cn.text), float(sep.tail)
+        return a * 10 ** b if kind == 'e-notation' else a / b
+    return float(cn.text)
+
+
+def _expand(node):
+    """Expand MathML `node` into a list of (coefficient, names) products.
+    """
+    tag = _local(node.tag)
+    if tag == 'ci':
+        return [(1.0, [node.text.strip()])]
+    if tag == 'cn':
+        return [(_number(node), [])]
+    if tag == 'semantics':
+        return _expand(_children(node)[0])
+    if tag != 'apply':
+        raise UnsupportedKineticLaw('unsupported MathML element <%s>' % tag)
+    children = _children(node)
+    op = _local(children[0].tag)
+    args = [_expand(child) for child in children[1:]]
+    if op == 'times':
+        terms = [(1.0, [])]
+        for arg in args:
+            terms = [(c1 * c2, n1 + n2) for c1, n1 in terms for c2, n2 in arg]
+        return terms
+    if op == 'plus':
+        return sum(args, [])
+    if op == 'minus':
+        negated = [(-c, names) for c, names in args[-1]]
+        return args[0] + negated if len(args) == 2 else negated
+    if op in ('divide', 'power') and len(args[1]) == 1 and \
+            not args[1][0][1]:
+        value = args[1][0][0]
+        if op == 'divide':
+            return [(c / value, names) for c, names in args[0]]
+        if value == int(value) and value >= 0 and len(args[0]) == 1:
+            c, names = args[0][0]
+            return [(c ** value, names * int(value))]
+    raise UnsupportedKineticLaw('unsupported MathML operator <%s>' % op)
+
+
+def mass_action(terms, reactants, products, lookup):
+    """Return the forward and reverse rate constants of a kinetic law.
+
+    `terms` is the expanded kinetic law, `reactants` and `products` the
+    species ids with multiplicity, and `lookup` maps an identifier to
+    ('species', id), ('parameter', position) or ('compartment', size), or
+    None. Returns (kf, kr, kf_scale, kr_scale): the rate constants and the
+    products of the numeric and compartment factors multiplying them in
+    the law. kr is None for an irreversible law. Raises
+    UnsupportedKineticLaw if the law is not mass action.
+    """
+    forward = reverse = None
+    forward_scale = reverse_scale = 1.0
+    for coefficient, names in terms:
+        species = []
+        constants = []
+        for name in names:
+            kind, value = lookup(name) or (None, None)
+            if kind == 'species':
+                species.append(value)
+            elif kind == 'parameter':
+                constants.append(value)
+            elif kind == 'compartment':
+                coefficient *= value
+            else:
+                raise UnsupportedKineticLaw('unknown identifier %s' % name)
+        if len(constants) != 1:
+            raise UnsupportedKineticLaw('terms must have one rate constant')
+        if not np.isfinite(coefficient) or coefficient == 0:
+            raise UnsupportedKineticLaw('factor %g' % coefficient)
+        species.sort()
+        if coefficient > 0 and forward is None and \
+                species == sorted(reactants):
+            forward, forward_scale = constants[0], coefficient
+        elif coefficient < 0 and reverse is None and \
+                species == sorted(products):
+            reverse, reverse_scale = constants[0], -coefficient
+        else:
+            raise UnsupportedKineticLaw('terms do not match the reactants '
+                                        'and products')
+    if forward is None:
+        raise UnsupportedKineticLaw('no forward term')
+    return forward, reverse, forward_scale, reverse_scale
+
+
+def _references(reaction, tag):
+    """Return the species ids of a list of species references, each
+    repeated by its stoichiometry."""
+    container = _child(reaction, tag)
+    if container is None:
+        return []
+    species = []
+    for ref in _children(container):
+        if _child(ref, 'stoichiometryMath') is not None:
+            raise UnsupportedKineticLaw('stoichiometryMath')
+        stoichiometry = float(ref.get('stoichiometry', 1))
+        if stoichiometry != int(stoichiometry) or stoichiometry < 0:
+            raise UnsupportedKineticLaw('stoichiometry %g' % stoichiometry)
+        species.extend([ref.get('species')] * int(stoichiometry))
+    return species
+
+
+# Elements the parser looks at, in any namespace: the components, and the
+# other parts of the model, which are only freed.
+_tags = tuple('{*}' + tag for tag in (
+    'compartment', 'species', 'parameter', 'reaction', 'notes',
+    'annotation', 'listOfFunctionDefinitions', 'listOfUnitDefinitions',
+    'listOfCompartmentTypes', 'listOfSpeciesTypes', 'listOfCompartments',
+    'listOfSpecies', 'listOfParameters', 'listOfInitialAssignments',
+    'listOfRules', 'listOfConstraints', 'listOfReactions', 'listOfEvents',
+    'model'))
+
+
+def parse(f, convention=None):
+    """Parse SBML from file object `f` into a record of plain tuples.
+
+    Species, parameters and reactions are read in a single streaming pass,
+    clearing each element once read; reactions refer to species and
+    parameters by position. The record can be pickled and turned into a
+    Model by model_from_record(). `convention` defaults to Convention().
+    """
+    if convention is None:
+        convention = Convention()
+    species = []
+    parameters = []
+    reactions = []
+    unrecognized = []
+    species_index = {}
+    # Size of the compartment each species' concentration is taken in, or 1
+    # for species that stand for their amount.
+    species_sizes = {}
+    parameter_index = {}
+    parameter_names = {}
+    compartments = {}
+    checked = False
+    for event, element in lxml.etree.iterparse(f, tag=_tags):
+        if not checked:
+            root = element.getroottree().getroot()
+            if _local(root.tag) != 'sbml' or \
+                    root.get('level') not in ('2', '3'):
+                raise ValueError('not an SBML Level 2 or 3 document')
+            checked = True
+        parent = element.getparent()
+        if parent is None:
+            continue
+        container = _local(parent.tag)
+        if container.startswith('listOf') and \
+                _local(parent.getparent().tag) == 'model':
+            tag = _local(element.tag)
+            attributes = dict(element.attrib)
+            if tag == 'compartment':
+                compartments[attributes['id']] = float(
+                    attributes.get('size', 'nan'))
+            elif tag == 'species':
+                name, label, compartment = convention.species(
+                    attributes, _notes(element), _annotation(element))
+                size = compartments.get(attributes.get('compartment'),
+                                        float('nan'))
+                if 'initialAmount' in attributes:
+                    amount = float(attributes['initialAmount'])
+                else:
+                    amount = size * float(attributes.get(
+                        'initialConcentration', 'nan'))
+                if _boolean(attributes.get('hasOnlySubstanceUnits'), False,
+                            'species.hasOnlySubstanceUnits'):
+                    size = 1.0
+                const = (_boolean(attributes.get('constant'), False,
+                                  'species.constant') or
+                         _boolean(attributes.get('boundaryCondition'), False,
+                                  'species.boundaryCondition'))
+                species_index[attributes['id']] = len(species)
+                species_sizes[attributes['id']] = size
+                species.append((attributes['id'], name, label, compartment,
+                                amount, const))
+            elif tag == 'parameter':
+                name = convention.parameter(attributes, _notes(element),
+                                            _annotation(element))
+                parameter_index[attributes['id']] = len(parameters)
+                parameter_names[name] = len(parameters)
+                parameters.append((attributes['id'], name,
+                                   float(attributes.get('value', 'nan')),
+                                   _boolean(attributes.get('constant'), True,
+                                            'parameter.constant'),
+                                   _notes(element)))
+            elif tag == 'reaction':
+                try:
+                    reactions.append(_reaction(
+                        element, attributes, convention, species_index,
+                        species_sizes, parameter_index, parameter_names,
+                        compartments, parameters))
+                except UnsupportedKineticLaw as e:
+                    unrecognized.append((attributes['id'], str(e)))
+        elif container not in ('model', 'sbml'):
+            continue
+        # Free the element and the already processed siblings before it.
+        element.clear()
+        while element.getprevious() is not None:
+            del parent[0]
+    return {
+        'version': cache.CACHE_VERSION,
+        'species': species,
+        'parameters': parameters,
+        'reactions': reactions,
+        'unrecognized': unrecognized,
+        }
+
+
+def _reaction(element, attributes, convention, species_index,
+              species_sizes, parameter_index, parameter_names, compartments,
+              parameters):
+    """Return the record tuple of a reaction, adding its local parameters
+    (and the zero parameter if needed) to `parameters`."""
+    name, label, kf, kr = convention.reaction(
+        attributes, _notes(element), _annotation(element))
+    reactants = _references(element, 'listOfReactants')
+    products = _references(element, 'listOfProducts')
+    if kf is not None:
+        kf = parameter_names[kf]
+        kr = parameter_names[kr] if kr is not None else None
+        kf_scale = kr_scale = 1.0
+    else:
+        law = _child(element, 'kineticLaw')
+        math = _child(law, 'math') if law is not None else None
+        if math is None:
+            raise UnsupportedKineticLaw('no kinetic law')
+        local = {}
+        for tag in 'listOfParameters', 'listOfLocalParameters':
+            container = _child(law, tag)
+            for p in _children(container) if container is not None else ():
+                local[p.get('id')] = len(parameters)
+                local_name = '%s_%s' % (attributes['id'], p.get('id'))
+                parameters.append((local_name, local_name,
+                                   float(p.get('value', 'nan')), True,
+                                   _notes(p)))
+
+        def lookup(identifier):
+            if identifier in local:
+                return 'parameter', local[identifier]
+            if identifier in species_index:
+                return 'species', identifier
+            if identifier in parameter_index:
+                return 'parameter', parameter_index[identifier]
+            if identifier in compartments:
+                return 'compartment', compartments[identifier]
+            return None
+
+        (expression,) = _children(math)
+        kf, kr, kf_scale, kr_scale = mass_action(
+            _expand(expression), reactants, products, lookup)
+        # Convert the law from concentrations to amounts.
+        for i in reactants:
+            kf_scale /= species_sizes[i]
+        if kr is not None:
+            for i in products:
+                kr_scale /= species_sizes[i]
+        if not np.isfinite(kf_scale) or not np.isfinite(kr_scale):
+            raise UnsupportedKineticLaw('compartment without a size')
+    if kr is None:
+        if '_zero' not in parameter_names:
+            parameter_names['_zero'] = len(parameters)
+            parameters.append(('', '_zero', 0.0, True, None))
+        kr = parameter_names['_zero']
+    return (attributes['id'], name, label,
+            tuple(species_index[i] for i in reactants),
+            tuple(species_index[i] for i in products), kf, kr, kf_scale,
+            kr_scale)
+
+
+def model_from_record(record):
+    """Return the Model described by a record from parse()."""
+    species = [Species(*fields) for fields in record['species']]
+    parameters = [Parameter(*fields) for fields in record['parameters']]
+    reactions = [Reaction(rxn_id, name, label,
+                          tuple(species[i] for i in reactants),
+                          tuple(species[i] for i in products),
+                          parameters[kf], parameters[kr], kf_scale, kr_scale)
+                 for (rxn_id, name, label, reactants, products, kf, kr,
+                      kf_scale, kr_scale) in record['reactions']]
+    model = Model(species, parameters, reactions)
+    model.unrecognized = record['unrecognized']
+    return model
+
+
+def _key_hash(convention):
+    h = hashlib.sha1()
+    h.update('sbml %d %s\n' % (PARSED_VERSION, convention.key))
+    return h
+
+
+def source_key(source, convention=None):
+    """Return the cache key of the parsed form of SBML text `source`."""
+    h = _key_hash(convention or Convention())
+    h.update(source)
+    return 'sbml-' + h.hexdigest()
+
+
+def load(path, convention=None, cache_dir=None):
+    """Return the Model of the SBML file at `path`, parsing it if needed.
+
+    The file is hashed and parsed in chunks, never read into memory whole.
+    `convention` defaults to Convention(); the lookup indexes of the model
+    are built.
+    """
+    if convention is None:
+        convention = Convention()
+    h = _key_hash(convention)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), ''):
+            h.update(chunk)
+    key = 'sbml-' + h.hexdigest()
+    record = cache.load(key, cache_dir)
+    if record is None:
+        with open(path, 'rb') as f:
+            record = parse(f, convention)
+        cache.store(key, record, cache_dir)
+    model = model_from_record(record)
+    model.build_indexes()
+    return model
@@ -0,0 +1,217 @@
+"""Conservation laws of a reaction network.
+
+A conservation law is a vector l with l * S = 0 for the stoichiometry
+matrix S, so l * y is constant along every trajectory. The steady states of
+dy/dt = S v(y) are therefore not isolated; they are fixed by the conserved
+totals. Replacing the dependent rows of S v(y) = 0 with l * y = total gives a
+square system with a nonsingular Jacobian, which Newton iteration can solve.
+Likewise, ReducedSystem eliminates one species per law from the integrated
+state and reconstructs it from the conserved totals.
+"""
+
+import fractions
+import numpy as np
+import scipy.linalg
+import scipy.sparse
+from .system import DerivedSystem
+
+# Largest denominator of the rational coefficients recovered by moiety_basis.
+MAX_DENOMINATOR = 1000
+
+
+def conservation_laws(stoichiometry, tol=1e-9):
+    """Return the conservation laws and independent rows of `stoichiometry`.
+
+    Parameters
+    ----------
+    stoichiometry : scipy.sparse matrix
+        Species by reactions.
+    tol : float, optional
+        Relative tolerance for the rank.
+
+    Returns
+    -------
+    laws : numpy.ndarray
+        Orthonormal basis of the left null space, one law per row.
+    independent : numpy.ndarray of int
+        Rows of `stoichiometry` that are linearly independent and span its
+        row space, in increasing order.
+    """
+    S = stoichiometry.toarray()
+    n = S.shape[0]
+    if not S.size:
+        return np.eye(n), np.array([], dtype=int)
+    u, s, vt = np.linalg.svd(S)
+    rank = int((s > tol * s[0]).sum()) if len(s) and s[0] else 0
+    laws = u[:, rank:].T
+    r, pivots = scipy.linalg.qr(S.T, mode='r', pivoting=True)
+    independent = np.sort(pivots[:rank])
+    return laws, independent
+
+
+def moiety_basis(laws, priority=None, tol=1e-9):
+    """Bring conservation laws to reduced row echelon form.
+
+    Each law gets a dependent species with coefficient 1 in it and 0 in the
+    other laws, so the dependent species is its law's total minus the other
+    species of the law. Pivots are restricted to coefficients within a
+    factor of two of the largest remaining one, and among those the species
+    with the highest `priority` (e.g. initial value) is chosen. Coefficients
+    within `tol` of a fraction with a small denominator are rounded to it.
+
+    Returns
+    -------
+    basis : numpy.ndarray
+        The laws, one per row.
+    dependent : numpy.ndarray of int
+        The dependent species of each row.
+    """
+    basis = np.array(laws, dtype=float)
+    m, n = basis.shape
+    if priority is None:
+        priority = np.zeros(n)
+    remaining = range(m)
+    dependent = np.empty(m, dtype=int)
+    for step in range(m):
+        magnitude = np.abs(basis[remaining])
+        best = magnitude.max()
+        if best <= tol:
+            raise ValueError("Conservation laws are not independent")
+        candidates = zip(*np.nonzero(magnitude >= 0.5 * best))
+        i, c = max(candidates,
+                   key=lambda (i, c): (priority[c], magnitude[i, c]))
+        r = remaining.pop(i)
+        basis[r] /= basis[r, c]
+        for other in range(m):
+            if other != r and basis[other, c]:
+                basis[other] -= basis[other, c] * basis[r]
+        dependent[r] = c
+    for value in np.unique(basis):
+        fraction = fractions.Fraction(value).limit_denominator(MAX_DENOMINATOR)
+        if abs(value - float(fraction)) < tol:
+            basis[basis == value] = float(fraction)
+    order = np.argsort(dependent)
+    return basis[order], dependent[order]
+
+
+class ReducedSystem(DerivedSystem):
+    """A MassActionSystem with conserved moieties eliminated.
+
+    One dependent species per conservation law is removed from the state
+    vector and reconstructed from the conserved totals, which are fixed by
+    the initial state (see initial_state()). The reduced system is smaller,
+    and its Jacobian loses the singular directions the conservation laws
+    give the full one. The methods used
+    by Simulator are provided with the same signatures as MassActionSystem,
+    on reduced state vectors::
+
+        system = ReducedSystem(MassActionSystem(model))
+        x0 = system.initial_state(system.initial_values())
+        dxdt = system.rhs(x0, system.rate_constants())
+
+    Attributes
+    ----------
+    laws : numpy.ndarray
+        Conservation laws over the full state, in reduced row echelon form
+        (see moiety_basis).
+    dependent, independent : numpy.ndarray of int
+        Positions in the full state of the eliminated and the remaining
+        species.
+    totals : numpy.ndarray
+        Conserved total of each law, set by initial_state().
+    """
+
+    # The reduced system keeps the species and reactions of the full one.
+    _shared = DerivedSystem._shared + ('stoichiometry', 'free')
+
+    def __init__(self, system, tol=1e-9):
+        DerivedSystem.__init__(self, system)
+        laws, rows = conservation_laws(system.stoichiometry, tol)
+        priority = system.state(system.initial_values())
+        self.laws, self.dependent = moiety_basis(laws, priority, tol)
+        self.independent = np.setdiff1d(np.arange(system.n_state),
+                                        self.dependent)
+        self.n_state = len(self.independent)
+        self.totals = np.zeros(len(self.dependent))
+        # Dependent species are totals - coupling * x.
+        self._coupling = scipy.sparse.csr_matrix(
+            self.laws[:, self.independent])
+        # d(full state)/d(reduced state).
+        expand = scipy.sparse.lil_matrix((system.n_state, self.n_state))
+        expand[self.independent, np.arange(self.n_state)] = 1
+        expand[self.dependent] = -self._coupling
+        self._expand = expand.tocsr()
+        self._build_jacobian_map()
+
+    def _build_jacobian_map(self):
+        """Precompute the linear map from full to reduced Jacobian entries.
+
+        The reduced Jacobian is J[independent] * expand. Both patterns are
+        fixed, so its entries are a fixed sparse matrix times the entries of
+        the full Jacobian.
+        """
+        rows, cols = self.system.jacobian_entries()
+        position = np.empty(self.system.n_state, dtype=int)
+        position.fill(-1)
+        position[self.independent] = np.arange(self.n_state)
+        expand = self._expand
+        entries = {}
+        map_rows = []
+        map_cols = []
+        data = []
+        for e, (p, i) in enumerate(zip(rows, cols)):
+            if position[p] < 0:
+                continue
+            for j in range(expand.indptr[i], expand.indptr[i + 1]):
+                key = (position[p], expand.indices[j])
+                map_rows.append(entries.setdefault(key, len(entries)))
+                map_cols.append(e)
+                data.append(expand.data[j])
+        order = sorted(entries, key=lambda (p, c): (c, p))
+        renumber = np.empty(len(entries), dtype=int)
+        for n, key in enumerate(order):
+            renumber[entries[key]] = n
+        self._jacobian_map = scipy.sparse.csr_matrix(
+            (data, (renumber[np.array(map_rows, dtype=int)], map_cols)),
+            shape=(len(entries), len(rows)))
+        self._jacobian_rows = np.array([p for p, c in order], dtype=int)
+        self._jacobian_indptr = np.searchsorted(
+            np.array([c for p, c in order], dtype=int),
+            np.arange(self.n_state + 1))
+
+    def initial_state(self, y0):
+        """Set clamped values and totals from species vector `y0`, and
+        return its reduced state."""
+        x = self.system.initial_state(y0)
+        self.totals = self.laws.dot(x)
+        return x[self.independent]
+
+    def state(self, y):
+        """Return the reduced state of species vectors `y`."""
+        return self.system.state(y)[..., self.independent]
+
+    def expand(self, x):
+        """Return the full states for reduced states `x`."""
+        x = np.asarray(x)
+        result = np.empty(x.shape[:-1] + (self.system.n_state,))
+        result[..., self.independent] = x
+        result[..., self.dependent] = (self.totals -
+                                       self._coupling.dot(x.T).T)
+        return result
+
+    def full_state(self, x):
+        """Return species vectors for reduced states `x`."""
+        return self.system.full_state(self.expand(x))
+
+    def fluxes(self, x, k, values=None):
+        return self.system.fluxes(self.expand(x), k, values)
+
+    def rhs(self, x, k, values=None):
+        return self.system.rhs(self.expand(x), k, values)[self.independent]
+
+    def jacobian(self, x, k, values=None):
+        data = self._jacobian_map.dot(
+            self.system.jacobian_values(self.expand(x), k, values))
+        return scipy.sparse.csc_matrix(
+            (data, self._jacobian_rows, self._jacobian_indptr),
+            shape=(self.n_state, self.n_state))
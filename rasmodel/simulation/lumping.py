@@ -0,0 +1,321 @@
+"""Exact lumping of species by forward and backward bisimulation.
+
+Rule-based models generate many species that the rules treat identically,
+e.g. the two orientations of a symmetric receptor dimer or complexes that
+differ only in a site no rule or observable reads. Following Cardelli et
+al. ("Forward and backward bisimulations for chemical reaction networks",
+CONCUR 2015), two kinds of partitions of the species lump the ODEs exactly:
+
+ - forward: the total of each block evolves by an ODE in the block totals.
+   Species X and Y may share a block if, for every multiset of other
+   reactants r and every block C, the reactions with reactants X + r
+   change C at the same total rate as those with reactants Y + r.
+ - backward: species of a block keep equal values if they start equal.
+   X and Y may share a block if, for every multiset of reactant blocks,
+   the reactions whose reactants fall in those blocks change X at the same
+   total rate as Y.
+
+Rates are compared symbolically (by rate constant names and numeric
+factors), so the partitions hold for any parameter values. Both are found
+as the coarsest refinement of an initial partition: for forward lumping
+species with the same coefficients in every observable, so the observables
+are sums over blocks; for backward lumping species with the same initial
+value. LumpedSystem integrates the block totals or values::
+
+    from rasmodel.simulation.lumping import forward_partition, LumpedSystem
+    system = LumpedSystem(base, forward_partition(base), 'forward')
+    print system.compression
+
+Simulator(model, tspan, lumping='forward') does this transparently; its y
+then holds NaN for the species of lumped blocks.
+"""
+
+import numpy as np
+import scipy.sparse
+from .system import DerivedSystem, _rate_factors
+
+KINDS = ('forward', 'backward')
+
+
+def _reactions(system):
+    """Kept reactions of `system` as (reactants, net changes, rate key).
+
+    Reactants are species indexes; net changes map state positions to
+    stoichiometric coefficients. The rate key is the numeric factor and the
+    sorted names of the other factors of the rate constant.
+    """
+    columns = system._columns
+    result = []
+    for j in system.reactions:
+        r = system.model.reactions[j]
+        net = {}
+        for i in r['reactants']:
+            net[i] = net.get(i, 0) - 1
+        for i in r['products']:
+            net[i] = net.get(i, 0) + 1
+        changes = dict((columns[i], c) for i, c in net.items()
+                       if c and columns[i] >= 0)
+        number, names = _rate_factors(r)
+        result.append((tuple(r['reactants']), changes,
+                       number, tuple(sorted(names))))
+    return result
+
+
+def _refine(labels, signature):
+    """Split blocks of `labels` by `signature` until the partition is stable.
+    """
+    labels = list(labels)
+    n_blocks = len(set(labels))
+    while True:
+        keys = [(labels[i], signature(labels, i)) for i in range(len(labels))]
+        numbering = {}
+        labels = [numbering.setdefault(key, len(numbering)) for key in keys]
+        if len(numbering) == n_blocks:
+            return np.array(labels, dtype=int)
+        n_blocks = len(numbering)
+
+
+def _canonical(labels):
+    """Renumber block labels in order of first appearance."""
+    numbering = {}
+    return np.array([numbering.setdefault(l, len(numbering)) for l in labels],
+                    dtype=int)
+
+
+def forward_partition(system, initial=None):
+    """Return the coarsest forward bisimulation of `system`'s state.
+
+    Parameters
+    ----------
+    system : MassActionSystem
+    initial : vector-like of int, optional
+        Initial block of each state variable. Defaults to grouping species
+        with the same coefficients in every observable.
+
+    Returns
+    -------
+    numpy.ndarray of int
+        Block of each state variable, numbered from 0 in order of first
+        appearance.
+    """
+    if initial is None:
+        observables = system.observables.tocsc()[:, system.free]
+        initial = [tuple(zip(observables.indices[start:end],
+                             observables.data[start:end]))
+                   for start, end in zip(observables.indptr[:-1],
+                                         observables.indptr[1:])]
+    reactions = _reactions(system)
+    columns = system._columns
+    by_reactant = [[] for i in range(system.n_state)]
+    for n, (reactants, changes, number, names) in enumerate(reactions):
+        for i in set(reactants):
+            if columns[i] >= 0:
+                by_reactant[columns[i]].append(n)
+
+    def signature(labels, x):
+        rates = {}
+        for n in by_reactant[x]:
+            reactants, changes, number, names = reactions[n]
+            others = list(reactants)
+            others.remove(system.free[x])
+            net = {}
+            for p, c in changes.items():
+                net[labels[p]] = net.get(labels[p], 0) + c
+            for block, c in net.items():
+                if c:
+                    key = (tuple(sorted(others)), block, names)
+                    rates[key] = rates.get(key, 0) + number * c
+        return frozenset((key, round(value, 12))
+                         for key, value in rates.items() if value)
+
+    return _canonical(_refine(_canonical(initial), signature))
+
+
+def backward_partition(system, initial=None):
+    """Return the coarsest backward bisimulation of `system`'s state.
+
+    Parameters
+    ----------
+    system : MassActionSystem
+    initial : vector-like, optional
+        Initial block of each state variable, e.g. the initial values.
+        Defaults to the initial values of the model.
+
+    Returns
+    -------
+    numpy.ndarray of int
+        Block of each state variable, numbered from 0 in order of first
+        appearance.
+    """
+    if initial is None:
+        initial = system.state(system.initial_values())
+    reactions = _reactions(system)
+    columns = system._columns
+    by_product = [[] for i in range(system.n_state)]
+    for n, (reactants, changes, number, names) in enumerate(reactions):
+        for p in changes:
+            by_product[p].append(n)
+
+    def signature(labels, x):
+        rates = {}
+        for n in by_product[x]:
+            reactants, changes, number, names = reactions[n]
+            blocks = tuple(sorted(labels[columns[i]] if columns[i] >= 0
+                                  else 'c%d' % i for i in reactants))
+            key = (blocks, names)
+            rates[key] = rates.get(key, 0) + number * changes[x]
+        return frozenset((key, round(value, 12))
+                         for key, value in rates.items() if value)
+
+    return _canonical(_refine(_canonical(initial), signature))
+
+
+class LumpedSystem(DerivedSystem):
+    """A MassActionSystem with its state lumped by a bisimulation.
+
+    With forward lumping the state holds the total of each block. The
+    individual species of blocks with more than one species are not known,
+    and full_state() reports them as NaN; total_state() puts each total on
+    the block's first species (its representative), which gives the
+    observables exactly since they are sums over blocks. With backward
+    lumping the state holds the common value of each block's species, and
+    full_state() reproduces every species exactly; initial values must be
+    equal within blocks. The methods used by Simulator are provided with the
+    same signatures as MassActionSystem, on lumped state vectors.
+
+    Parameters
+    ----------
+    system : MassActionSystem
+    blocks : vector-like of int
+        Block of each state variable of `system`, from forward_partition()
+        or backward_partition().
+    kind : str
+        'forward' or 'backward'.
+
+    Attributes
+    ----------
+    blocks : numpy.ndarray of int
+    representatives : numpy.ndarray of int
+        First state variable of `system` in each block.
+    sizes : numpy.ndarray of int
+        Number of species in each block.
+    """
+
+    def __init__(self, system, blocks, kind):
+        if kind not in KINDS:
+            raise ValueError("kind must be one of %s" % ', '.join(KINDS))
+        DerivedSystem.__init__(self, system)
+        self.kind = kind
+        self.blocks = np.asarray(blocks, dtype=int)
+        self.n_state = self.blocks.max() + 1 if len(self.blocks) else 0
+        self.sizes = np.bincount(self.blocks, minlength=self.n_state)
+        first = {}
+        for i, b in enumerate(self.blocks):
+            first.setdefault(b, i)
+        self.representatives = np.array([first[b] for b in
+                                         range(self.n_state)], dtype=int)
+        self.free = system.free[self.representatives]
+        self._build_jacobian_map()
+
+    @property
+    def compression(self):
+        """Ratio of the number of state variables before and after lumping.
+        """
+        return float(self.system.n_state) / max(self.n_state, 1)
+
+    def _build_jacobian_map(self):
+        """Precompute the map from full to lumped Jacobian entries.
+
+        Forward lumping sums the rows of each block and takes the columns
+        of representatives; backward lumping takes the rows of
+        representatives and sums the columns of each block.
+        """
+        rows, cols = self.system.jacobian_entries()
+        is_representative = np.zeros(self.system.n_state, dtype=bool)
+        is_representative[self.representatives] = True
+        if self.kind == 'forward':
+            keep = is_representative[cols]
+        else:
+            keep = is_representative[rows]
+        entries = {}
+        map_rows = []
+        map_cols = []
+        for e in np.nonzero(keep)[0]:
+            key = (self.blocks[rows[e]], self.blocks[cols[e]])
+            map_rows.append(entries.setdefault(key, len(entries)))
+            map_cols.append(e)
+        order = sorted(entries, key=lambda (p, c): (c, p))
+        renumber = np.empty(len(entries), dtype=int)
+        for n, key in enumerate(order):
+            renumber[entries[key]] = n
+        self._jacobian_map = scipy.sparse.csr_matrix(
+            (np.ones(len(map_rows)),
+             (renumber[np.array(map_rows, dtype=int)], map_cols)),
+            shape=(len(entries), len(rows)))
+        self._jacobian_rows = np.array([p for p, c in order], dtype=int)
+        self._jacobian_indptr = np.searchsorted(
+            np.array([c for p, c in order], dtype=int),
+            np.arange(self.n_state + 1))
+
+    def _lump(self, x):
+        """Lump full states `x` (state along the last axis)."""
+        x = np.asarray(x)
+        if self.kind == 'backward':
+            return x[..., self.representatives]
+        result = np.zeros(x.shape[:-1] + (self.n_state,))
+        for i, b in enumerate(self.blocks):
+            result[..., b] += x[..., i]
+        return result
+
+    def expand(self, z):
+        """Return the full states for lumped states `z`."""
+        z = np.asarray(z)
+        if self.kind == 'backward':
+            return z[..., self.blocks]
+        result = np.zeros(z.shape[:-1] + (self.system.n_state,))
+        result[..., self.representatives] = z
+        return result
+
+    def initial_state(self, y0):
+        """Set clamped values from species vector `y0` and return its
+        lumped state."""
+        x = self.system.initial_state(y0)
+        if self.kind == 'backward' and \
+                np.any(x != x[self.representatives][self.blocks]):
+            raise ValueError("Initial values differ within a block of the "
+                             "backward lumping")
+        return self._lump(x)
+
+    def state(self, y):
+        """Return the lumped state of species vectors `y`."""
+        return self._lump(self.system.state(y))
+
+    def total_state(self, z):
+        """Return species vectors for lumped states `z`, with the total of
+        each block on its representative and zeros on the other members."""
+        return self.system.full_state(self.expand(z))
+
+    def full_state(self, z):
+        """Return species vectors for lumped states `z`. With forward
+        lumping, species of blocks with more than one member are NaN."""
+        y = self.total_state(z)
+        if self.kind == 'forward':
+            lumped = self.sizes[self.blocks] > 1
+            y[..., self.system.free[lumped]] = np.nan
+        return y
+
+    def fluxes(self, z, k, values=None):
+        return self.system.fluxes(self.expand(z), k, values)
+
+    def rhs(self, z, k, values=None):
+        f = self.system.rhs(self.expand(z), k, values)
+        if self.kind == 'backward':
+            return f[self.representatives]
+        return np.bincount(self.blocks, f, minlength=self.n_state)
+
+    def jacobian(self, z, k, values=None):
+        data = self._jacobian_map.dot(
+            self.system.jacobian_values(self.expand(z), k, values))
+        return scipy.sparse.csc_matrix(
+            (data, self._jacobian_rows, self._jacobian_indptr),
+            shape=(self.n_state, self.n_state))
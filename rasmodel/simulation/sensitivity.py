@@ -0,0 +1,524 @@
+"""Forward sensitivities of observables and expressions to parameters.
+
+Finite differences take one stiff integration per parameter plus the
+nominal one, which for the Chen 2009 model means hundreds. SensitivitySolver
+instead integrates the sensitivities S = dy/dp alongside the state y. They
+follow the linear equations
+
+    dS/dt = J(y) S + df/dp,    S(0) = dy0/dp
+
+where J is the analytic Jacobian of MassActionSystem and df/dp comes from
+the rate constants, which are products of parameters (see
+MassActionSystem.rate_constant_derivatives), and from the clamped species,
+which hold initial values that depend on parameters.
+
+The state and the sensitivities are integrated together by a variable order
+BDF method (the quasi-constant step NDF scheme of scipy's BDF solver) with a
+staggered corrector: each step first solves the Newton iteration for the
+state, then iterates on the sensitivities with the same LU factorization of
+I - c J. The sensitivity residual uses the Jacobian at the new state, so the
+factorization is only refreshed when the step size or order changes or an
+iteration fails to converge, and the sensitivities of all parameters are
+solved at once as the columns of one right hand side::
+
+    from rasmodel.chen_2009 import model, module_parameters
+    from rasmodel.simulation.sensitivity import SensitivitySolver
+    sim = SensitivitySolver(model, tspan, module_parameters(model, ['mapk']),
+                            atol=1e-6, rtol=1e-8)
+    sim.run()
+    sim.dyobs['pERK']         # (time, parameters) d(pERK)/d(parameter)
+    sim.dyexpr['pErbB1']
+
+Observable sensitivities are accumulated at the output times, so the
+(time, species, parameters) array is only kept with species=True.
+"""
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+import sympy
+from rasmodel.network.cache import generate_equations
+from rasmodel.network.dependency import dependency_cone
+from .system import MassActionSystem, evaluate
+from .solver import _record_array
+
+MAX_ORDER = 5
+NEWTON_MAXITER = 4
+MIN_FACTOR = 0.2
+MAX_FACTOR = 10
+EPS = np.finfo(float).eps
+
+# Coefficients of the numerical differentiation formulas (Shampine and
+# Reichelt, "The MATLAB ODE Suite"), as in scipy.integrate.BDF.
+_kappa = np.array([0, -0.1850, -1.0 / 9, -0.0823, -0.0415, 0])
+_gamma = np.hstack((0, np.cumsum(1.0 / np.arange(1, MAX_ORDER + 1))))
+_alpha = (1 - _kappa) * _gamma
+_error_const = _kappa * _gamma + 1.0 / np.arange(1, MAX_ORDER + 2)
+
+
+def _norm(x):
+    """RMS norm, taken separately over each column of a matrix and
+    maximized, so that each parameter's sensitivities count in full."""
+    return np.sqrt(np.mean(np.square(x), axis=0)).max()
+
+
+def _change_differences(D, order, factor):
+    """Rescale the difference array D in place for a step size changed by
+    `factor`."""
+    def transform(factor):
+        i = np.arange(1.0, order + 1)[:, None]
+        j = np.arange(1.0, order + 1)
+        m = np.zeros((order + 1, order + 1))
+        m[1:, 1:] = (i - 1 - factor * j) / i
+        m[0] = 1
+        return np.cumprod(m, axis=0)
+
+    ru = transform(factor).dot(transform(1))
+    D[:order + 1] = np.tensordot(ru.T, D[:order + 1], axes=1)
+
+
+def _corrector(fun, predict, c, psi, lu, scale, tol):
+    """Iterate the BDF corrector equation c * fun(z) = psi + (z - predict)
+    with the factorization `lu`.
+
+    Returns whether it converged, the iterations, z and z - predict.
+    """
+    d = 0
+    z = predict.copy()
+    norm_old = None
+    converged = False
+    for k in range(NEWTON_MAXITER):
+        f = fun(z)
+        if not np.all(np.isfinite(f)):
+            break
+        dz = lu.solve(c * f - psi - d)
+        dz_norm = _norm(dz / scale)
+        rate = None if norm_old is None else dz_norm / norm_old
+        if rate is not None and (rate >= 1 or rate ** (NEWTON_MAXITER - k) /
+                                 (1 - rate) * dz_norm > tol):
+            break
+        z += dz
+        d += dz
+        if dz_norm == 0 or rate is not None and \
+                rate / (1 - rate) * dz_norm < tol:
+            converged = True
+            break
+        norm_old = dz_norm
+    return converged, k + 1, z, d
+
+
+def _sensitivity_array(n, names, n_parameters):
+    if names:
+        return np.ndarray(n, [(name, float, (n_parameters,))
+                              for name in names])
+    return np.ndarray((n, 0, n_parameters))
+
+
+class SensitivitySolver(object):
+    """Integrate a model's network and its forward sensitivities.
+
+    Parameters
+    ----------
+    model : pysb.Model
+        The model. Its network is generated (through the network cache) if
+        necessary.
+    tspan : vector-like
+        Time values at which to report results.
+    parameters : list of str, optional
+        Names of the parameters to differentiate by, e.g. from
+        rasmodel.chen_2009.module_parameters. Defaults to every parameter
+        that a rate constant or an initial value depends on, except pysb's
+        own (like __source_0).
+    clamped : list, optional
+        Species held at their initial values, as for Simulator.
+    targets : list, optional
+        Observables and expressions (or their names) to compute, as for
+        Simulator. The others, and their sensitivities, are NaN.
+    rtol, atol : float, optional
+        Tolerances of the state. Sensitivities are held to the same
+        tolerances, scaled by the parameter values (i.e. as p * dy/dp).
+    error_control : bool, optional
+        Whether the sensitivities take part in step size control. If False,
+        steps are chosen for the state alone, which is cheaper but leaves
+        the accuracy of the sensitivities unchecked. Defaults to True.
+    max_step : float, optional
+        Largest step size.
+    species : bool, optional
+        Whether to keep the sensitivities of every species in `dy`.
+
+    Attributes
+    ----------
+    parameters : list of str
+        The parameters, in the order of the last axis of the sensitivities.
+    y, yobs, yexpr : numpy.ndarray
+        Species, observables and dynamic expressions, as for Simulator.
+    dyobs, dyexpr : numpy.ndarray
+        Sensitivities of the observables and the expressions: record arrays
+        by name whose fields are (time, parameters) arrays.
+    dy : numpy.ndarray
+        Sensitivities of the species, (time, species, parameters), if
+        `species` is True.
+    stats : dict
+        Right hand side evaluations ('nfev'), Jacobian evaluations ('njev'),
+        LU decompositions ('nlu'), accepted steps ('nsteps') and
+        sensitivity corrector iterations ('nsens') of the last run.
+    """
+
+    def __init__(self, model, tspan, parameters=None, clamped=(),
+                 targets=None, rtol=1e-6, atol=1e-6, error_control=True,
+                 max_step=np.inf, species=False, verbose=False):
+        generate_equations(model, verbose=verbose)
+        self.model = model
+        self.tspan = np.asarray(tspan, dtype=float)
+        self.rtol = rtol
+        self.atol = atol
+        self.error_control = error_control
+        self.max_step = max_step
+        self.verbose = verbose
+        ignored = ()
+        if targets is not None:
+            cone, reactions = dependency_cone(model, targets)
+            ignored = np.setdiff1d(np.arange(len(model.species)), cone)
+        self.system = system = MassActionSystem(model, clamped, (), ignored)
+        if system.has_dynamic_rates:
+            raise NotImplementedError("Sensitivities of observable-dependent "
+                                      "rates are not supported")
+        names = system.parameter_names
+        if parameters is None:
+            used = (system.rate_constant_derivatives().getnnz(axis=0) +
+                    system.initial_value_derivatives().getnnz(axis=0))
+            parameters = [name for name, n in zip(names, used)
+                          if n and not name.startswith('__')]
+        for name in parameters:
+            if name not in names:
+                raise IndexError("Unknown parameter name (%s)" % name)
+        self.parameters = list(parameters)
+        self._columns = np.array([names.index(name) for name in parameters],
+                                 dtype=int)
+        n_parameters = len(self.parameters)
+
+        # Reactant slots of clamped species, for the flux derivatives with
+        # respect to the clamped values.
+        position = dict((i, c) for c, i in enumerate(system.clamped))
+        slots = [(j, s, position[i])
+                 for (j, s), i in np.ndenumerate(system.reactants)
+                 if i in position]
+        self._clamped_slots = tuple(np.array([slot[a] for slot in slots],
+                                             dtype=int) for a in range(3))
+
+        # Observables of ignored species are unknown, as are their
+        # sensitivities.
+        self._unknown = system.observables[:, system.ignored].getnnz(
+            axis=1) > 0
+        self._expression_derivatives = self._differentiate_expressions()
+
+        n = len(self.tspan)
+        self.y = np.ndarray((n, system.n_species))
+        self.yobs = _record_array(n, system.observable_names)
+        self.yobs_view = self.yobs.view(float).reshape(n, -1)
+        expression_names = [e.name for e in system.dynamic_expressions]
+        self.yexpr = _record_array(n, expression_names)
+        self.yexpr_view = self.yexpr.view(float).reshape(n, -1)
+        self.dyobs = _sensitivity_array(n, system.observable_names,
+                                        n_parameters)
+        self.dyobs_view = self.dyobs.view(float).reshape(
+            n, len(system.observable_names), n_parameters)
+        self.dyexpr = _sensitivity_array(n, expression_names, n_parameters)
+        self.dyexpr_view = self.dyexpr.view(float).reshape(
+            n, len(expression_names), n_parameters)
+        self.dy = None
+        if species:
+            self.dy = np.ndarray((n, system.n_species, n_parameters))
+        self.stats = {}
+
+    def _differentiate_expressions(self):
+        """Partial derivatives of each dynamic expression, as lists of
+        (observable index, derivative) and (parameter column, derivative).
+        """
+        observables = dict((name, i) for i, name in
+                           enumerate(self.system.observable_names))
+        columns = dict((name, c) for c, name in enumerate(self.parameters))
+        result = []
+        for e in self.system.dynamic_expressions:
+            expr = e.expand_expr()
+            symbols = sorted(expr.free_symbols, key=lambda s: s.name)
+            result.append((
+                [(observables[s.name], sympy.diff(expr, s))
+                 for s in symbols if s.name in observables],
+                [(columns[s.name], sympy.diff(expr, s))
+                 for s in symbols if s.name in columns]))
+        return result
+
+    def run(self, param_values=None, y0=None):
+        """Integrate the state and the sensitivities.
+
+        Parameters
+        ----------
+        param_values : vector-like or dict, optional
+            Parameter values in model.parameters order, or a dict of values
+            by name overriding the model's. Defaults to the model's values.
+        y0 : vector-like, optional
+            Initial species values in model.species order. Defaults to the
+            model's initial conditions. An explicit y0 does not depend on
+            the parameters, so the sensitivities start at zero.
+        """
+        system = self.system
+        p = system.parameter_vector(param_values)
+        values = system.values(p)
+        k = system.rate_constants(p)
+        dk = system.rate_constant_derivatives(p)[:, self._columns]
+        if y0 is None:
+            y0 = system.initial_values(p)
+            dy0 = system.initial_value_derivatives(p)[:, self._columns]
+        elif len(y0) != system.n_species:
+            raise ValueError("y0 must be the same length as model.species")
+        else:
+            dy0 = scipy.sparse.csr_matrix((system.n_species,
+                                           len(self._columns)))
+        x0 = system.initial_state(y0)
+        dclamped = dy0[system.clamped]
+        # Constant part of the observable sensitivities, from the clamped
+        # species.
+        observables_free = system.observables[:, system.free]
+        clamped_part = system.observables[:, system.clamped].dot(
+            dclamped).toarray()
+        x = np.empty((len(self.tspan), system.n_state))
+
+        def store(i, z):
+            x[i] = z[:, 0]
+            self.dyobs_view[i] = observables_free.dot(z[:, 1:]) + clamped_part
+            if self.dy is not None:
+                self.dy[i, :, :] = 0
+                self.dy[i, system.free] = z[:, 1:]
+                self.dy[i, system.clamped] = dclamped.toarray()
+                self.dy[i, system.ignored] = np.nan
+
+        scale = np.abs(p[self._columns])
+        scale[scale == 0] = 1
+        last = self._integrate(x0, dy0[system.free].toarray(), k, values, dk,
+                               dclamped, scale, store)
+        x[last + 1:] = np.nan
+        self.dyobs_view[last + 1:] = np.nan
+        if self.dy is not None:
+            self.dy[last + 1:] = np.nan
+        self.y[:] = system.full_state(x)
+        self._outputs(values)
+
+    def _parameter_rhs(self, x, k, dk, dclamped):
+        """Return df/dp at state `x`, states by parameters."""
+        system = self.system
+        system._y[system.free] = x
+        factors = system._y[system.reactants]
+        dflux = scipy.sparse.diags(factors.prod(axis=1)).dot(dk)
+        j, s, c = self._clamped_slots
+        if len(j) and dclamped.nnz:
+            others = factors[j]
+            others[np.arange(len(j)), s] = 1
+            flux_derivatives = scipy.sparse.csr_matrix(
+                (k[j] * others.prod(axis=1), (j, c)),
+                shape=(system.n_reactions, len(system.clamped)))
+            dflux = dflux + flux_derivatives.dot(dclamped)
+        return system.stoichiometry.dot(dflux).toarray()
+
+    def _integrate(self, x0, s0, k, values, dk, dclamped, pscale, store):
+        """Integrate from (x0, s0), passing the output index and the state
+        and sensitivities, as the columns of one matrix, to `store` at every
+        output time. Returns the last output index reached."""
+        system = self.system
+        rtol, atol = self.rtol, self.atol
+        tspan = self.tspan
+        t, t_end = tspan[0], tspan[-1]
+        identity = scipy.sparse.identity(system.n_state, format='csc')
+        newton_tol = max(10 * EPS / rtol, min(0.03, rtol ** 0.5))
+        sensitivities = s0.shape[1] > 0
+        stats = self.stats = {'nfev': 0, 'njev': 0, 'nlu': 0, 'nsteps': 0,
+                              'nsens': 0}
+
+        def rhs(x):
+            stats['nfev'] += 1
+            return system.rhs(x, k, values)
+
+        def jacobian(x):
+            stats['njev'] += 1
+            return system.jacobian(x, k, values)
+
+        def scales(z):
+            scale = np.empty_like(z)
+            scale[:, 0] = atol + rtol * np.abs(z[:, 0])
+            scale[:, 1:] = (atol + rtol * np.abs(z[:, 1:] * pscale)) / pscale
+            return scale
+
+        def error_norm(error, scale):
+            if self.error_control and sensitivities:
+                return _norm(error / scale)
+            return _norm(error[:, 0] / scale[:, 0])
+
+        z = np.column_stack((x0, s0))
+        store(0, z)
+        J = jacobian(x0)
+        f0 = rhs(x0)
+        dz = np.column_stack((f0, J.dot(s0) +
+                              self._parameter_rhs(x0, k, dk, dclamped)))
+        h_abs = min(self._initial_step(x0, f0, rhs), self.max_step)
+        D = np.zeros((MAX_ORDER + 3,) + z.shape)
+        D[0] = z
+        D[1] = dz * h_abs
+        order = 1
+        n_equal_steps = 0
+        lu = None
+        i = 1
+        while i < len(tspan):
+            min_step = 10 * abs(np.nextafter(t, np.inf) - t)
+            if h_abs > self.max_step:
+                _change_differences(D, order, self.max_step / h_abs)
+                h_abs = self.max_step
+                n_equal_steps = 0
+            elif h_abs < min_step:
+                _change_differences(D, order, min_step / h_abs)
+                h_abs = min_step
+                n_equal_steps = 0
+            current_jac = False
+            accepted = False
+            while not accepted:
+                if h_abs < min_step:
+                    break
+                t_new = t + h_abs
+                if t_new > t_end:
+                    t_new = t_end
+                    _change_differences(D, order, (t_new - t) / h_abs)
+                    n_equal_steps = 0
+                    lu = None
+                h_abs = t_new - t
+                predict = D[:order + 1].sum(axis=0)
+                scale = scales(predict)
+                psi = np.tensordot(_gamma[1:order + 1], D[1:order + 1],
+                                   axes=1) / _alpha[order]
+                c = h_abs / _alpha[order]
+                while True:
+                    if lu is None:
+                        stats['nlu'] += 1
+                        # Reaction networks have nearly symmetric patterns,
+                        # for which this ordering gives far less fill-in
+                        # than the default.
+                        lu = scipy.sparse.linalg.splu(
+                            (identity - c * J).tocsc(),
+                            permc_spec='MMD_AT_PLUS_A')
+                    converged, n_iter, x_new, dx = _corrector(
+                        rhs, predict[:, 0], c, psi[:, 0], lu, scale[:, 0],
+                        newton_tol)
+                    if converged and sensitivities:
+                        # Staggered corrector: the sensitivity equations are
+                        # linear, with the Jacobian at the new state.
+                        J_new = jacobian(x_new)
+                        fp = self._parameter_rhs(x_new, k, dk, dclamped)
+                        converged, n_sens, s_new, ds = _corrector(
+                            lambda s: J_new.dot(s) + fp, predict[:, 1:], c,
+                            psi[:, 1:], lu, scale[:, 1:], newton_tol)
+                        stats['nsens'] += n_sens
+                    if converged or current_jac:
+                        break
+                    J = jacobian(predict[:, 0])
+                    lu = None
+                    current_jac = True
+                if not converged:
+                    h_abs *= 0.5
+                    _change_differences(D, order, 0.5)
+                    n_equal_steps = 0
+                    lu = None
+                    continue
+                if sensitivities:
+                    z_new = np.column_stack((x_new, s_new))
+                    d = np.column_stack((dx, ds))
+                    J = J_new
+                else:
+                    z_new = x_new[:, None]
+                    d = dx[:, None]
+                safety = 0.9 * (2 * NEWTON_MAXITER + 1) / (2 * NEWTON_MAXITER
+                                                           + n_iter)
+                scale = scales(z_new)
+                error = error_norm(_error_const[order] * d, scale)
+                if error > 1:
+                    factor = max(MIN_FACTOR,
+                                 safety * error ** (-1.0 / (order + 1)))
+                    h_abs *= factor
+                    _change_differences(D, order, factor)
+                    n_equal_steps = 0
+                else:
+                    accepted = True
+            if not accepted:
+                print 'Step size became too small at t=%g' % t
+                return i - 1
+            stats['nsteps'] += 1
+            n_equal_steps += 1
+            t = t_new
+            D[order + 2] = d - D[order + 1]
+            D[order + 1] = d
+            for j in reversed(range(order + 1)):
+                D[j] += D[j + 1]
+            if n_equal_steps >= order + 1:
+                # Change order by one if that allows a longer step.
+                error_m = error_p = np.inf
+                if order > 1:
+                    error_m = error_norm(_error_const[order - 1] * D[order],
+                                         scale)
+                if order < MAX_ORDER:
+                    error_p = error_norm(
+                        _error_const[order + 1] * D[order + 2], scale)
+                with np.errstate(divide='ignore'):
+                    factors = np.array([error_m, error, error_p]) ** (
+                        -1.0 / np.arange(order, order + 3))
+                order += np.argmax(factors) - 1
+                factor = min(MAX_FACTOR, safety * factors.max())
+                h_abs *= factor
+                _change_differences(D, order, factor)
+                n_equal_steps = 0
+                lu = None
+            # Interpolate the outputs passed by this step.
+            shift = t - h_abs * np.arange(order)
+            denominator = h_abs * (1 + np.arange(order))
+            while i < len(tspan) and tspan[i] <= t:
+                p = np.cumprod((tspan[i] - shift) / denominator)
+                store(i, D[0] + np.tensordot(p, D[1:order + 1], axes=1))
+                i += 1
+        if self.verbose:
+            print stats
+        return i - 1
+
+    def _initial_step(self, x0, f0, rhs):
+        """Choose the first step size (Hairer, Norsett and Wanner, Sec.
+        II.4) from the state alone."""
+        scale = self.atol + self.rtol * np.abs(x0)
+        d0 = _norm(x0 / scale)
+        d1 = _norm(f0 / scale)
+        if d0 < 1e-5 or d1 < 1e-5:
+            h0 = 1e-6
+        else:
+            h0 = 0.01 * d0 / d1
+        f1 = rhs(x0 + h0 * f0)
+        d2 = _norm((f1 - f0) / scale) / h0
+        if d1 <= 1e-15 and d2 <= 1e-15:
+            h1 = max(1e-6, h0 * 1e-3)
+        else:
+            h1 = (0.01 / max(d1, d2)) ** 0.5
+        return min(100 * h0, h1)
+
+    def _outputs(self, values):
+        """Compute yobs, yexpr and dyexpr from y and dyobs."""
+        system = self.system
+        self.yobs_view[:] = system.observables.dot(self.y.T).T
+        self.dyobs_view[:, self._unknown] = np.nan
+        if not self.yexpr_view.shape[1]:
+            return
+        self.yexpr_view[:] = system.expression_values(self.yobs_view, values)
+        values = dict(values)
+        for o, name in enumerate(system.observable_names):
+            values[name] = self.yobs_view[:, o]
+        for e, (observables, parameters) in enumerate(
+                self._expression_derivatives):
+            self.dyexpr_view[:, e] = 0
+            for o, derivative in observables:
+                self.dyexpr_view[:, e] += (
+                    np.reshape(evaluate(derivative, values), (-1, 1)) *
+                    self.dyobs_view[:, o])
+            for c, derivative in parameters:
+                self.dyexpr_view[:, e, c] += evaluate(derivative, values)
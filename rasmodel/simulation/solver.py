@@ -0,0 +1,396 @@
+"""Integration of generated networks through MassActionSystem.
+
+Simulator follows the interface of pysb.integrate.Solver (the constructor
+arguments, run() and the y, yobs and yexpr results), so it can replace it
+in existing scripts. By default it integrates with scipy's BDF method, given
+the sparse Jacobian from MassActionSystem, so Newton iterations factorize
+the iteration matrix with a sparse LU instead of building dense
+finite-difference Jacobians over all species::
+
+    from rasmodel.simulation.solver import Simulator
+    sim = Simulator(model, tspan, atol=1e-6, rtol=1e-8)
+    sim.run()
+    sim.yobs['pERK']
+
+Species that are held fixed (never consumed, like a ligand dose) are given
+as `clamped`, by pattern or by index, and are not integrated::
+
+    sim = Simulator(model, tspan, clamped=[EGF(rec=None, comp='pm')])
+
+Grids of conditions are integrated with run_batch(), which reuses the one
+MassActionSystem and returns stacked observables::
+
+    params = [{'KRAS_0': r, 'Vem_0': v} for r in ras for v in vem]
+    yobs = sim.run_batch(params)   # (conditions, time, observables)
+
+With prune=True, species that can never become nonzero from a run's initial
+state are dropped before integrating, so e.g. an EGF-only run skips the
+HRG-specific part of the network::
+
+    sim = Simulator(model, tspan, prune=True)
+    sim.run({'HRG_0': 0})
+
+When only some observables are needed, `targets` restricts the integration
+to their dependency cone (see rasmodel.network.dependency); the results are
+exact for the targets and NaN for species outside the cone::
+
+    sim = Simulator(model, tspan, targets=['pERK', 'pAKT', 'pErbB1'])
+
+lumping='forward' or 'backward' integrates equivalent species together (see
+rasmodel.simulation.lumping), which preserves the observables exactly.
+"""
+
+import itertools
+import warnings
+import numpy as np
+import scipy.integrate
+from rasmodel.network.cache import generate_equations
+from rasmodel.network.reachability import reachable
+from rasmodel.network.dependency import dependency_cone
+from .system import MassActionSystem
+from .conservation import ReducedSystem
+from .timescale import QSSASystem
+from .lumping import (KINDS, LumpedSystem, forward_partition,
+                      backward_partition)
+
+default_integrator_options = {
+    'bdf': {},
+    'vode': {
+        'method': 'bdf',
+        'with_jacobian': True,
+        'nsteps': 2**31 - 1,
+        },
+    }
+
+
+def _record_array(n, names):
+    if names:
+        return np.ndarray(n, list(zip(names, itertools.repeat(float))))
+    return np.ndarray((n, 0))
+
+
+def batch_conditions(param_values=None, y0=None):
+    """Pair up the parameter and initial values of a batch of conditions.
+
+    Takes the param_values and y0 arguments of Simulator.run_batch and
+    returns a list of (param_values, y0) pairs, one per condition.
+    """
+    if param_values is None or isinstance(param_values, dict):
+        param_values = [param_values]
+    if y0 is None:
+        y0 = [None]
+    param_values = list(param_values)
+    y0 = list(y0)
+    n = max(len(param_values), len(y0))
+    for name, arg in ('param_values', param_values), ('y0', y0):
+        if len(arg) not in (1, n):
+            raise ValueError("%s must give 1 or %d conditions" % (name, n))
+    param_values = param_values * (n // len(param_values))
+    y0 = y0 * (n // len(y0))
+    return zip(param_values, y0)
+
+
+class Simulator(object):
+    """Integrate a model's network with array-based right hand sides.
+
+    Parameters
+    ----------
+    model : pysb.Model
+        The model. Its network is generated (through the network cache) if
+        necessary.
+    tspan : vector-like
+        Time values at which to report results.
+    use_analytic_jacobian : bool, optional
+        Whether to pass the Jacobian to the integrator. Defaults to True.
+    integrator : str, optional
+        'bdf' (the default) for scipy.integrate.solve_ivp's BDF method with
+        a sparse Jacobian, or the name of a scipy.integrate.ode integrator,
+        which is given the Jacobian in dense form.
+    clamped : list, optional
+        Species held at their initial values, as species indexes or
+        patterns (see MassActionSystem). They are left out of the integrated
+        state and reported as constants in y.
+    reduced : bool, optional
+        Whether to integrate the system reduced by its conservation laws
+        (see rasmodel.simulation.conservation.ReducedSystem). The eliminated
+        species are reconstructed in y. Defaults to False.
+    prune : bool, optional
+        Whether to leave out species that can never become nonzero from the
+        initial state of each run, and the reactions consuming them (see
+        rasmodel.network.reachability). They are reported as zeros in y.
+        Systems are built once for each set of pruned species. Defaults to
+        False.
+    targets : list, optional
+        Observables and expressions (or their names) to compute. Only the
+        species they depend on are integrated; the others, and observables
+        made of them, are NaN in the results. Defaults to all.
+    qssa : list, optional
+        Species (indexes or patterns) to hold at quasi-steady state instead
+        of integrating them (see rasmodel.simulation.timescale). Can't be
+        combined with `reduced`.
+    lumping : str, optional
+        'forward' to integrate the totals of species lumped by forward
+        bisimulation, or 'backward' to integrate the common values of
+        species lumped by backward bisimulation (see
+        rasmodel.simulation.lumping). Backward lumpings are found once for
+        each pattern of equal initial values. Can't be combined with
+        `reduced` or `qssa`. Forward lumping only keeps the totals of
+        lumped species, so their values in y are NaN; the observables,
+        which are sums over the lumped blocks, are exact.
+    **integrator_options
+        Passed on to the integrator, e.g. atol and rtol.
+
+    Attributes
+    ----------
+    stats : dict
+        Right hand side evaluations ('nfev'), Jacobian evaluations ('njev')
+        and LU decompositions ('nlu') of the last BDF integration.
+    """
+
+    def __init__(self, model, tspan, use_analytic_jacobian=True,
+                 integrator='bdf', verbose=False, clamped=(), reduced=False,
+                 prune=False, targets=None, qssa=None, lumping=None,
+                 **integrator_options):
+        generate_equations(model, verbose=verbose)
+        self.model = model
+        self.tspan = np.asarray(tspan, dtype=float)
+        self.verbose = verbose
+        self.clamped = clamped
+        self.reduced = reduced
+        if qssa is not None:
+            if reduced:
+                raise ValueError("qssa can't be combined with reduced")
+            from rasmodel.network.index import species_indexes
+            qssa = species_indexes(model, qssa)
+        self.qssa = qssa
+        if lumping is not None:
+            if lumping not in KINDS:
+                raise ValueError("lumping must be one of %s" %
+                                 ', '.join(KINDS))
+            if reduced or qssa is not None:
+                raise ValueError("lumping can't be combined with reduced "
+                                 "or qssa")
+        self.lumping = lumping
+        self.stats = {}
+        self.prune = prune
+        self._systems = {}
+        self.ignored = ()
+        if targets is not None:
+            species, reactions = dependency_cone(model, targets)
+            self.ignored = np.setdiff1d(np.arange(len(model.species)),
+                                        species)
+        self.system = self._build_system(())
+        if lumping == 'backward':
+            # Lumped by the model's initial values, for the default run.
+            self.system = self._system_for(
+                self.system.initial_values())
+        self._setup_integrator(integrator, use_analytic_jacobian,
+                               integrator_options)
+
+    def _setup_integrator(self, integrator, use_analytic_jacobian,
+                          integrator_options):
+        """Set the integrator options and allocate the result arrays."""
+        options = dict(default_integrator_options.get(integrator, {}))
+        options.update(integrator_options)
+        self.opts = options
+        self.integrator_name = integrator
+        self.use_analytic_jacobian = use_analytic_jacobian
+        self.y = np.ndarray((len(self.tspan), self.system.n_species))
+        self.yobs = _record_array(len(self.tspan),
+                                  self.system.observable_names)
+        self.yobs_view = self.yobs.view(float).reshape(len(self.yobs), -1)
+        self.yexpr = _record_array(len(self.tspan),
+                                   [e.name for e in
+                                    self.system.dynamic_expressions])
+        self.yexpr_view = self.yexpr.view(float).reshape(len(self.yexpr), -1)
+
+    def _build_system(self, pruned, y0=None):
+        system = MassActionSystem(self.model, self.clamped, pruned,
+                                  self.ignored)
+        if self.reduced:
+            system = ReducedSystem(system)
+        if self.qssa is not None:
+            system = QSSASystem(system, self.qssa)
+        if self.lumping == 'forward':
+            system = LumpedSystem(system, forward_partition(system),
+                                  'forward')
+        elif self.lumping == 'backward' and y0 is not None:
+            system = LumpedSystem(system, backward_partition(
+                system, system.state(y0)), 'backward')
+        return system
+
+    def _system_for(self, y0):
+        """Return the system for a run from y0: without the species
+        unreachable from y0 if pruning, and lumped by y0's equal values if
+        lumping backward. Systems are cached by these."""
+        pruned = ()
+        if self.prune:
+            species, reactions = reachable(self.model, y0 != 0)
+            pruned = tuple(np.nonzero(~species)[0])
+        key = pruned
+        if self.lumping == 'backward':
+            key = (pruned, tuple(np.unique(y0, return_inverse=True)[1]))
+        elif not pruned:
+            return self.system
+        system = self._systems.get(key)
+        if system is None:
+            system = self._systems[key] = self._build_system(pruned, y0)
+        return system
+
+    def _rhs(self, t, y, system, k, values):
+        return system.rhs(y, k, values)
+
+    def _dense_jacobian(self, t, y, system, k, values):
+        return system.jacobian(y, k, values).toarray()
+
+    def _integrator(self):
+        jac = self._dense_jacobian if self.use_analytic_jacobian else None
+        integrator = scipy.integrate.ode(self._rhs, jac=jac)
+        with warnings.catch_warnings():
+            warnings.filterwarnings('error', 'No integrator name match')
+            integrator.set_integrator(self.integrator_name, **self.opts)
+        return integrator
+
+    def run(self, param_values=None, y0=None):
+        """Perform an integration.
+
+        Parameters
+        ----------
+        param_values : vector-like or dict, optional
+            Parameter values in model.parameters order, or a dict of values
+            by name overriding the model's. Defaults to the model's values.
+        y0 : vector-like, optional
+            Initial species values in model.species order. Defaults to the
+            model's initial conditions. Clamped species keep these values.
+        """
+        values = self._integrate(param_values, y0, self.y, self.yobs_view)
+        self._outputs(values)
+
+    def run_batch(self, param_values=None, y0=None, expressions=False):
+        """Integrate a batch of conditions and return their observables.
+
+        Every condition is integrated with the same MassActionSystem, so
+        there is no per-condition network or code generation; only the rate
+        constants and initial values change. The y, yobs and yexpr
+        attributes are not modified.
+
+        Parameters
+        ----------
+        param_values : 2D array-like or list of dicts, optional
+            One parameter vector (model.parameters order) or dict of
+            overrides per condition, as for run().
+        y0 : 2D array-like, optional
+            One initial species vector per condition. Rows that are None, or
+            a y0 of None, use the initial conditions for the condition's
+            parameters.
+
+            If either of param_values and y0 is omitted or gives a single
+            condition, it is repeated for every condition of the other.
+        expressions : bool, optional
+            Also return the dynamic expressions.
+
+        Returns
+        -------
+        yobs : numpy.ndarray
+            Observable values shaped (conditions, time, observables), in
+            model.observables order. If `expressions` is True, a second
+            array shaped (conditions, time, expressions) is also returned.
+        """
+        conditions = batch_conditions(param_values, y0)
+        yobs = np.empty(self.batch_shape(len(conditions)))
+        yexpr = np.empty(self.batch_shape(len(conditions), expressions=True))
+        for c, (p, y) in enumerate(conditions):
+            self.run_condition(p, y, yobs[c],
+                               yexpr[c] if expressions else None)
+        if expressions:
+            return yobs, yexpr
+        return yobs
+
+    def batch_shape(self, n, expressions=False):
+        """Shape of run_batch's observable (or expression) array."""
+        if expressions:
+            return n, len(self.tspan), len(self.system.dynamic_expressions)
+        return n, len(self.tspan), len(self.system.observable_names)
+
+    def run_condition(self, param_values, y0, yobs, yexpr=None):
+        """Integrate one condition, writing observables into `yobs`.
+
+        `yobs` (and `yexpr`, if given) are (time, observables) and (time,
+        expressions) arrays, e.g. rows of the arrays run_batch() returns.
+        The y, yobs and yexpr attributes are not modified.
+        """
+        system = self.system
+        y = np.empty((len(self.tspan), system.n_species))
+        values = self._integrate(param_values, y0, y, yobs)
+        if yexpr is not None and yexpr.shape[1]:
+            yexpr[:] = system.expression_values(yobs, values)
+
+    def _integrate(self, param_values, y0, out, yobs):
+        """Integrate one condition into `out` and its observables into
+        `yobs`, returning parameter values."""
+        system = self.system
+        param_values = system.parameter_vector(param_values)
+        values = system.values(param_values)
+        if y0 is None:
+            y0 = system.initial_values(param_values)
+        elif len(y0) != system.n_species:
+            raise ValueError("y0 must be the same length as model.species")
+        y0 = np.asarray(y0, dtype=float)
+        if self.prune or self.lumping == 'backward':
+            system = self._system_for(y0)
+        k = system.rate_constants(param_values)
+        x0 = system.initial_state(y0)
+        if self.integrator_name == 'bdf':
+            x = self._run_bdf(system, x0, k, values)
+        else:
+            x = self._run_ode(system, x0, k, values)
+        out[:] = system.full_state(x)
+        if self.lumping == 'forward':
+            # Lumped species are NaN in `out`, but the observables are sums
+            # over blocks and follow from the block totals.
+            yobs[:] = system.observables.dot(system.total_state(x).T).T
+        else:
+            yobs[:] = system.observables.dot(out.T).T
+        return values
+
+    def _run_bdf(self, system, y0, k, values):
+        options = dict(self.opts)
+        if self.use_analytic_jacobian:
+            options['jac'] = lambda t, y: system.jacobian(y, k, values)
+        result = scipy.integrate.solve_ivp(
+            lambda t, y: system.rhs(y, k, values),
+            (self.tspan[0], self.tspan[-1]), y0, method='BDF',
+            t_eval=self.tspan, **options)
+        self.stats = {'nfev': result.nfev, 'njev': result.njev,
+                      'nlu': result.nlu}
+        y = np.empty((len(self.tspan), len(y0)))
+        n = result.y.shape[1]
+        y[:n] = result.y.T
+        y[n:] = np.nan
+        if not result.success:
+            warnings.warn(result.message)
+        elif self.verbose:
+            print result.message
+        return y
+
+    def _run_ode(self, system, y0, k, values):
+        integrator = self._integrator()
+        integrator.set_initial_value(y0, self.tspan[0])
+        integrator.set_f_params(system, k, values)
+        if self.use_analytic_jacobian:
+            integrator.set_jac_params(system, k, values)
+        y = np.empty((len(self.tspan), len(y0)))
+        y[0] = y0
+        i = 1
+        while integrator.successful() and i < len(self.tspan):
+            y[i] = integrator.integrate(self.tspan[i])
+            i += 1
+        if not integrator.successful():
+            y[i - 1:] = np.nan
+        return y
+
+    def _outputs(self, values):
+        """Compute yexpr from yobs."""
+        if self.yexpr_view.shape[1]:
+            self.yexpr_view[:] = self.system.expression_values(
+                self.yobs_view, values)
@@ -0,0 +1,393 @@
+"""Direct computation of steady states.
+
+Integrating to a long end time and keeping the last point spends most of the
+work on a transient that is thrown away. SteadyStateSolver instead solves
+S v(y) = 0 directly:
+
+ 1. Newton iteration on the conservation-reduced system (the independent
+    rows of S v(y) = 0 plus the conservation laws with the totals of the
+    initial state; see rasmodel.simulation.conservation). Each iteration is
+    one sparse LU solve with the analytic Jacobian, damped by the natural
+    monotonicity test so that steps from a distant start still converge.
+ 2. If Newton fails, pseudo-transient continuation: linearized implicit
+    Euler steps (I/dt - J) dy = S v(y) with dt growing geometrically, which
+    follow the trajectory early on and become Newton's method near the
+    steady state. The steps hold the conservation laws exactly.
+ 3. If that fails too, time integration (BDF) to t_end, then Newton from
+    the final state.
+
+Given a guess, such as the steady state of a nearby condition, solve() first
+tries Newton from the guess and then continuation from the guess moved onto
+the conserved totals of the condition, before the starts above.
+
+Models that degrade species without synthesizing any, such as
+rasmodel.chen_2009 (receptor complexes are degraded in endosomes and never
+made), have no nontrivial steady state: every species that can reach a
+degradation step eventually drains to zero. solve() can be expected to fail
+on them, since the drain is too slow for continuation or integration to
+t_end to finish, or at best to return the drained state; simulate them over
+a finite time instead.
+
+scan() solves a batch of conditions, starting each one from the solution of
+the nearest condition already solved::
+
+    from rasmodel.simulation.steady import SteadyStateSolver
+    solver = SteadyStateSolver(model)
+    results = solver.scan([{'KRAS_0': r, 'Vem_0': v}
+                           for r in ras for v in vem])
+    yobs = np.array([s.yobs for s in results])   # (conditions, observables)
+"""
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+import scipy.integrate
+from rasmodel.network.cache import generate_equations
+from .system import MassActionSystem
+from .solver import batch_conditions
+from .conservation import conservation_laws
+
+
+class SteadyState(object):
+    """The result of SteadyStateSolver.solve.
+
+    Attributes
+    ----------
+    y : numpy.ndarray
+        Species values, in model.species order.
+    yobs : numpy.ndarray
+        Observable values, in model.observables order.
+    converged : bool
+        Whether the last Newton step was within tolerance.
+    method : str
+        The method that produced y: 'warm' (Newton from the given guess),
+        'warm-ptc' (pseudo-transient continuation from the guess), 'newton'
+        (from the initial state), 'ptc' (continuation from the initial
+        state) or 'integration', each followed by Newton iterations.
+    iterations : int
+        Total Newton and continuation iterations over all attempts.
+    residual : float
+        max |dy/dt| at y.
+    attempts : list of (str, int, bool)
+        Method, iterations and success of each attempt, in order.
+    """
+
+    def __init__(self, y, yobs, converged, method, iterations, residual,
+                 attempts):
+        self.y = y
+        self.yobs = yobs
+        self.converged = converged
+        self.method = method
+        self.iterations = iterations
+        self.residual = residual
+        self.attempts = attempts
+
+    def __repr__(self):
+        return ('<%s %s by %s, %d iterations, residual %g>' %
+                (self.__class__.__name__,
+                 'converged' if self.converged else 'NOT converged',
+                 self.method, self.iterations, self.residual))
+
+
+class _Failed(Exception):
+    pass
+
+
+class SteadyStateSolver(object):
+    """Find steady states of a model's network.
+
+    Parameters
+    ----------
+    model : pysb.Model
+        The model. Its network is generated (through the network cache) if
+        necessary.
+    clamped : list, optional
+        Species held at their initial values, as for Simulator.
+    rtol, atol : float, optional
+        Newton iteration stops when every component of the step is below
+        atol + rtol * |y|.
+    max_newton : int, optional
+        Maximum Newton iterations per attempt.
+    max_warm : int, optional
+        Maximum Newton iterations from a warm start, after which the other
+        methods are tried.
+    max_ptc : int, optional
+        Maximum pseudo-transient continuation steps.
+    t_end : float, optional
+        End time of the fallback integration.
+    """
+
+    def __init__(self, model, clamped=(), rtol=1e-8, atol=1e-6,
+                 max_newton=50, max_warm=10, max_ptc=500, t_end=1e6,
+                 verbose=False):
+        generate_equations(model, verbose=verbose)
+        self.model = model
+        self.system = MassActionSystem(model, clamped)
+        self.rtol = rtol
+        self.atol = atol
+        self.max_newton = max_newton
+        self.max_warm = max_warm
+        self.max_ptc = max_ptc
+        self.t_end = t_end
+        self.verbose = verbose
+        laws, self.independent = conservation_laws(self.system.stoichiometry)
+        self.laws = scipy.sparse.csr_matrix(laws)
+
+    def _weights(self, y):
+        return 1.0 / (self.atol + self.rtol * np.abs(y))
+
+    def _newton(self, y, k, values, totals, max_iterations=None):
+        """Newton iteration on the conservation-reduced system.
+
+        Steps are damped by the natural monotonicity test (Deuflhard): a
+        damped step is accepted if the Newton correction at the new point,
+        computed with the same factorization, is smaller than the step
+        itself. Unlike a test on the residual, this is invariant to the
+        scaling of the equations, so a warm start whose conserved totals
+        are off (a large linear residual that a full step removes) still
+        takes full steps.
+        """
+        max_iterations = max_iterations or self.max_newton
+        system = self.system
+        laws = self.laws
+
+        def residual(y):
+            return np.concatenate((
+                system.rhs(y, k, values)[self.independent],
+                laws.dot(y) - totals))
+
+        r = residual(y)
+        damping = 1.0
+        for iteration in range(1, max_iterations + 1):
+            jacobian = system.jacobian(y, k, values).tocsr()[self.independent]
+            a = scipy.sparse.vstack([jacobian, laws]).tocsc()
+            try:
+                lu = scipy.sparse.linalg.splu(a)
+            except RuntimeError:
+                raise _Failed(iteration)
+            step = -lu.solve(r)
+            if not np.all(np.isfinite(step)):
+                raise _Failed(iteration)
+            weights = self._weights(y)
+            norm = np.linalg.norm(step * weights)
+            if np.all(np.abs(step) * weights < 1):
+                y = y + step
+                return y, iteration
+            # Start from twice the last accepted damping, so damping is
+            # relaxed again as iterations approach the solution.
+            damping = min(1.0, 2 * damping)
+            while True:
+                y_new = y + damping * step
+                if np.all(y_new >= -self.atol):
+                    r_new = residual(y_new)
+                    simplified = lu.solve(r_new)
+                    if np.all(np.isfinite(simplified)) and \
+                            np.linalg.norm(simplified * weights) <= \
+                            (1 - damping / 4) * norm:
+                        break
+                damping /= 2
+                if damping < 1e-6:
+                    raise _Failed(iteration)
+            y, r = y_new, r_new
+        raise _Failed(max_iterations)
+
+    def _project(self, y, totals, base):
+        """Move a warm start onto the conserved totals of a condition.
+
+        The steady state of a neighbouring condition has that condition's
+        totals, and moving to the new ones in a single linear step can make
+        species negative. Instead, each species of `base` (`y` with room for
+        species that are zero in it) is scaled by exp(laws.T * mu), which
+        keeps it positive, and mu is found by damped Newton iteration on the
+        (convex) dual problem, so that laws * result = totals. Species that
+        no law involves are left unchanged.
+        """
+        laws = self.laws
+        tolerance = self.atol + self.rtol * np.abs(totals)
+        mu = np.zeros(laws.shape[0])
+
+        def dual(mu):
+            z = base * np.exp(laws.T.dot(mu))
+            return z, z.sum() - mu.dot(totals)
+
+        z, objective = dual(mu)
+        for iteration in range(1, self.max_newton + 1):
+            gradient = laws.dot(z) - totals
+            if np.all(np.abs(gradient) <= tolerance):
+                return z
+            hessian = laws.multiply(z).dot(laws.T).toarray()
+            step = -np.linalg.lstsq(hessian, gradient, rcond=None)[0]
+            # Change no species by more than a factor e^5 per iteration.
+            step *= min(1.0, 5 / max(np.abs(laws.T.dot(step)).max(), 1e-300))
+            while True:
+                z_new, objective_new = dual(mu + step)
+                if objective_new <= objective + 1e-4 * gradient.dot(step):
+                    break
+                step /= 2
+                if np.abs(step).max() < 1e-12:
+                    raise _Failed(iteration)
+            mu += step
+            z, objective = z_new, objective_new
+        raise _Failed(self.max_newton)
+
+    def _ptc(self, y, k, values, totals):
+        """Pseudo-transient continuation toward a steady state.
+
+        Each step solves (I/dt - J) dy = S v(y) on the independent rows,
+        with the conservation laws held exactly. dt doubles after every
+        accepted step and is cut when a step would make species negative.
+        Once steps fall within tolerance, Newton iteration is tried from
+        the current state.
+        """
+        system = self.system
+        identity = scipy.sparse.identity(system.n_state, format='csr')
+        identity = identity[self.independent]
+        f = system.rhs(y, k, values)
+        dt = 1.0 / max(np.abs(system.jacobian(y, k, values).diagonal()).max(),
+                       1e-12)
+        newton_dt = 0
+        for iteration in range(1, self.max_ptc + 1):
+            jacobian = system.jacobian(y, k, values).tocsr()[self.independent]
+            a = scipy.sparse.vstack([identity / dt - jacobian,
+                                     self.laws]).tocsc()
+            rhs = np.concatenate((f[self.independent],
+                                  totals - self.laws.dot(y)))
+            try:
+                step = scipy.sparse.linalg.splu(a).solve(rhs)
+            except RuntimeError:
+                step = None
+            if step is None or not np.all(np.isfinite(step)) or \
+                    np.any(y + step < -self.atol):
+                dt /= 4
+                if dt < 1e-12:
+                    raise _Failed(iteration)
+                continue
+            y = y + step
+            f = system.rhs(y, k, values)
+            dt *= 2
+            if np.all(np.abs(step) * self._weights(y) < 1) and \
+                    dt > 10 * newton_dt:
+                newton_dt = dt
+                try:
+                    y, newton_iterations = self._newton(y, k, values, totals)
+                except _Failed:
+                    continue
+                return y, iteration + newton_iterations
+        raise _Failed(self.max_ptc)
+
+    def _warm_ptc(self, guess, x0, k, values, totals):
+        """Pseudo-transient continuation from a warm start, moved onto the
+        conserved totals first (see _project). Species that are zero in the
+        guess get room from the initial state x0."""
+        base = np.maximum(guess, self.atol) + 1e-3 * x0
+        return self._ptc(self._project(guess, totals, base), k, values,
+                         totals)
+
+    def _integrate(self, y, k, values):
+        system = self.system
+        result = scipy.integrate.solve_ivp(
+            lambda t, y: system.rhs(y, k, values), (0, self.t_end), y,
+            method='BDF', rtol=self.rtol, atol=self.atol,
+            jac=lambda t, y: system.jacobian(y, k, values))
+        if not result.success:
+            raise _Failed(len(result.t))
+        return result.y[:, -1], len(result.t)
+
+    def solve(self, param_values=None, y0=None, guess=None):
+        """Find the steady state reached from an initial state.
+
+        Parameters
+        ----------
+        param_values : vector-like or dict, optional
+            Parameter values, as for Simulator.run.
+        y0 : vector-like, optional
+            Initial species values, as for Simulator.run. The steady state
+            has the same conserved totals (and clamped values) as y0.
+        guess : vector-like, optional
+            Species values to start Newton iteration from, e.g. the steady
+            state of a nearby condition. y0 is used if it is omitted or
+            Newton fails from it.
+
+        Returns
+        -------
+        SteadyState
+        """
+        system = self.system
+        param_values = system.parameter_vector(param_values)
+        values = system.values(param_values)
+        k = system.rate_constants(param_values)
+        if y0 is None:
+            y0 = system.initial_values(param_values)
+        elif len(y0) != system.n_species:
+            raise ValueError("y0 must be the same length as model.species")
+        x0 = system.initial_state(y0)
+        totals = self.laws.dot(x0)
+
+        attempts = []
+        starts = []
+        if guess is not None:
+            x_guess = system.state(guess)
+            starts.append(('warm', lambda: (x_guess, 0), self.max_warm))
+            starts.append(('warm-ptc', lambda: self._warm_ptc(
+                x_guess, x0, k, values, totals), None))
+        starts.append(('newton', lambda: (x0, 0), None))
+        starts.append(('ptc', lambda: self._ptc(x0, k, values, totals), None))
+        starts.append(('integration', lambda: self._integrate(x0, k, values),
+                       None))
+        x = x0
+        converged = False
+        for method, start, max_iterations in starts:
+            try:
+                x, iterations = start()
+            except _Failed as e:
+                attempts.append((method, e.args[0], False))
+                continue
+            try:
+                x, newton_iterations = self._newton(x, k, values, totals,
+                                                    max_iterations)
+            except _Failed as e:
+                attempts.append((method, iterations + e.args[0], False))
+                continue
+            attempts.append((method, iterations + newton_iterations, True))
+            converged = True
+            break
+        if self.verbose:
+            print attempts
+        y = system.full_state(x)
+        return SteadyState(y, system.observables.dot(y), converged, method,
+                           sum(a[1] for a in attempts),
+                           np.abs(system.rhs(x, k, values)).max(), attempts)
+
+    def scan(self, param_values=None, y0=None, warm_start=True):
+        """Solve a batch of conditions in order.
+
+        The conditions are given as for Simulator.run_batch. With
+        `warm_start`, each condition starts from the steady state of the
+        nearest condition solved before it: the one whose parameter and
+        initial values differ least, relative to their ranges over the
+        batch. Returns a list of SteadyState.
+        """
+        system = self.system
+        conditions = batch_conditions(param_values, y0)
+        features = []
+        for p, y in conditions:
+            p = system.parameter_vector(p)
+            if y is None:
+                y = system.initial_values(p)
+            features.append(np.concatenate((p, y)))
+        features = np.array(features)
+        ranges = features.ptp(axis=0)
+        ranges[ranges == 0] = 1
+        results = []
+        solved = []
+        for i, (p, y) in enumerate(conditions):
+            guess = None
+            if warm_start and solved:
+                distances = (np.abs(features[solved] - features[i]) /
+                             ranges).sum(axis=1)
+                guess = results[solved[distances.argmin()]].y
+            result = self.solve(p, y, guess)
+            results.append(result)
+            if result.converged:
+                solved.append(i)
+        return results
@@ -0,0 +1,94 @@
+"""Parallel parameter sweeps over forked worker processes.
+
+run_sweep integrates the same conditions as Simulator.run_batch, but spreads
+them over a pool of processes. The pool is forked after the Simulator is
+built, so the workers inherit the generated network and MassActionSystem
+instead of rebuilding or unpickling them. Conditions are handed out one at a
+time as workers become free, so a few stiff, slow conditions (e.g. one corner
+of a grid) don't hold up a statically assigned share of the work. Workers
+write their results directly into arrays in shared memory and only send
+back the index of each finished condition::
+
+    from rasmodel.simulation.solver import Simulator
+    from rasmodel.simulation.sweep import run_sweep
+    sim = Simulator(model, tspan)
+    params = [{'KRAS_0': r, 'Vem_0': v} for r in ras for v in vem]
+    yobs = run_sweep(sim, params)   # (conditions, time, observables)
+
+Forking is required; where it is not available (or with processes=1), the
+conditions are run in this process.
+"""
+
+import os
+import multiprocessing
+import multiprocessing.sharedctypes
+import numpy as np
+from .solver import batch_conditions
+
+# State inherited by forked workers: the simulator, the conditions and the
+# shared output arrays.
+_sweep = None
+
+
+def _shared_array(shape):
+    """Return a numpy view of a new float array in shared memory."""
+    size = int(np.prod(shape))
+    buf = multiprocessing.sharedctypes.RawArray('d', max(size, 1))
+    return np.frombuffer(buf, dtype=float, count=size).reshape(shape)
+
+
+def _run_condition(c):
+    simulator, conditions, yobs, yexpr = _sweep
+    param_values, y0 = conditions[c]
+    simulator.run_condition(param_values, y0, yobs[c],
+                            yexpr[c] if yexpr is not None else None)
+    return c
+
+
+def run_sweep(simulator, param_values=None, y0=None, expressions=False,
+              processes=None):
+    """Integrate a batch of conditions over a pool of worker processes.
+
+    Parameters
+    ----------
+    simulator : Simulator
+        Simulator for the model and time points. It is inherited, not
+        copied, by the workers.
+    param_values, y0, expressions
+        The conditions and outputs, as for Simulator.run_batch.
+    processes : int, optional
+        Number of worker processes. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    The same arrays as Simulator.run_batch.
+    """
+    global _sweep
+    conditions = batch_conditions(param_values, y0)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(conditions))
+    if processes <= 1 or not hasattr(os, 'fork'):
+        return simulator.run_batch(param_values, y0, expressions)
+
+    yobs = _shared_array(simulator.batch_shape(len(conditions)))
+    yexpr = None
+    if expressions:
+        yexpr = _shared_array(simulator.batch_shape(len(conditions),
+                                                    expressions=True))
+    _sweep = (simulator, conditions, yobs, yexpr)
+    pool = multiprocessing.Pool(processes)
+    try:
+        for c in pool.imap_unordered(_run_condition, range(len(conditions)),
+                                     chunksize=1):
+            pass
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        _sweep = None
+    if expressions:
+        return yobs, yexpr
+    return yobs
@@ -0,0 +1,617 @@
+"""Numeric form of a generated reaction network.
+
+pysb.integrate.Solver turns model.odes into one sympy expression per species
+and generates code from them, which is slow to build and evaluates every
+species' equation separately. MassActionSystem instead reads
+model.reactions once into arrays:
+
+ - a sparse stoichiometry matrix S (species x reactions),
+ - an integer array of reactant indexes for each reaction,
+ - a rate constant vector k, evaluated from the parameter values,
+
+so the right hand side is ``S * (k * prod(y[reactants]))``, a handful of
+NumPy operations. Reaction rates may also include expressions that depend on
+observables; these are evaluated from the current observable values at every
+step.
+
+Building the system does not generate or compile any code. Expressions are
+evaluated by walking their (already constructed) expression trees.
+
+The Jacobian is assembled in sparse CSC form. Its sparsity pattern is fixed
+when the system is built, and each evaluation only recomputes the partial
+derivatives of the fluxes and maps them onto the stored pattern with one
+sparse matrix-vector product. If some rates depend on observables, the
+mass-action Jacobian is incomplete; jacobian() then falls back to finite
+differences over column groups found by coloring the sparsity pattern, so
+the cost is a few RHS evaluations rather than one per species.
+
+Species can be clamped (held at fixed values, e.g. a ligand dose that is
+never consumed). Clamped species are left out of the state vector, the
+stoichiometry and the Jacobian, and enter the fluxes as constants set through
+clamped_values, so the same system can be reused for any clamp values::
+
+    system = MassActionSystem(model, clamped=[EGF(rec=None, comp='pm')])
+    y0 = system.initial_values()
+    system.clamped_values = y0[system.clamped]
+    dydt = system.rhs(system.state(y0), system.rate_constants())
+
+Species known to stay zero (see rasmodel.network.reachability) can be
+pruned. They are left out like clamped species, held at zero, and the
+reactions consuming them are dropped, so a simulation that never activates
+part of the network does not pay for it.
+
+Species that cannot influence the quantities of interest (see
+rasmodel.network.dependency) can be ignored. They are left out of the state
+too, but are not computed at all; full_state() reports them as NaN.
+"""
+
+import numpy as np
+import scipy.sparse
+import sympy
+import pysb
+
+
+def evaluate(expr, values):
+    """Numerically evaluate a sympy expression built from pysb components.
+
+    `values` maps component names to numbers or arrays. Named expressions
+    not in `values` are evaluated recursively. Only sums, products, powers
+    and numbers are supported, which covers pysb rate expressions.
+    """
+    if isinstance(expr, sympy.Symbol):
+        try:
+            return values[expr.name]
+        except KeyError:
+            if isinstance(expr, pysb.Expression):
+                return evaluate(expr.expr, values)
+            raise
+    if isinstance(expr, sympy.Number):
+        return float(expr)
+    if isinstance(expr, sympy.Add):
+        return sum(evaluate(a, values) for a in expr.args)
+    if isinstance(expr, sympy.Mul):
+        result = 1.0
+        for a in expr.args:
+            result = result * evaluate(a, values)
+        return result
+    if isinstance(expr, sympy.Pow):
+        return evaluate(expr.base, values) ** evaluate(expr.exp, values)
+    raise NotImplementedError("Can't evaluate expression: %s" % expr)
+
+
+def parameter_derivatives(expr):
+    """Return the partial derivatives of a rate factor or initial value.
+
+    `expr` is a Parameter, an Expression or a sympy expression of them.
+    Returns (parameter name, derivative) pairs, with the derivatives as
+    sympy expressions for evaluate().
+    """
+    if isinstance(expr, pysb.Parameter):
+        return [(expr.name, sympy.Integer(1))]
+    if isinstance(expr, pysb.Expression):
+        expr = expr.expand_expr()
+    parameters = sorted(expr.atoms(pysb.Parameter), key=lambda p: p.name)
+    return [(p.name, sympy.diff(expr, p)) for p in parameters]
+
+
+def _rate_factors(reaction):
+    """Split a reaction rate into a number and the names of its symbols."""
+    number = 1.0
+    names = []
+    for factor in sympy.Mul.make_args(reaction['rate']):
+        if isinstance(factor, sympy.Number):
+            number *= float(factor)
+            continue
+        base = factor.base if isinstance(factor, sympy.Pow) else factor
+        if not isinstance(base, sympy.Symbol):
+            raise NotImplementedError("Unsupported rate term: %s" % factor)
+        if not base.name.startswith('__s'):
+            if base is not factor:
+                raise NotImplementedError("Unsupported rate term: %s" % factor)
+            names.append(base.name)
+    return number, names
+
+
+class MassActionSystem(object):
+    """Array form of the reaction network of a model.
+
+    The model's network must already have been generated. Parameter values
+    are passed as a vector in model.parameters order, as for
+    pysb.integrate.Solver.
+
+    Parameters
+    ----------
+    model : pysb.Model
+        The model, with its network generated.
+    clamped : list, optional
+        Species to hold constant, as species indexes or patterns (see
+        rasmodel.network.index.species_indexes).
+    pruned : list of int, optional
+        Species that stay zero. They are left out of the state and the
+        reactions with a pruned reactant are dropped; no remaining reaction
+        may produce a pruned species.
+    ignored : list of int, optional
+        Species whose values are not computed. They are left out of the
+        state and the reactions with an ignored reactant are dropped; those
+        reactions may not change any other species.
+
+    Attributes
+    ----------
+    free, clamped : numpy.ndarray of int
+        Indexes in model.species of the integrated and the clamped species.
+        The state vector taken by rhs() and jacobian() holds the free species
+        in this order; it is the whole species vector if nothing is clamped.
+    pruned, ignored : numpy.ndarray of int
+        Indexes in model.species of the pruned and the ignored species.
+    reactions : numpy.ndarray of int
+        Indexes in model.reactions of the reactions kept, in the order of
+        fluxes() and the stoichiometry columns.
+    stoichiometry : scipy.sparse.csr_matrix
+        Net stoichiometry, free species by reactions.
+    reactants : numpy.ndarray of int
+        Reactant species of each reaction, reactions by maximum order, padded
+        with the index n_species (which refers to a constant 1).
+    observables : scipy.sparse.csr_matrix
+        Observable coefficients, observables by species.
+    """
+
+    def __init__(self, model, clamped=(), pruned=(), ignored=()):
+        if not model.reactions:
+            raise ValueError("Model network has not been generated")
+        self.model = model
+        self.n_species = n = len(model.species)
+        if clamped:
+            from rasmodel.network.index import species_indexes
+            clamped = species_indexes(model, clamped)
+        self.pruned = np.unique(np.asarray(pruned, dtype=int))
+        self.ignored = np.setdiff1d(np.asarray(ignored, dtype=int),
+                                    self.pruned)
+        removed = np.union1d(self.pruned, self.ignored)
+        self.clamped = np.setdiff1d(np.asarray(clamped, dtype=int), removed)
+        self.free = np.setdiff1d(np.arange(n),
+                                 np.union1d(self.clamped, removed))
+        self.n_state = len(self.free)
+        # Jacobian column of each species (-1 for clamped, pruned and ignored
+        # species and for the constant padding index).
+        self._columns = np.empty(n + 1, dtype=int)
+        self._columns.fill(-1)
+        self._columns[self.free] = np.arange(self.n_state)
+        is_pruned = np.zeros(n, dtype=bool)
+        is_pruned[self.pruned] = True
+        is_removed = np.zeros(n, dtype=bool)
+        is_removed[removed] = True
+        kept = []
+        for j, r in enumerate(model.reactions):
+            if not is_removed[list(r['reactants'])].any():
+                kept.append(j)
+                if is_pruned[list(r['products'])].any():
+                    raise ValueError("Reaction %d produces a pruned species"
+                                     % j)
+            elif not is_pruned[list(r['reactants'])].any():
+                changed = [i for i in set(r['reactants'] + r['products'])
+                           if self._columns[i] >= 0 and
+                           r['reactants'].count(i) != r['products'].count(i)]
+                if changed:
+                    raise ValueError("Reaction %d consumes an ignored "
+                                     "species and changes a computed one" % j)
+        self.reactions = np.array(kept, dtype=int)
+        reactions = [model.reactions[j] for j in self.reactions]
+        self.n_reactions = m = len(reactions)
+        self.parameter_names = [p.name for p in model.parameters]
+        self.dynamic_expressions = list(model.expressions_dynamic())
+        dynamic = dict((e.name, i) for i, e in
+                       enumerate(self.dynamic_expressions))
+
+        order = max([len(r['reactants']) for r in reactions] or [1])
+        self.reactants = np.empty((m, max(order, 1)), dtype=int)
+        self.reactants.fill(n)
+        rows = []
+        cols = []
+        data = []
+        self.rate_numbers = np.empty(m)
+        # (reaction, constant name) and (reaction, dynamic expression) pairs.
+        constant_terms = []
+        dynamic_terms = []
+        for j, r in enumerate(reactions):
+            self.reactants[j, :len(r['reactants'])] = r['reactants']
+            net = {}
+            for i in r['reactants']:
+                net[i] = net.get(i, 0) - 1
+            for i in r['products']:
+                net[i] = net.get(i, 0) + 1
+            for i, c in net.items():
+                if c:
+                    rows.append(i)
+                    cols.append(j)
+                    data.append(c)
+            number, names = _rate_factors(r)
+            self.rate_numbers[j] = number
+            for name in names:
+                if name in dynamic:
+                    dynamic_terms.append((j, dynamic[name]))
+                else:
+                    constant_terms.append((j, name))
+        self.stoichiometry = scipy.sparse.csr_matrix(
+            (data, (rows, cols)), shape=(n, m), dtype=float)[self.free]
+        self.constant_names = sorted(set(name for j, name in constant_terms))
+        components = model.all_components()
+        self._constants = [components[name] for name in self.constant_names]
+        position = dict((name, i) for i, name in
+                        enumerate(self.constant_names))
+        self._constant_reactions = np.array([j for j, name in
+                                             constant_terms], dtype=int)
+        self._constant_index = np.array([position[name] for j, name in
+                                         constant_terms], dtype=int)
+        self._dynamic_reactions = np.array([j for j, e in dynamic_terms],
+                                           dtype=int)
+        self._dynamic_index = np.array([e for j, e in dynamic_terms],
+                                       dtype=int)
+
+        self.observable_names = [o.name for o in model.observables]
+        rows = []
+        cols = []
+        data = []
+        for i, obs in enumerate(model.observables):
+            rows.extend([i] * len(obs.species))
+            cols.extend(obs.species)
+            data.extend(obs.coefficients)
+        self.observables = scipy.sparse.csr_matrix(
+            (data, (rows, cols)), shape=(len(model.observables), n),
+            dtype=float)
+        # Full species vector: free species are written in at every
+        # evaluation, clamped species hold clamped_values, pruned and ignored
+        # ones 0.
+        self._y = np.zeros(n + 1)
+        self._y[n] = 1.0
+        self._build_jacobian_pattern()
+
+    def _build_jacobian_pattern(self):
+        """Precompute the structure of the Jacobian.
+
+        Each reactant slot (reaction j, position s) contributes the partial
+        derivative of flux j with respect to its species. The Jacobian entry
+        (p, i) sums S[p, j] times those derivatives over all slots of species
+        i, so J.data = M * slot_derivatives for a fixed sparse matrix M.
+        Slots of clamped species have no column and are left out.
+        """
+        n = self.n_state
+        columns = self._columns
+        m, order = self.reactants.shape
+        slots = [(j, s) for j in range(m) for s in range(order)
+                 if columns[self.reactants[j, s]] >= 0]
+        self._slot_reactions = np.array([j for j, s in slots], dtype=int)
+        self._slot_positions = np.array([s for j, s in slots], dtype=int)
+        by_reaction = {}
+        for q, (j, s) in enumerate(slots):
+            by_reaction.setdefault(j, []).append(q)
+        stoichiometry = self.stoichiometry.tocsc()
+        entries = {}
+        rows = []
+        cols = []
+        data = []
+        for j in range(m):
+            start, end = stoichiometry.indptr[j], stoichiometry.indptr[j + 1]
+            for p, c in zip(stoichiometry.indices[start:end],
+                            stoichiometry.data[start:end]):
+                for q in by_reaction.get(j, ()):
+                    i = columns[self.reactants[j, self._slot_positions[q]]]
+                    e = entries.setdefault((p, i), len(entries))
+                    rows.append(e)
+                    cols.append(q)
+                    data.append(c)
+        # Observable-dependent rates couple the species of the observables
+        # they read to the species their reactions change.
+        if self.has_dynamic_rates:
+            read = set()
+            for expr in self.dynamic_expressions:
+                for atom in expr.expand_expr().atoms(pysb.Observable):
+                    read.update(columns[i] for i in atom.species
+                                if columns[i] >= 0)
+            for j in set(self._dynamic_reactions):
+                start, end = stoichiometry.indptr[j], stoichiometry.indptr[j + 1]
+                for p in stoichiometry.indices[start:end]:
+                    for i in read:
+                        entries.setdefault((p, i), len(entries))
+        # Order the entries column-major so J.data can be used directly.
+        order = sorted(entries, key=lambda (p, i): (i, p))
+        position = np.empty(len(entries), dtype=int)
+        for k, key in enumerate(order):
+            position[entries[key]] = k
+        self._jacobian_map = scipy.sparse.csr_matrix(
+            (data, (position[np.array(rows, dtype=int)], cols)),
+            shape=(len(entries), len(slots)))
+        self._jacobian_rows = np.array([p for p, i in order], dtype=int)
+        self._jacobian_cols = np.array([i for p, i in order], dtype=int)
+        self._jacobian_indptr = np.searchsorted(self._jacobian_cols,
+                                                np.arange(n + 1))
+        self._colors = None
+
+    def jacobian_sparsity(self):
+        """Return the fixed sparsity pattern of the Jacobian (CSC, ones)."""
+        return scipy.sparse.csc_matrix(
+            (np.ones(len(self._jacobian_rows)), self._jacobian_rows,
+             self._jacobian_indptr), shape=(self.n_state, self.n_state))
+
+    @property
+    def has_dynamic_rates(self):
+        """Whether any reaction rate depends on observables."""
+        return len(self._dynamic_reactions) > 0
+
+    def parameter_vector(self, param_values=None):
+        """Return parameter values as a vector in model.parameters order.
+
+        `param_values` may be None (use the model's values), a vector, or a
+        dict of values by parameter name overriding the model's values.
+        """
+        if param_values is not None and not isinstance(param_values, dict):
+            if len(param_values) != len(self.parameter_names):
+                raise ValueError("param_values must be the same length as "
+                                 "model.parameters")
+            return np.array(param_values, dtype=float)
+        values = np.array([p.value for p in self.model.parameters])
+        for name, value in (param_values or {}).items():
+            try:
+                values[self.parameter_names.index(name)] = value
+            except ValueError:
+                raise IndexError("param_values dictionary has unknown "
+                                 "parameter name (%s)" % name)
+        return values
+
+    def values(self, param_values=None):
+        """Return a dict of parameter values by name."""
+        return dict(zip(self.parameter_names,
+                        self.parameter_vector(param_values)))
+
+    def rate_constants(self, param_values=None):
+        """Return the vector of constant rate factors, one per reaction."""
+        values = self.values(param_values)
+        constants = np.array([float(evaluate(c, values))
+                              for c in self._constants])
+        k = self.rate_numbers.copy()
+        np.multiply.at(k, self._constant_reactions,
+                       constants[self._constant_index])
+        return k
+
+    def initial_values(self, param_values=None):
+        """Return the species vector given by model.initial_conditions."""
+        # Imported here to keep the index an optional dependency of systems
+        # built outside rasmodel.network.
+        from rasmodel.network.index import species_index
+        values = self.values(param_values)
+        index = species_index(self.model)
+        y0 = np.zeros(self.n_species)
+        for cp, value in self.model.initial_conditions:
+            y0[index[cp]] = evaluate(value, values)
+        return y0
+
+    def _parameter_matrix(self, entries, n_rows, values):
+        """Assemble (row, expression, scale) entries into a rows by
+        parameters CSR matrix of the scaled parameter derivatives."""
+        position = dict((name, i) for i, name in
+                        enumerate(self.parameter_names))
+        rows = []
+        cols = []
+        data = []
+        for row, expr, scale in entries:
+            for name, derivative in parameter_derivatives(expr):
+                rows.append(row)
+                cols.append(position[name])
+                data.append(scale * float(evaluate(derivative, values)))
+        return scipy.sparse.csr_matrix(
+            (data, (rows, cols)), shape=(n_rows, len(self.parameter_names)))
+
+    def rate_constant_derivatives(self, param_values=None):
+        """Return d(rate_constants())/d(parameters).
+
+        A reactions by parameters (model.parameters order) CSR matrix. Each
+        rate constant is a number times constant factors, so each factor
+        contributes its own derivative times the other factors.
+        """
+        values = self.values(param_values)
+        constants = np.array([float(evaluate(c, values))
+                              for c in self._constants])
+        terms = constants[self._constant_index]
+        entries = []
+        for t, (j, c) in enumerate(zip(self._constant_reactions,
+                                       self._constant_index)):
+            others = ((self._constant_reactions == j) &
+                      (np.arange(len(terms)) != t))
+            entries.append((j, self._constants[c],
+                            self.rate_numbers[j] * terms[others].prod()))
+        return self._parameter_matrix(entries, self.n_reactions, values)
+
+    def initial_value_derivatives(self, param_values=None):
+        """Return d(initial_values())/d(parameters).
+
+        A species by parameters (model.parameters order) CSR matrix.
+        """
+        from rasmodel.network.index import species_index
+        values = self.values(param_values)
+        index = species_index(self.model)
+        return self._parameter_matrix(
+            [(index[cp], value, 1.0) for cp, value in
+             self.model.initial_conditions], self.n_species, values)
+
+    @property
+    def clamped_values(self):
+        """Values of the clamped species, in the order of `clamped`."""
+        return self._y[self.clamped]
+
+    @clamped_values.setter
+    def clamped_values(self, values):
+        self._y[self.clamped] = values
+
+    def state(self, y):
+        """Return the state vector (free species) of a species vector."""
+        return np.asarray(y)[..., self.free]
+
+    def initial_state(self, y0):
+        """Set clamped_values from species vector `y0`, and return its state.
+        """
+        y0 = np.asarray(y0, dtype=float)
+        self.clamped_values = y0[self.clamped]
+        return self.state(y0)
+
+    def full_state(self, y):
+        """Return species vectors for state vectors `y`.
+
+        `y` has the state along its last axis; clamped species are filled in
+        from clamped_values, pruned species are 0 and ignored ones NaN.
+        """
+        y = np.asarray(y)
+        result = np.zeros(y.shape[:-1] + (self.n_species,))
+        result[..., self.free] = y
+        result[..., self.clamped] = self.clamped_values
+        result[..., self.ignored] = np.nan
+        return result
+
+    def expression_values(self, yobs, values):
+        """Evaluate the dynamic expressions given observable values.
+
+        `yobs` is an array with observables along its last axis, and `values`
+        a dict of parameter values from values(). Returns an array with
+        dynamic expressions along the last axis.
+        """
+        values = dict(values)
+        yobs = np.asarray(yobs)
+        for i, name in enumerate(self.observable_names):
+            values[name] = yobs[..., i]
+        result = np.empty(yobs.shape[:-1] + (len(self.dynamic_expressions),))
+        for i, expr in enumerate(self.dynamic_expressions):
+            result[..., i] = evaluate(expr.expr, values)
+        return result
+
+    def fluxes(self, y, k, values=None):
+        """Return the flux of every reaction at state `y`.
+
+        `values` (from values()) is only needed if rates depend on
+        observables.
+        """
+        self._y[self.free] = y
+        flux = k * self._y[self.reactants].prod(axis=1)
+        if self.has_dynamic_rates:
+            g = self.expression_values(self.observables.dot(self._y[:-1]),
+                                       values)
+            np.multiply.at(flux, self._dynamic_reactions,
+                           g[self._dynamic_index])
+        return flux
+
+    def rhs(self, y, k, values=None):
+        """Return dy/dt at state `y` given rate constants `k`."""
+        return self.stoichiometry.dot(self.fluxes(y, k, values))
+
+    def _flux_derivatives(self, y, k):
+        """Partial derivative of each reaction's flux for each reactant slot.
+        """
+        self._y[self.free] = y
+        factors = self._y[self.reactants]
+        m, order = self.reactants.shape
+        others = np.empty((m, order))
+        for s in range(order):
+            others[:, s] = np.prod(np.delete(factors, s, axis=1), axis=1)
+        return (k[self._slot_reactions] *
+                others[self._slot_reactions, self._slot_positions])
+
+    def relaxation_rates(self, y, k):
+        """Return the sum of d(flux)/d(reactant) over each reaction's free
+        reactants at state `y`.
+
+        This is the rate (1/time) at which a reaction relaxes a perturbation
+        of its reactants; observable-dependent rate factors are left out.
+        """
+        return np.bincount(self._slot_reactions,
+                           self._flux_derivatives(y, k),
+                           minlength=self.n_reactions)
+
+    def _jacobian(self, data):
+        return scipy.sparse.csc_matrix(
+            (data, self._jacobian_rows, self._jacobian_indptr),
+            shape=(self.n_state, self.n_state))
+
+    def jacobian_entries(self):
+        """Return the rows and columns of the Jacobian's fixed pattern, in
+        the order of jacobian_values()."""
+        return self._jacobian_rows, self._jacobian_cols
+
+    def jacobian_values(self, y, k, values=None):
+        """Return the Jacobian entries at `y`, in jacobian_entries() order.
+        """
+        if self.has_dynamic_rates:
+            return self.jacobian_fd(y, k, values).data
+        return self._jacobian_map.dot(self._flux_derivatives(y, k))
+
+    def jacobian(self, y, k, values=None):
+        """Return the Jacobian of rhs() at `y` as a CSC matrix.
+
+        Mass-action networks get the analytic Jacobian. With observable-
+        dependent rates it is approximated by colored finite differences.
+        """
+        if self.has_dynamic_rates:
+            return self.jacobian_fd(y, k, values)
+        return self._jacobian(self.jacobian_values(y, k, values))
+
+    def column_colors(self):
+        """Group Jacobian columns that share no rows (greedy coloring)."""
+        if self._colors is None:
+            pattern = self.jacobian_sparsity()
+            rows_of = [set(pattern.indices[pattern.indptr[i]:
+                                           pattern.indptr[i + 1]])
+                       for i in range(self.n_state)]
+            colors = np.empty(self.n_state, dtype=int)
+            used = []
+            for i in sorted(range(self.n_state),
+                            key=lambda i: -len(rows_of[i])):
+                for c, rows in enumerate(used):
+                    if not rows & rows_of[i]:
+                        rows |= rows_of[i]
+                        colors[i] = c
+                        break
+                else:
+                    colors[i] = len(used)
+                    used.append(set(rows_of[i]))
+            self._colors = colors
+        return self._colors
+
+    def jacobian_fd(self, y, k, values=None):
+        """Approximate the Jacobian by finite differences over column groups.
+        """
+        y = np.asarray(y, dtype=float)
+        f0 = self.rhs(y, k, values)
+        colors = self.column_colors()
+        h = np.sqrt(np.finfo(float).eps) * np.maximum(1.0, np.abs(y))
+        data = np.empty(len(self._jacobian_rows))
+        for c in range(colors.max() + 1 if len(colors) else 0):
+            columns = np.nonzero(colors == c)[0]
+            y1 = y.copy()
+            y1[columns] += h[columns]
+            df = self.rhs(y1, k, values) - f0
+            for i in columns:
+                start, end = self._jacobian_indptr[i:i + 2]
+                data[start:end] = (df[self._jacobian_rows[start:end]] /
+                                   h[i])
+        return self._jacobian(data)
+
+
+class DerivedSystem(object):
+    """Base class of systems built on the state of a MassActionSystem.
+
+    ReducedSystem, QSSASystem and LumpedSystem change the state vector but
+    keep the model, parameters, observables and clamps of the system they
+    wrap. The attributes named in `_shared` are read from that system;
+    subclasses provide the state-dependent methods used by Simulator.
+    """
+
+    # Attributes that are the same for the wrapped and the derived system.
+    _shared = ('model', 'n_species', 'n_reactions', 'parameter_names',
+               'dynamic_expressions', 'observable_names', 'observables',
+               'clamped', 'clamped_values', 'pruned', 'ignored',
+               'reactions', 'has_dynamic_rates', 'parameter_vector', 'values',
+               'rate_constants', 'initial_values', 'expression_values')
+
+    def __init__(self, system):
+        self.system = system
+
+    def __getattr__(self, name):
+        if name in self._shared:
+            return getattr(self.system, name)
+        raise AttributeError(name)
@@ -0,0 +1,555 @@
+"""Timescale separation and quasi-steady-state reduction.
+
+Many binding steps (e.g. ErbB1 priming by ATP, k122 = 1.87e-8 against ATP at
+1.2e9) relax in milliseconds while receptor trafficking and degradation take
+minutes to hours. The fast species make the system stiff without affecting
+the readouts at the time resolution of interest. This module
+
+ 1. estimates timescales at reference states: 1/|J_ii| for each species and
+    1/sum(d flux/d reactant) for each reaction (see
+    MassActionSystem.relaxation_rates),
+ 2. proposes the species faster than a threshold along a reference
+    trajectory, and holding little of any conserved pool, for elimination,
+    marking those held by a fast reversible pair as 'equilibrium' and the
+    others as 'qssa',
+ 3. eliminates them with QSSASystem: each is held at the quasi-steady state
+    dy_fast/dt = 0 given the slow species, set explicitly where it is linear
+    in the fast species alone and otherwise solved by chord iteration with
+    a reused factorization, and
+ 4. compares the reduced and the full model on a reference protocol::
+
+    from rasmodel.simulation import timescale
+    states = system.state(full_simulation.y)
+    fast = timescale.propose_fast(system, states, k, threshold=0.01)
+    report = timescale.error_report(model, tspan, [p.species for p in fast])
+    print report
+
+Rapid-equilibrium pairs are eliminated the same way, through the QSSA of
+their fast species; report.errors gives the price of that approximation.
+"""
+
+import time
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+from .system import DerivedSystem
+from .conservation import conservation_laws
+
+# Entries of the reduced Jacobian below this fraction of the larger of their
+# row and column diagonal entries are dropped.
+FILL_TOLERANCE = 1e-12
+
+
+class FastSpecies(object):
+    """A species proposed for elimination.
+
+    Attributes
+    ----------
+    species : int
+        Index in model.species.
+    timescale : float
+        1/|J_ii| at the reference state.
+    kind : str
+        'equilibrium' if the reaction consuming it fastest has a reverse
+        reaction that is also fast, otherwise 'qssa'.
+    reactions : list of int
+        Fast reactions (indexes in model.reactions) consuming it.
+    """
+
+    def __init__(self, species, timescale, kind, reactions):
+        self.species = species
+        self.timescale = timescale
+        self.kind = kind
+        self.reactions = reactions
+
+    def __repr__(self):
+        return '<%s %d (%s, %g)>' % (self.__class__.__name__, self.species,
+                                     self.kind, self.timescale)
+
+
+def species_timescales(system, x, k, values=None):
+    """Return 1/|J_ii| for each state variable of `system` at state `x`."""
+    diagonal = np.abs(system.jacobian(x, k, values).diagonal())
+    with np.errstate(divide='ignore'):
+        return 1.0 / diagonal
+
+
+def reaction_timescales(system, x, k):
+    """Return the relaxation time of each reaction of `system` at `x`."""
+    with np.errstate(divide='ignore'):
+        return 1.0 / system.relaxation_rates(x, k)
+
+
+def pool_fractions(system, x, tol=1e-9, laws=None):
+    """Return each species' largest share of a conserved pool at state `x`.
+
+    The share of species i in conservation law l is |l_i| x_i / (|l| . x).
+    Species outside every conservation law have share 0. Pass the
+    conservation laws of `system` as `laws` to reuse them across states.
+    """
+    if laws is None:
+        laws = conservation_laws(system.stoichiometry, tol)[0]
+    laws = np.abs(laws)
+    x = np.abs(x)
+    pools = laws.dot(x)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shares = np.nan_to_num(laws * x / pools[:, None])
+    return shares.max(axis=0) if len(shares) else np.zeros(len(x))
+
+
+def propose_fast(system, states, k, values=None, threshold=1.0,
+                 max_fraction=1e-2, tol=1e-9):
+    """Propose species to eliminate by quasi-steady-state approximation.
+
+    A species is proposed if its timescale is below `threshold` at every
+    reference state and it never holds more than `max_fraction` of a
+    conserved pool, since the QSSA neglects the change in the amount of the
+    eliminated species. The Jacobian block of the proposed species must
+    also be nonsingular for their quasi-steady state to be defined. Where
+    it is singular (e.g. a species and the complex it forms, which
+    conserve their sum), the slowest species of the offending combination
+    is kept, until the block is nonsingular.
+
+    Parameters
+    ----------
+    system : MassActionSystem
+    states : numpy.ndarray
+        Reference states, one per row, e.g. the state trajectory of a
+        simulation of the full system from its initial state. Species that
+        are only fast once the response is under way (an enzyme whose
+        substrate starts at zero) are not proposed if the initial state is
+        included.
+    k, values
+        Rate constants and parameter values, as for system.rhs.
+    threshold : float, optional
+        Largest timescale to eliminate, in model time units.
+    max_fraction : float, optional
+        Largest share of a conserved pool a proposed species may hold.
+    tol : float, optional
+        Relative tolerance for singularity.
+
+    Returns
+    -------
+    list of FastSpecies, fastest first.
+    """
+    states = np.atleast_2d(states)
+    tau = np.max([species_timescales(system, x, k, values)
+                  for x in states], axis=0)
+    laws = conservation_laws(system.stoichiometry, tol)[0]
+    fraction = np.max([pool_fractions(system, x, tol, laws)
+                       for x in states], axis=0)
+    fast = [i for i in np.argsort(tau)
+            if tau[i] < threshold and fraction[i] <= max_fraction]
+    for x in states:
+        jacobian = system.jacobian(x, k, values).toarray()
+        while fast:
+            block = jacobian[np.ix_(fast, fast)]
+            u, s, vt = np.linalg.svd(block)
+            if s[-1] > tol * s[0]:
+                break
+            null = np.abs(vt[-1])
+            involved = [n for n in range(len(fast))
+                        if null[n] > tol * null.max()]
+            del fast[max(involved, key=lambda n: tau[fast[n]])]
+
+    reaction_tau = np.max([reaction_timescales(system, x, k)
+                           for x in states], axis=0)
+    model = system.model
+    reactions = [model.reactions[j] for j in system.reactions]
+    reverse = {}
+    for j, r in enumerate(reactions):
+        reverse[(tuple(sorted(r['reactants'])),
+                 tuple(sorted(r['products'])))] = j
+    proposals = []
+    for i in fast:
+        species = system.free[i]
+        consuming = [j for j, r in enumerate(reactions)
+                     if species in r['reactants'] and
+                     reaction_tau[j] < threshold]
+        kind = 'qssa'
+        if consuming:
+            j = min(consuming, key=lambda j: reaction_tau[j])
+            r = reactions[j]
+            back = reverse.get((tuple(sorted(r['products'])),
+                                tuple(sorted(r['reactants']))))
+            if back is not None and reaction_tau[back] < threshold:
+                kind = 'equilibrium'
+        proposals.append(FastSpecies(species, tau[i], kind,
+                                     [system.reactions[j] for j in consuming]))
+    return proposals
+
+
+class QSSASystem(DerivedSystem):
+    """A MassActionSystem with fast species held at quasi-steady state.
+
+    The state vector holds the slow species. The fast species are computed
+    from them by solving rhs(y)[fast] = 0 at every evaluation:
+
+     - Fast species whose reactions have no other fast reactant (e.g. the
+       complex of a fast reversible binding between slow species) obey a
+       linear equation in themselves alone. They are set explicitly to
+       production / (consumption per unit amount), from one flux evaluation.
+     - The others are found by chord iteration from the last solution, with
+       an LU factorization of their Jacobian block that is kept across
+       evaluations and only refreshed when the iteration stops contracting,
+       at Jacobian evaluations, or when the rate constants change. When the
+       slow state has barely moved the first chord step is already within
+       tolerance, so an evaluation costs a triangular solve and no
+       factorization.
+
+    The Jacobian is the Schur complement J_ss - J_sf J_ff^-1 J_fs, without
+    the entries it fills in at roundoff level (see FILL_TOLERANCE). The
+    methods used by Simulator are provided with the same signatures as
+    MassActionSystem, on reduced state vectors::
+
+        system = QSSASystem(MassActionSystem(model), fast)
+
+    Parameters
+    ----------
+    system : MassActionSystem
+    fast : list of int
+        Species (indexes in model.species) to eliminate. Clamped, pruned and
+        ignored species are skipped.
+    rtol, atol : float, optional
+        Tolerances of the chord iteration.
+    max_iterations : int, optional
+        Chord iterations per solve before giving up.
+
+    Attributes
+    ----------
+    fast, slow : numpy.ndarray of int
+        Positions of the eliminated and the remaining species in the state
+        of `system`.
+    explicit, coupled : numpy.ndarray of int
+        The fast species set explicitly and by chord iteration.
+    """
+
+    def __init__(self, system, fast, rtol=1e-8, atol=1e-6,
+                 max_iterations=50):
+        DerivedSystem.__init__(self, system)
+        columns = system._columns[np.asarray(fast, dtype=int)]
+        self.fast = np.unique(columns[columns >= 0])
+        self.slow = np.setdiff1d(np.arange(system.n_state), self.fast)
+        self.free = system.free[self.slow]
+        self.n_state = len(self.slow)
+        self.rtol = rtol
+        self.atol = atol
+        self.max_iterations = max_iterations
+        self._split_fast()
+        self._index_jacobian()
+        self._y_fast = np.zeros(len(self.fast))
+        self._lu = None
+        self._k = None
+        # Slow state, rate constants, full state and right hand side of the
+        # last solve.
+        self._last = (None, None, None, None)
+        # Rate constants and parameter values of the last evaluation, for
+        # full_state().
+        self._parameters = (None, None)
+
+    def _split_fast(self):
+        """Find the fast species that can be set explicitly, and the
+        production and consumption matrices that give their values."""
+        system = self.system
+        stoichiometry = system.stoichiometry.tocsc()
+        is_fast = np.zeros(system.n_state + 1, dtype=bool)
+        is_fast[self.fast] = True
+        # State column of each reactant slot; n_state for padding and
+        # species outside the state.
+        columns = system._columns[system.reactants]
+        columns[columns < 0] = system.n_state
+        fast_reactants = [sorted(c for c in row if is_fast[c])
+                          for row in columns]
+        explicit = []
+        if not system.has_dynamic_rates:
+            touching = [set() for i in range(system.n_state)]
+            for f, row in enumerate(columns):
+                for c in row:
+                    if c < system.n_state:
+                        touching[c].add(f)
+                for i in stoichiometry.indices[stoichiometry.indptr[f]:
+                                               stoichiometry.indptr[f + 1]]:
+                    touching[i].add(f)
+            for i in self.fast:
+                for f in touching[i]:
+                    if i in fast_reactants[f]:
+                        if fast_reactants[f] != [i] or \
+                                stoichiometry[i, f] > 0:
+                            break
+                    elif fast_reactants[f]:
+                        break
+                else:
+                    explicit.append(i)
+        self.explicit = np.array(explicit, dtype=int)
+        self.coupled = np.setdiff1d(self.fast, self.explicit)
+        self._positions = (np.searchsorted(self.fast, self.explicit),
+                           np.searchsorted(self.fast, self.coupled))
+        rows = system.stoichiometry.tocsr()[self.explicit]
+        self._production = rows.multiply(rows > 0).tocsr()
+        self._consumption = -rows.multiply(rows < 0).tocsr()
+
+    def _index_jacobian(self):
+        """Locate the blocks of the Jacobian in jacobian_values() order.
+
+        Each block is (entries, rows, columns), to be scattered into a dense
+        array by _dense(). Only the slow rows that depend on fast species
+        and the slow columns that fast species depend on are changed by the
+        elimination; the other entries of J_ss are kept as they are.
+        """
+        rows, columns = self.system.jacobian_entries()
+        slow = -np.ones(self.system.n_state, dtype=int)
+        slow[self.slow] = np.arange(self.n_state)
+        fast = -np.ones(self.system.n_state, dtype=int)
+        fast[self.fast] = np.arange(len(self.fast))
+        slow_rows, slow_columns = slow[rows], slow[columns]
+        fast_rows, fast_columns = fast[rows], fast[columns]
+        corrected_rows = np.unique(
+            slow_rows[(slow_rows >= 0) & (fast_columns >= 0)])
+        corrected_columns = np.unique(
+            slow_columns[(fast_rows >= 0) & (slow_columns >= 0)])
+        self._corrected = (corrected_rows, corrected_columns)
+        row = -np.ones(self.n_state, dtype=int)
+        row[corrected_rows] = np.arange(len(corrected_rows))
+        column = -np.ones(self.n_state, dtype=int)
+        column[corrected_columns] = np.arange(len(corrected_columns))
+
+        def block(selected, i, j):
+            return np.flatnonzero(selected), i[selected], j[selected]
+
+        fast_fast = (fast_rows >= 0) & (fast_columns >= 0)
+        self._fast_fast = block(fast_fast, fast_rows, fast_columns)
+        fast_slow = (fast_rows >= 0) & (slow_columns >= 0)
+        self._fast_slow = block(fast_slow, fast_rows, column[slow_columns])
+        slow_fast = (slow_rows >= 0) & (fast_columns >= 0)
+        self._slow_fast = block(slow_fast, row[slow_rows], fast_columns)
+        slow_slow = (slow_rows >= 0) & (slow_columns >= 0)
+        inside = slow_slow & (row[slow_rows] >= 0) & \
+            (column[slow_columns] >= 0)
+        self._slow_corrected = block(inside, row[slow_rows],
+                                     column[slow_columns])
+        self._slow_kept = block(slow_slow & ~inside, slow_rows, slow_columns)
+        self._slow_diagonal = block(slow_slow & (rows == columns),
+                                    slow_rows, slow_columns)[:2]
+        common = np.intersect1d(corrected_rows, corrected_columns)
+        self._corrected_diagonal = (common, row[common], column[common])
+
+    def _fast_block(self, jacobian_values):
+        """Return J_ff as a dense array."""
+        n = len(self.fast)
+        return _dense(jacobian_values, self._fast_fast, (n, n))
+
+    def _factor(self, block, k):
+        """Factorize the coupled part of J_ff, given as `block`, for the
+        chord iteration at rate constants `k`."""
+        coupled = self._positions[1]
+        self._lu = scipy.sparse.linalg.splu(
+            scipy.sparse.csc_matrix(block[np.ix_(coupled, coupled)]))
+        self._k = k.copy()
+
+    def _solve_fast(self, x, k, values):
+        """Return the full state with the fast species at quasi-steady
+        state for slow state `x`, and the right hand side there."""
+        system = self.system
+        self._parameters = (k, values)
+        last_x, last_k, last_y, last_f = self._last
+        if last_x is not None and np.array_equal(x, last_x) and \
+                np.array_equal(k, last_k):
+            return last_y.copy(), last_f.copy()
+        y = np.empty(system.n_state)
+        y[self.slow] = x
+        y[self.fast] = self._y_fast
+        if len(self.explicit):
+            y[self.explicit] = 1
+            flux = system.fluxes(y, k, values)
+            production = self._production.dot(flux)
+            consumption = self._consumption.dot(flux)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                y[self.explicit] = np.where(consumption > 0,
+                                            production / consumption, 0)
+        coupled = self.coupled
+        if len(coupled) and (self._lu is None or
+                             not np.array_equal(k, self._k)):
+            self._factor(self._fast_block(
+                system.jacobian_values(y, k, values)), k)
+        previous = None
+        fresh = True
+        for iteration in range(self.max_iterations):
+            f = system.rhs(y, k, values)
+            if not len(coupled) or previous is not None and previous <= 1:
+                break
+            step = -self._lu.solve(f[coupled])
+            norm = np.max(np.abs(step) /
+                          (self.atol + self.rtol * np.abs(y[coupled])))
+            if previous is not None and norm > 0.5 * previous and not fresh:
+                # The factorization is out of date; refresh it at y.
+                self._factor(self._fast_block(
+                    system.jacobian_values(y, k, values)), k)
+                step = -self._lu.solve(f[coupled])
+                fresh = True
+            else:
+                fresh = False
+            # Keep the fast species nonnegative (within atol).
+            damping = 1.0
+            while np.any(y[coupled] + damping * step < -self.atol) and \
+                    damping > 1e-6:
+                damping /= 2
+            y[coupled] += damping * step
+            previous = norm
+        else:
+            raise RuntimeError("Quasi-steady state did not converge")
+        self._y_fast = y[self.fast].copy()
+        self._last = (x.copy(), k.copy(), y.copy(), f.copy())
+        return y, f
+
+    def initial_state(self, y0):
+        """Set clamped values from species vector `y0` and return its slow
+        state. The fast values of `y0` start the first chord iteration."""
+        x = self.system.initial_state(y0)
+        self._y_fast = x[self.fast]
+        self._last = (None, None, None, None)
+        return x[self.slow]
+
+    def state(self, y):
+        """Return the slow state of species vectors `y`."""
+        return self.system.state(y)[..., self.slow]
+
+    def expand(self, x, k, values=None):
+        """Return the full states for slow states `x`. Rows that are not
+        finite (from a failed integration) expand to NaN."""
+        x = np.asarray(x)
+        flat = x.reshape(-1, self.n_state)
+        result = np.empty((len(flat), self.system.n_state))
+        for row, out in zip(flat, result):
+            if np.all(np.isfinite(row)):
+                out[:] = self._solve_fast(row, k, values)[0]
+            else:
+                out[:] = np.nan
+        return result.reshape(x.shape[:-1] + (self.system.n_state,))
+
+    def full_state(self, x):
+        """Return species vectors for slow states `x`, with the rate
+        constants of the last evaluation."""
+        k, values = self._parameters
+        return self.system.full_state(self.expand(x, k, values))
+
+    def fluxes(self, x, k, values=None):
+        return self.system.fluxes(self._solve_fast(x, k, values)[0], k,
+                                  values)
+
+    def rhs(self, x, k, values=None):
+        return self._solve_fast(x, k, values)[1][self.slow]
+
+    def _solve_block(self, block, b):
+        """Solve J_ff z = b, given J_ff as `block`, with the chord
+        factorization. Explicit species depend on no other fast species, so
+        J_ff is lower block triangular with a diagonal explicit block."""
+        z = np.empty_like(b)
+        explicit, coupled = self._positions
+        z[explicit] = b[explicit] / block.diagonal()[explicit][:, None]
+        if len(coupled):
+            z[coupled] = self._lu.solve(
+                b[coupled] -
+                block[np.ix_(coupled, explicit)].dot(z[explicit]))
+        return z
+
+    def jacobian(self, x, k, values=None):
+        y = self._solve_fast(x, k, values)[0]
+        jacobian = self.system.jacobian_values(y, k, values)
+        block = self._fast_block(jacobian)
+        if len(self.coupled):
+            # Refresh the chord factorization while the Jacobian is at hand.
+            self._factor(block, k)
+        rows, columns = self._corrected
+        n = len(self.fast)
+        coupling = self._solve_block(
+            block, _dense(jacobian, self._fast_slow, (n, len(columns))))
+        corrected = _dense(jacobian, self._slow_corrected,
+                           (len(rows), len(columns))) - \
+            _dense(jacobian, self._slow_fast, (len(rows), n)).dot(coupling)
+        # The correction fills in many entries at roundoff level, which
+        # would only slow down the integrator's LU decompositions.
+        diagonal = np.zeros(self.n_state)
+        entries, i = self._slow_diagonal
+        diagonal[i] = jacobian[entries]
+        common, i, j = self._corrected_diagonal
+        diagonal[common] = corrected[i, j]
+        diagonal = np.abs(diagonal)
+        scale = np.maximum(diagonal[rows][:, None], diagonal[columns])
+        i, j = np.nonzero(np.abs(corrected) > FILL_TOLERANCE * scale)
+        entries, kept_rows, kept_columns = self._slow_kept
+        return scipy.sparse.csc_matrix(
+            (np.concatenate([jacobian[entries], corrected[i, j]]),
+             (np.concatenate([kept_rows, rows[i]]),
+              np.concatenate([kept_columns, columns[j]]))),
+            shape=(self.n_state, self.n_state))
+
+
+def _dense(values, block, shape):
+    """Scatter the entries of `values` in `block` into a dense array."""
+    entries, rows, columns = block
+    result = np.zeros(shape)
+    result[rows, columns] = values[entries]
+    return result
+
+
+class ErrorReport(object):
+    """Comparison of a QSSA-reduced model with the full model.
+
+    Attributes
+    ----------
+    fast : numpy.ndarray of int
+        Eliminated species.
+    errors : dict
+        Maximum absolute difference of each observable and dynamic
+        expression, relative to its maximum absolute value in the full
+        model, by name.
+    seconds, evaluations : (float, float), (int, int)
+        Integration time and right hand side evaluations of the full and
+        the reduced model.
+    """
+
+    def __init__(self, fast, errors, seconds, evaluations):
+        self.fast = fast
+        self.errors = errors
+        self.seconds = seconds
+        self.evaluations = evaluations
+
+    def __str__(self):
+        lines = ['%d species eliminated' % len(self.fast),
+                 'time: %.3gs full, %.3gs reduced' % self.seconds,
+                 'rhs evaluations: %d full, %d reduced' % self.evaluations,
+                 'relative errors:']
+        for name in sorted(self.errors, key=lambda n: -self.errors[n]):
+            lines.append('  %-30s %.3g' % (name, self.errors[name]))
+        return '\n'.join(lines)
+
+
+def error_report(model, tspan, fast, param_values=None, y0=None,
+                 **simulator_options):
+    """Simulate the full and the QSSA-reduced model and compare them.
+
+    `fast` are the species to eliminate. The reference protocol is given
+    by `tspan`, `param_values` and `y0`, as for Simulator.run, and the
+    remaining options are passed on to both Simulators. Returns an
+    ErrorReport.
+    """
+    from .solver import Simulator
+    full = Simulator(model, tspan, **simulator_options)
+    reduced = Simulator(model, tspan, qssa=fast, **simulator_options)
+    seconds = []
+    evaluations = []
+    for sim in full, reduced:
+        start = time.time()
+        sim.run(param_values, y0)
+        seconds.append(time.time() - start)
+        evaluations.append(sim.stats.get('nfev', 0))
+    errors = {}
+    for attr in 'yobs', 'yexpr':
+        expected = getattr(full, attr)
+        actual = getattr(reduced, attr)
+        for name in expected.dtype.names or ():
+            scale = np.abs(expected[name]).max()
+            error = np.abs(expected[name] - actual[name]).max()
+            errors[name] = error / scale if scale else error
+    return ErrorReport(reduced.system.system.free[reduced.system.fast],
+                       errors, tuple(seconds), tuple(evaluations))
@@ -0,0 +1,83 @@
+import shutil
+import tempfile
+import unittest
+import pysb.bng
+from pysb import Model, Monomer, Parameter, Rule, Observable
+from rasmodel.network import cache, generate
+
+
+def binding_model(phosphorylation):
+    """A binds B; with `phosphorylation`, A phosphorylates the bound B."""
+    model = Model('cache_round_trip', _export=False)
+    A = Monomer('A', ['b'], _export=False)
+    B = Monomer('B', ['a', 's'], {'s': ['u', 'p']}, _export=False)
+    k = Parameter('k', 1, _export=False)
+    A_0 = Parameter('A_0', 10, _export=False)
+    B_0 = Parameter('B_0', 5, _export=False)
+    for component in A, B, k, A_0, B_0:
+        model.add_component(component)
+    model.add_component(Rule(
+        'bind', A(b=None) + B(a=None) <> A(b=1) % B(a=1), k, k,
+        _export=False))
+    if phosphorylation:
+        model.add_component(Rule(
+            'phosphorylate',
+            A(b=1) % B(a=1, s='u') >> A(b=1) % B(a=1, s='p'), k,
+            _export=False))
+    model.add_component(Observable('AB', A(b=1) % B(a=1), _export=False))
+    model.initial(A(b=None), A_0)
+    model.initial(B(a=None, s='u'), B_0)
+    return model
+
+
+class BNGCalled(Exception):
+    pass
+
+
+class TestIncremental(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        cache.generate_equations(binding_model(False),
+                                 cache_dir=self.cache_dir,
+                                 generator='python')
+        self.previous = cache.load_latest(binding_model(True),
+                                          self.cache_dir)
+        self.bng = pysb.bng.generate_equations
+
+        def bng(model, *args):
+            raise BNGCalled()
+        pysb.bng.generate_equations = bng
+
+    def tearDown(self):
+        pysb.bng.generate_equations = self.bng
+        shutil.rmtree(self.cache_dir)
+
+    def test_verified_round_trip(self):
+        self.assertTrue(generate.can_extend(self.previous,
+                                            binding_model(True)))
+        model = binding_model(True)
+        cache.generate_equations(model, cache_dir=self.cache_dir,
+                                 generator='python', verify=True)
+        full = generate.generate_network(binding_model(True))
+        self.assertEqual(generate.compare_networks(
+            cache.network_record(model), full, model), [])
+        self.assertEqual(len(model.species), 5)
+        # The stored network is restored as is on the next call.
+        again = binding_model(True)
+        cache.generate_equations(again, cache_dir=self.cache_dir,
+                                 generator='bng')
+        self.assertEqual(map(str, again.species), map(str, model.species))
+
+    def test_bng_is_not_incremental_by_default(self):
+        self.assertRaises(BNGCalled, cache.generate_equations,
+                          binding_model(True), cache_dir=self.cache_dir,
+                          generator='bng')
+        model = binding_model(True)
+        cache.generate_equations(model, cache_dir=self.cache_dir,
+                                 generator='bng', incremental=True)
+        self.assertEqual(len(model.species), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
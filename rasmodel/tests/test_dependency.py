@@ -0,0 +1,51 @@
+import unittest
+from pysb import Model, Monomer, Parameter, Rule, Observable
+from rasmodel.network.generate import generate_equations
+from rasmodel.network.dependency import dependency_cone, cone_report
+
+
+def sequestration_model():
+    """A kinase phosphorylates free A, and B sequesters A."""
+    model = Model('sequestration', _export=False)
+    A = Monomer('A', ['b', 's'], {'s': ['u', 'p']}, _export=False)
+    B = Monomer('B', ['a'], _export=False)
+    K = Monomer('K', _export=False)
+    k = Parameter('k', 1, _export=False)
+    A_0 = Parameter('A_0', 100, _export=False)
+    B_0 = Parameter('B_0', 50, _export=False)
+    K_0 = Parameter('K_0', 1, _export=False)
+    for component in A, B, K, k, A_0, B_0, K_0:
+        model.add_component(component)
+    model.add_component(Rule(
+        'phosphorylate', K() + A(b=None, s='u') >> K() + A(b=None, s='p'), k,
+        _export=False))
+    model.add_component(Rule(
+        'bind', A(b=None) + B(a=None) <> A(b=1) % B(a=1), k, k,
+        _export=False))
+    model.add_component(Observable('free_pA', A(b=None, s='p'),
+                                   _export=False))
+    model.initial(A(b=None, s='u'), A_0)
+    model.initial(B(a=None), B_0)
+    model.initial(K(), K_0)
+    generate_equations(model)
+    return model
+
+
+class TestDependency(unittest.TestCase):
+
+    def test_sequestering_species_are_candidates(self):
+        model = sequestration_model()
+        species, reactions = dependency_cone(model, ['free_pA'])
+        self.assertEqual(len(species), len(model.species))
+        (row, everything) = cone_report(model, ['free_pA'])
+        self.assertEqual(row['species'], len(model.species))
+        candidates = set(str(model.species[i]) for i in row['candidates'])
+        self.assertEqual(candidates, set([
+            "B(a=None)",
+            "A(b=1, s='u') % B(a=1)",
+            "A(b=1, s='p') % B(a=1)"]))
+        self.assertEqual(everything['candidates'], row['candidates'])
+
+
+if __name__ == '__main__':
+    unittest.main()
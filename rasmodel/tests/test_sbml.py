@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+import unittest
+import warnings
+import numpy as np
+import scipy.integrate
+from rasmodel.network import sbml
+from rasmodel.chen_2009.sbml_simulation import SBMLSimulator
+
+# Level 3 model in a compartment of size 2: cell * (k1*A*B - k2*C),
+# 0.5 * cell * k3 * C, and a Michaelis-Menten law the loader leaves out.
+PATH = os.path.join(os.path.dirname(__file__), 'data',
+                    'compartment_mass_action.xml')
+VOLUME = 2.0
+K1, K2, K3 = 0.7, 0.3, 0.2
+
+
+def concentration_rhs(c, t):
+    """The kinetic laws of the file in concentration form, without the
+    Michaelis-Menten reaction."""
+    A, B, C, D = c
+    bind = VOLUME * (K1 * A * B - K2 * C)
+    convert = 0.5 * VOLUME * K3 * C
+    return np.array([-bind, -bind, bind - convert, convert]) / VOLUME
+
+
+class TestSBML(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.model = sbml.load(PATH, cache_dir=self.cache_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_rate_scales(self):
+        scales = dict((r.id, (r.kf.name, r.kf_scale, r.kr.name, r.kr_scale))
+                      for r in self.model.reactions)
+        self.assertEqual(scales, {
+            'bind': ('k1', 1 / VOLUME, 'k2', 1.0),
+            'convert': ('k3', 0.5, '_zero', 1.0)})
+        self.assertEqual([r for r, reason in self.model.unrecognized],
+                         ['mm'])
+
+    def test_initial_amounts(self):
+        amounts = [(s.name, s.initial_amount) for s in self.model.species]
+        self.assertEqual(amounts, [('A', 6.0), ('B', 3.0), ('C', 0.4),
+                                   ('D', 0.0)])
+
+    def test_simulation_matches_concentration_odes(self):
+        tspan = np.linspace(0, 5, 11)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            sim = SBMLSimulator(tspan, self.model, atol=1e-10, rtol=1e-10)
+        self.assertEqual(len(caught), 1)
+        self.assertIn('mm', str(caught[0].message))
+        sim.run()
+        c = scipy.integrate.odeint(concentration_rhs, [3, 1.5, 0.2, 0],
+                                   tspan, rtol=1e-11, atol=1e-12)
+        np.testing.assert_allclose(sim.y, VOLUME * c, rtol=1e-7, atol=1e-8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -25,52 +25,34 @@ ERK_phosphorylation.declare_observables()
 
 # from ERK_phosphorylation import by_BRAF_wt
 import numpy as np
-from pysb.integrate import Solver
+from rasmodel.simulation.steady import SteadyStateSolver
 
 Ras_range = 2 * np.linspace(0, 1e5, num=10)
 sos_range = 2 * np.linspace(0, 1000, num=10)
 Vemurafenib_range = 2 * np.linspace(0, 1e5, num=10)
 
-RAF_WT_level = []
-RAF_V600E_level = []
-ERK_P_level = []
-KRAS_level = []
-SOS_level = []
-
-# for s in sos_range:
-for r in Ras_range:
-    wt_holder_row = []
-    v600e_holder_row = []
-    erk_holder_row = []
-    kras_holder_row = []
-    sos_holder_row = []
-    for v in Vemurafenib_range:
-
-        model.parameters['KRAS_0'].value = r
-        # model.parameters['SOS_0'].value = s
-        model.parameters['Vem_0'].value = v
-
-        ts = np.linspace(0, 1e5, 100)
-        solver = Solver(model, ts)
-        solver.run()
-
-        wt_holder_row.append(solver.yobs['BRAF_WT_active'][-1])
-        v600e_holder_row.append(solver.yobs['BRAF_V600E_active'][-1])
-        erk_holder_row.append(solver.yobs['ERK_P'][-1])
-        kras_holder_row.append(solver.yobs['active_KRAS'][-1])
-        sos_holder_row.append(solver.yobs['active_SOS'][-1])
-
-    RAF_WT_level.append(wt_holder_row)
-    RAF_V600E_level.append(v600e_holder_row)
-    ERK_P_level.append(erk_holder_row)
-    KRAS_level.append(kras_holder_row)
-    SOS_level.append(sos_holder_row)
-
-wt = np.array(RAF_WT_level, dtype='float')
-v600e = np.array(RAF_V600E_level, dtype='float')
-erkp = np.array(ERK_P_level, dtype='float')
-kras = np.array(KRAS_level, dtype='float')
-sos = np.array(SOS_level, dtype='float')
+# Solve for the steady state at every point of the KRAS_0 x Vem_0 grid, each
+# starting from the solution of the nearest point already solved. This takes
+# seconds where integrating the grid to t=1e5 took over a minute, and that
+# integration had not yet settled at three of the points.
+solver = SteadyStateSolver(model)
+conditions = [{'KRAS_0': r, 'Vem_0': v}
+              # {'SOS_0': s, 'Vem_0': v}
+              for r in Ras_range for v in Vemurafenib_range]
+steady_states = solver.scan(conditions)
+for s in steady_states:
+    if not s.converged:
+        print 'Steady state not found:', s, s.attempts
+
+# Steady-state observable values, shaped (KRAS, Vemurafenib).
+final = np.array([s.yobs for s in steady_states])
+final = final.reshape(len(Ras_range), len(Vemurafenib_range), -1)
+obs_index = solver.system.observable_names.index
+wt = final[..., obs_index('BRAF_WT_active')]
+v600e = final[..., obs_index('BRAF_V600E_active')]
+erkp = final[..., obs_index('ERK_P')]
+kras = final[..., obs_index('active_KRAS')]
+sos = final[..., obs_index('active_SOS')]
 
 # Plots
 # -----